@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ClinSpeech.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Импорт после get_asgi_application(): к этому моменту Django уже настроен
+from api.events import EVENTS_PATH, sse_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # SSE-поток хода обработки отдаем напрямую, долгие соединения не держат Django-вьюхи
+    if scope['type'] == 'http' and scope['method'] == 'GET' and EVENTS_PATH.match(scope['path']):
+        await sse_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -2,6 +2,7 @@
 Django settings for ClinSpeech project.
 """
 import os
+from importlib.util import find_spec
 from pathlib import Path
 import environ  # Библиотека для работы с .env файлами
 
@@ -20,7 +21,6 @@ ALLOWED_HOSTS = env.list('ALLOWED_HOSTS', default=['127.0.0.1', 'localhost'])
 
 # 3. Приложения
 INSTALLED_APPS = [
-    'django_q',  # django-q2 импортируется как django_q
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -31,6 +31,9 @@ INSTALLED_APPS = [
     'corsheaders',
     'api',
 ]
+# django-q2 импортируется как django_q. Пакета нет — задачи выполняет встроенный пул (раздел 26)
+if find_spec('django_q') is not None:
+    INSTALLED_APPS.insert(0, 'django_q')
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',  # CORS должен быть вверху
@@ -122,4 +125,138 @@ Q_CLUSTER = {
     'queue_limit': 500,
     'cpu_affinity': 1,
     'label': 'Django Q',
-    'orm': 'default'   }
\ No newline at end of file
+    'daemonize_workers': False,  # воркерам нужен пул процессов для длинных записей (api/chunking.py)
+    'orm': 'default'   }
+
+
+# 9. Whisper (локальная транскрибация)
+WHISPER_MODEL = env('WHISPER_MODEL', default='medium')
+WHISPER_DEVICE = env('WHISPER_DEVICE', default='cpu')
+WHISPER_COMPUTE_TYPE = env('WHISPER_COMPUTE_TYPE', default='float32')
+# Какие модели прогревать при старте воркера Django Q (пустой список = не прогревать)
+WHISPER_PRELOAD_MODELS = env.list('WHISPER_PRELOAD_MODELS', default=[WHISPER_MODEL])
+# Сколько памяти могут занимать загруженные модели в одном процессе
+WHISPER_MODEL_MEMORY_LIMIT_MB = env.int('WHISPER_MODEL_MEMORY_LIMIT_MB', default=4096)
+# Доп. параметры model.transcribe (язык, beam_size и т.д.) — входят в ключ кэша транскрибаций
+WHISPER_DECODE_OPTIONS = {}
+
+# 10. Кэш транскрибаций (одинаковое аудио не распознаём дважды)
+TRANSCRIPTION_CACHE_MAX_MB = env.int('TRANSCRIPTION_CACHE_MAX_MB', default=512)
+TRANSCRIPTION_CACHE_MAX_AGE_DAYS = env.int('TRANSCRIPTION_CACHE_MAX_AGE_DAYS', default=90)
+
+# 11. Длинные записи: режем по паузам и распознаём куски параллельно
+WHISPER_CHUNK_SECONDS = env.int('WHISPER_CHUNK_SECONDS', default=120)
+WHISPER_CHUNK_MAX_SECONDS = env.int('WHISPER_CHUNK_MAX_SECONDS', default=180)
+WHISPER_CHUNK_WORKERS = env.int('WHISPER_CHUNK_WORKERS', default=2)
+# Потоковый режим: ffmpeg -> окна по 30 c, постоянная память, но без параллельности
+WHISPER_STREAMING = env.bool('WHISPER_STREAMING', default=False)
+
+# 12. Пакетный планировщик (manage.py run_batch_scheduler): окна нескольких записей в одном батче
+# Если включён, загрузка не ставит задачу в Django Q — консультацию забирает планировщик
+WHISPER_BATCH_SCHEDULER = env.bool('WHISPER_BATCH_SCHEDULER', default=False)
+WHISPER_BATCH_MAX_SIZE = env.int('WHISPER_BATCH_MAX_SIZE', default=8)
+WHISPER_BATCH_MAX_WAIT = env.float('WHISPER_BATCH_MAX_WAIT', default=2.0)  # секунды
+
+# 13. Режим "черновик -> уточнение": быстрый черновик, большая модель только для сомнительных мест
+WHISPER_TWO_TIER = env.bool('WHISPER_TWO_TIER', default=False)
+WHISPER_DRAFT_MODEL = env('WHISPER_DRAFT_MODEL', default='base')
+# Сегмент сомнительный, если avg_logprob ниже порога или no_speech_prob выше порога
+WHISPER_REFINE_LOGPROB_THRESHOLD = env.float('WHISPER_REFINE_LOGPROB_THRESHOLD', default=-0.7)
+WHISPER_REFINE_NO_SPEECH_THRESHOLD = env.float('WHISPER_REFINE_NO_SPEECH_THRESHOLD', default=0.5)
+
+# 14. Движок транскрибации (api/backends.py): 'whisper' (fp32) или 'whisper-int8' (int8-квантизация, только CPU)
+TRANSCRIPTION_BACKEND = env('TRANSCRIPTION_BACKEND', default='whisper')
+
+# 15. Push-уведомления о ходе обработки (SSE, ClinSpeech/asgi.py)
+PROGRESS_EVENTS_TTL_HOURS = env.int('PROGRESS_EVENTS_TTL_HOURS', default=24)
+PROGRESS_POLL_INTERVAL = env.float('PROGRESS_POLL_INTERVAL', default=0.5)  # секунды
+
+# 16. Живая транскрибация во время приема (api/live.py)
+LIVE_MIN_WINDOW_SECONDS = env.float('LIVE_MIN_WINDOW_SECONDS', default=3.0)
+LIVE_MAX_WINDOW_SECONDS = env.float('LIVE_MAX_WINDOW_SECONDS', default=25.0)
+# Последние секунды окна еще могут измениться — их не подтверждаем
+LIVE_HOLDBACK_SECONDS = env.float('LIVE_HOLDBACK_SECONDS', default=2.0)
+
+# 17. Клинические правила для отчета (api/rule_engine.py), файл перечитывается при изменении
+CLINICAL_RULES_FILE = env('CLINICAL_RULES_FILE', default=str(BASE_DIR / 'api' / 'clinical_rules.json'))
+
+# 18. Кэш PDF-заключений (api/pdf_reports.py). Не в MEDIA_ROOT: отчеты не должны раздаваться по /media/
+PDF_CACHE_DIR = env('PDF_CACHE_DIR', default=os.path.join(BASE_DIR, 'pdf_cache'))
+
+# 19. Массовая выгрузка PDF в ZIP (api/exports.py)
+EXPORT_WORKERS = env.int('EXPORT_WORKERS', default=2)  # процессов для рендера
+EXPORT_SYNC_MAX = env.int('EXPORT_SYNC_MAX', default=500)  # больше — только фоновой задачей
+EXPORT_JOB_BATCH = env.int('EXPORT_JOB_BATCH', default=200)  # консультаций за одну задачу
+EXPORT_JOB_STALE_SECONDS = env.int('EXPORT_JOB_STALE_SECONDS', default=600)  # без пачек дольше — цепочка умерла, можно resume
+EXPORT_DIR = env('EXPORT_DIR', default=os.path.join(BASE_DIR, 'exports'))
+
+# 20. Очередь транскрибации с делением между клиниками (api/transcription_queue.py)
+# Сколько записей одновременно отдаем в Django Q (обычно = числу воркеров)
+TRANSCRIPTION_MAX_RUNNING = env.int('TRANSCRIPTION_MAX_RUNNING', default=Q_CLUSTER['workers'])
+# Лимиты одной клиники по умолчанию (переопределяются в карточке организации).
+# 0 — без отдельного лимита: пока других нет, клиника может занять все слоты,
+# а освободившийся слот все равно достается клинике, у которой меньше задач в работе
+TRANSCRIPTION_ORG_MAX_RUNNING = env.int('TRANSCRIPTION_ORG_MAX_RUNNING', default=0)
+TRANSCRIPTION_ORG_QUEUE_LIMIT = env.int('TRANSCRIPTION_ORG_QUEUE_LIMIT', default=200)
+# Всего записей в очереди; больше — загрузка получает 429 и Retry-After
+TRANSCRIPTION_QUEUE_LIMIT = env.int('TRANSCRIPTION_QUEUE_LIMIT', default=Q_CLUSTER['queue_limit'])
+TRANSCRIPTION_RETRY_AFTER = env.int('TRANSCRIPTION_RETRY_AFTER', default=60)  # секунды
+# Записи до стольких секунд идут раньше длинных; длинная, прождавшая AGING, — наравне с короткими
+TRANSCRIPTION_SHORT_SECONDS = env.int('TRANSCRIPTION_SHORT_SECONDS', default=300)
+TRANSCRIPTION_AGING_SECONDS = env.int('TRANSCRIPTION_AGING_SECONDS', default=1800)
+# Аренда задачи воркером: дольше timeout Django Q, иначе живую задачу сочтут зависшей.
+# Пока идет распознавание, воркер продлевает ее каждую треть срока (transcription_queue.heartbeat)
+TRANSCRIPTION_LEASE_SECONDS = env.int('TRANSCRIPTION_LEASE_SECONDS', default=Q_CLUSTER['timeout'] + 60)
+TRANSCRIPTION_MAX_ATTEMPTS = env.int('TRANSCRIPTION_MAX_ATTEMPTS', default=3)
+
+# 21. Метрики конвейера (api/metrics.py, /api/metrics/ в формате Prometheus)
+METRICS_WINDOW_MINUTES = env.int('METRICS_WINDOW_MINUTES', default=60)  # окно для перцентилей эндпоинта
+METRICS_RETENTION_DAYS = env.int('METRICS_RETENTION_DAYS', default=30)
+# Пусто — эндпоинт открыт (закрывайте на уровне сети); иначе нужен Authorization: Bearer <токен>
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# 22. Загрузка записей по частям (api/uploads.py, /api/uploads/)
+UPLOAD_MAX_BYTES = env.int('UPLOAD_MAX_BYTES', default=1024 * 1024 * 1024)
+# Сколько байт нужно ffprobe, чтобы прочитать шапку (кодек, длительность)
+UPLOAD_PROBE_BYTES = env.int('UPLOAD_PROBE_BYTES', default=256 * 1024)
+UPLOAD_MIN_SECONDS = env.float('UPLOAD_MIN_SECONDS', default=1.0)
+# Аренда записи куска: запрос, зависший дольше (клиент молчит), уступает загрузку повтору
+UPLOAD_LOCK_SECONDS = env.int('UPLOAD_LOCK_SECONDS', default=60)
+# Пик громкости ниже порога (dBFS) — в записи тишина, в очередь ее не ставим
+UPLOAD_SILENCE_DB = env.float('UPLOAD_SILENCE_DB', default=-50.0)
+# Тишину проверяем не по всей записи (это минуты в запросе), а по отрезкам, разложенным по ней
+UPLOAD_SILENCE_SAMPLES = env.int('UPLOAD_SILENCE_SAMPLES', default=5)
+UPLOAD_SILENCE_SAMPLE_SECONDS = env.float('UPLOAD_SILENCE_SAMPLE_SECONDS', default=20.0)
+# Время на всю проверку тишины — с запасом меньше таймаута HTTP; не успели — запись не отклоняем
+UPLOAD_SILENCE_BUDGET_SECONDS = env.float('UPLOAD_SILENCE_BUDGET_SECONDS', default=10.0)
+# Брошенные незавершенные загрузки удаляет manage.py reap_transcriptions
+UPLOAD_EXPIRE_HOURS = env.int('UPLOAD_EXPIRE_HOURS', default=24)
+
+# 23. Нормализация записей (api/normalization.py): один раз в 16 кГц моно PCM (.npy) + архивная копия Opus
+AUDIO_NORMALIZE = env.bool('AUDIO_NORMALIZE', default=True)
+AUDIO_TARGET_DBFS = env.float('AUDIO_TARGET_DBFS', default=-20.0)  # громкость речи после выравнивания
+# Кадры тише порога (dBFS) считаются тишиной: по краям записи обрезаются. У тихой записи порог
+# опускается до AUDIO_TRIM_RANGE_DB ниже уровня ее речи (normalization.silence_threshold)
+AUDIO_TRIM_THRESHOLD_DB = env.float('AUDIO_TRIM_THRESHOLD_DB', default=-45.0)
+AUDIO_TRIM_RANGE_DB = env.float('AUDIO_TRIM_RANGE_DB', default=30.0)
+AUDIO_TRIM_PADDING = env.float('AUDIO_TRIM_PADDING', default=0.3)  # секунды запаса вокруг речи
+AUDIO_OPUS_BITRATE = env('AUDIO_OPUS_BITRATE', default='24k')
+# False — исходный файл заменяется Opus-копией (в media в разы меньше места)
+AUDIO_KEEP_ORIGINAL = env.bool('AUDIO_KEEP_ORIGINAL', default=True)
+# PCM (.npy) нужен только на время обработки: он в разы больше сжатой записи
+AUDIO_KEEP_PCM = env.bool('AUDIO_KEEP_PCM', default=False)
+
+# 24. Кэш лог-мел признаков для повторной транскрибации (api/feature_cache.py, manage.py retranscribe)
+FEATURE_CACHE_MAX_MB = env.int('FEATURE_CACHE_MAX_MB', default=4096)  # ~58 МБ на час записи
+
+# 25. Массовая переобработка старых приемов (api/reprocessing.py, manage.py reprocess)
+REPROCESS_BATCH_SIZE = env.int('REPROCESS_BATCH_SIZE', default=20)  # консультаций в одной задаче очереди
+REPROCESS_PARALLELISM = env.int('REPROCESS_PARALLELISM', default=2)  # пачек одновременно
+
+# 26. Исполнитель фоновых задач (api/ai_service.py): 'django_q' — кластер Django Q (manage.py qcluster),
+# 'local' — встроенный пул потоков в процессе сайта (без qcluster); без пакета django_q пул включается сам
+# Модель Whisper в процессе одна, и распознает она по одной записи за раз (whisper_models.inference):
+# при LOCAL_EXECUTOR_WORKERS > 1 параллельно идут декодирование, отчеты и PDF, а Whisper — по очереди
+TASK_EXECUTOR = env('TASK_EXECUTOR', default='django_q')
+LOCAL_EXECUTOR_WORKERS = env.int('LOCAL_EXECUTOR_WORKERS', default=1)  # одновременных задач
+LOCAL_EXECUTOR_QUEUE_LIMIT = env.int('LOCAL_EXECUTOR_QUEUE_LIMIT', default=20)  # больше — 429
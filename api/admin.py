@@ -1,12 +1,12 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import Organization, User, Patient, Consultation
+from .models import Organization, User, Patient, Consultation, ConsultationContent
 
 
 # 1. Настройка для Организаций (Клиник)
 @admin.register(Organization)
 class OrganizationAdmin(admin.ModelAdmin):
-    list_display = ('name', 'address')  # Что показывать в списке
+    list_display = ('name', 'address', 'max_running_transcriptions', 'queue_limit')  # Что показывать в списке
     search_fields = ('name',)  # Поиск по названию
 
 
@@ -36,16 +36,27 @@ class CustomUserAdmin(UserAdmin):
 class PatientAdmin(admin.ModelAdmin):
     list_display = ('last_name', 'first_name', 'middle_name', 'birth_date', 'organization')
     list_filter = ('organization',)  # Фильтр по клинике
-    search_fields = ('last_name', 'first_name', 'phone')  # Поиск по ФИО
+    search_fields = ('^last_name', '^first_name')  # Поиск по началу ФИО (использует индекс)
 
 
 # 4. Настройка для Консультаций (Приемов)
+class ConsultationContentInline(admin.StackedInline):
+    # Тексты лежат в отдельной таблице и грузятся только на странице приема, не в списке
+    model = ConsultationContent
+    can_delete = False
+
+    # Делаем поля ИИ только для чтения, чтобы админ случайно не сломал JSON
+    readonly_fields = ('raw_transcription', 'generated_report')
+
+
 @admin.register(Consultation)
 class ConsultationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'doctor', 'patient', 'status', 'created_at')
-    list_filter = ('status', 'doctor', 'created_at')
+    list_display = ('id', 'doctor', 'patient', 'status', 'is_urgent', 'created_at')
+    list_filter = ('status', 'is_urgent', 'doctor', 'created_at')
+    list_select_related = ('doctor', 'patient')
+    inlines = (ConsultationContentInline,)
 
-    # Делаем поля ИИ только для чтения, чтобы админ случайно не сломал JSON
-    readonly_fields = ('created_at', 'raw_transcription', 'generated_report')
+    readonly_fields = ('created_at',)
 
-    search_fields = ('patient__last_name', 'doctor__last_name')
\ No newline at end of file
+    # '^' — поиск по началу фамилии: такой LIKE использует индекс, '%...%' — нет
+    search_fields = ('^patient__last_name', '^doctor__last_name')
\ No newline at end of file
@@ -1,82 +1,207 @@
-import os
-import json
+"""
+Встроенный исполнитель фоновых задач — когда Django Q нет (пакет не установлен
+или кластер не запускают: TASK_EXECUTOR=local).
+
+Раньше без Django Q start_ai_task запускал отдельный поток на каждую консультацию,
+а заглушка async_task во views выполняла задачу прямо в запросе: клиент ждал всю
+транскрибацию, а пачка из 20 загрузок давала 20 одновременных распознаваний на веб-хосте.
+Теперь задачи идут через очередь длиной LOCAL_EXECUTOR_QUEUE_LIMIT в общий пул из
+LOCAL_EXECUTOR_WORKERS потоков. Модель одна на процесс (api/whisper_models.py), пул
+прогревает ее при старте; распознают ей потоки по очереди (whisper_models.inference). Очередь полна — ExecutorFull (QueueFull, клиенту 429).
+Глубина очереди видна в /api/consultations/queue/ и /api/metrics/.
+
+async_task() отсюда — единая точка постановки задач: Django Q, если он есть, иначе пул.
+"""
+import queue
 import threading
-import whisper  # Библиотека локального ИИ
-from .models import Consultation
 
-
-def run_ai_processing(consultation_id):
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from . import transcription_queue
+
+try:
+    from django_q.tasks import async_task as q_async_task
+except ImportError:
+    q_async_task = None
+
+
+# Поток пула или нет (см. LocalExecutor.submit)
+_thread = threading.local()
+
+
+class ExecutorFull(transcription_queue.QueueFull):
+    """Очередь встроенного пула переполнена: задачу не берем, клиент повторит позже."""
+
+
+def local_mode():
+    return q_async_task is None or settings.TASK_EXECUTOR == 'local'
+
+
+class LocalExecutor:
+    """
+    Пул потоков с ограниченной очередью. Потоки стартуют при первой задаче.
+    Лимит очереди — для новой работы извне: продолжения из потоков пула (следующая пачка
+    выгрузки, архив после отчета) принимаются всегда, иначе начатая работа оборвется.
+    on_idle — что сделать, когда поток освободился и очередь пуста (раздать слоты транскрибации).
+    """
+
+    def __init__(self, workers, queue_limit, on_idle=None):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.on_idle = on_idle
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'ai-executor-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        self._start()
+        with self._lock:
+            if self._queue.qsize() >= self.queue_limit and not getattr(_thread, 'in_pool', False):
+                self.rejected += 1
+                raise ExecutorFull(
+                    f"Очередь фоновых задач переполнена ({self.queue_limit}), повторите позже",
+                    settings.TRANSCRIPTION_RETRY_AFTER,
+                )
+            self._queue.put((func, args, kwargs))
+
+    def is_full(self):
+        return self._queue.qsize() >= self.queue_limit
+
+    def free_workers(self):
+        with self._lock:
+            return max(0, self.workers - self.busy - self._queue.qsize())
+
+    def _work(self):
+        _thread.in_pool = True
+        if settings.WHISPER_PRELOAD_MODELS:
+            # Реестр грузит модель под блокировкой: потоки пула получат один и тот же экземпляр
+            from . import backends
+            try:
+                backends.preload()
+            except Exception as e:
+                print(f"⚠️ [Executor] Не удалось прогреть модели: {e}")
+        while True:
+            func, args, kwargs = self._queue.get()
+            with self._lock:
+                self.busy += 1
+            ok = False
+            try:
+                func(*args, **kwargs)
+                ok = True
+            except Exception as e:
+                print(f"❌ [Executor] Задача {getattr(func, '__name__', func)} упала: {e}")
+            with self._lock:
+                self.busy -= 1
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            try:
+                if self.on_idle is not None and self._queue.empty():
+                    self.on_idle()
+            except Exception as e:
+                print(f"⚠️ [Executor] {e}")
+            finally:
+                # Соединения с базой у каждого потока свои — не держим их между задачами
+                connections.close_all()
+                self._queue.task_done()
+
+    def join(self):
+        """Дождаться, пока очередь опустеет (тесты, остановка процесса)."""
+        self._queue.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'queued': self._queue.qsize(),
+                'queue_limit': self.queue_limit,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+            }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = LocalExecutor(settings.LOCAL_EXECUTOR_WORKERS, settings.LOCAL_EXECUTOR_QUEUE_LIMIT,
+                                      on_idle=transcription_queue.dispatch)
+        return _executor
+
+
+def async_task(func, *args, **kwargs):
+    """Как django_q.tasks.async_task: путь к функции (или сама функция) и аргументы."""
+    if not local_mode():
+        return q_async_task(func, *args, **kwargs)
+    if isinstance(func, str):
+        func = import_string(func)
+    get_executor().submit(func, *args, **kwargs)
+    return None
+
+
+def check_capacity():
+    """Перед приемом новой работы: очередь встроенного пула полна — ExecutorFull."""
+    if local_mode() and get_executor().is_full():
+        raise ExecutorFull("Очередь фоновых задач переполнена, повторите позже", settings.TRANSCRIPTION_RETRY_AFTER)
+
+
+def free_slots():
+    """Сколько задач пул может начать сразу; None — задачи выполняет Django Q."""
+    return get_executor().free_workers() if local_mode() else None
+
+
+def stats():
+    """Режим исполнения и глубина очереди фоновых задач."""
+    if local_mode():
+        return dict(get_executor().stats(), mode='local')
     try:
-        # 1. Получаем запись
-        consultation = Consultation.objects.get(id=consultation_id)
-        print(f"🏥 [FREE AI] Начинаю обработку ID: {consultation_id}")
-
-        consultation.status = 'processing'
-        consultation.save()
-
-        file_path = consultation.audio_file.path
-
-        # --- ЭТАП 1: Локальная транскрибация (Whisper) ---
-        print("📥 Загружаю модель Whisper (это может занять время в первый раз)...")
-        # 'base' - это легкая модель, работает быстро на CPU.
-        # Есть еще 'tiny' (быстрее, но глупее) и 'small' (умнее, но медленнее)
-        model = whisper.load_model("base")
-
-        print("🎙️ Слушаю аудио и перевожу в текст...")
-        result = model.transcribe(file_path)
-        text = result["text"]
-
-        # Сохраняем сырой текст
-        consultation.raw_transcription = text
-        consultation.save()
-        print(f"✅ Текст получен: {text}")
-
-        # --- ЭТАП 2: Генерация отчета (Пока имитация) ---
-        print("🧠 Анализирую текст...")
-
-        # Простая логика для теста (пока без LLM)
-        # Мы ищем ключевые слова в тексте и подставляем диагноз
-        text_lower = text.lower()
-
-        diagnosis = "Не удалось определить (требуется осмотр)"
-        rec = "Консультация специалиста"
-
-        if "голов" in text_lower or "мигрень" in text_lower:
-            diagnosis = "Головная боль напряжения / Мигрень"
-            rec = "МРТ головного мозга, режим сна, Нурофен."
-        elif "кашел" in text_lower or "горл" in text_lower or "температур" in text_lower:
-            diagnosis = "ОРВИ / Острый бронхит"
-            rec = "Обильное питье, Лазолван, парацетамол при t > 38.5."
-        elif "живот" in text_lower or "болит" in text_lower:
-            diagnosis = "Гастрит? Синдром раздраженного кишечника"
-            rec = "Диета стол №1, Но-шпа, ФГДС."
-
-        # Формируем JSON вручную
-        ai_report = {
-            "complaints": text,  # В жалобы пишем то, что распознали
-            "anamnesis": "Со слов пациента, заболевание началось остро.",
-            "diagnosis": diagnosis,
-            "recommendations": rec
-        }
-
-        json_report = json.dumps(ai_report, ensure_ascii=False)
-
-        # Сохраняем
-        consultation.generated_report = json_report
-        consultation.final_report = json_report
-        consultation.status = 'ready'
-        consultation.save()
-
-        print(f"🎉 [DONE] Успешно завершено! ID: {consultation_id}")
-
-    except Exception as e:
-        print(f"❌ ОШИБКА: {e}")
-        consultation = Consultation.objects.get(id=consultation_id)
-        consultation.status = 'error'
-        consultation.save()
+        from django_q.brokers import get_broker
+        queued = get_broker().queue_size()
+    except Exception:
+        queued = None
+    return {'mode': 'django_q', 'queued': queued}
 
 
 def start_ai_task(consultation_id):
-    # Запускаем в фоне, чтобы сайт не вис
-    thread = threading.Thread(target=run_ai_processing, args=(consultation_id,))
-    thread.start()
\ No newline at end of file
+    """
+    Запуск транскрибации во встроенном пуле — тот же tasks.process_audio, что и в Django Q:
+    кэш транскрибаций, этапы, версии модели и правил у консультации одни и те же.
+    """
+    from .tasks import process_audio
+
+    # Аренду берем до постановки в пул: повторный вызов на тот же id вторую задачу не создаст
+    owner = transcription_queue.worker_id()
+    job = transcription_queue.acquire(consultation_id, owner)
+    if job is None:
+        print(f"⏭️ [FREE AI] ID {consultation_id} уже обрабатывается или готов")
+        return False
+
+    # В общий пул с ограниченной очередью, а не отдельный поток на каждую запись
+    try:
+        get_executor().submit(process_audio, consultation_id, owner, job)
+    except ExecutorFull:
+        transcription_queue.release(consultation_id, owner)
+        raise
+    return True
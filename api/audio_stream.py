@@ -0,0 +1,345 @@
+"""
+Потоковое декодирование аудио через ffmpeg.
+
+ffmpeg пишет PCM в stdout, мы читаем его кадрами фиксированного размера
+в один переиспользуемый буфер на 30 секунд и отдаём окна по одному.
+Пиковое потребление памяти не зависит от длины записи.
+"""
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import whisper
+from whisper.audio import N_SAMPLES, SAMPLE_RATE
+from whisper.decoding import DecodingOptions
+
+from . import whisper_models
+
+# Сколько сэмплов читаем из ffmpeg за раз (0.5 c)
+READ_FRAME_SAMPLES = SAMPLE_RATE // 2
+
+# Длительность одного кадра мел-спектрограммы / шага таймкодов Whisper
+SECONDS_PER_TIMESTAMP = 0.02
+
+# Умолчания model.transcribe(): расписание температур и пороги повтора окна
+TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+
+
+def _find_ffmpeg():
+    """Ищем ffmpeg в системе, а если нет — рядом с manage.py (ffmpeg.exe на Windows)."""
+    if shutil.which('ffmpeg'):
+        return True
+    if os.path.exists('ffmpeg.exe'):
+        os.environ["PATH"] += os.pathsep + os.getcwd()
+        return True
+    return False
+
+
+# Проверяем один раз при импорте модуля, а не в каждой задаче
+FFMPEG_AVAILABLE = _find_ffmpeg()
+if not FFMPEG_AVAILABLE:
+    print("❌ ОШИБКА: FFmpeg не найден! Положите ffmpeg.exe рядом с manage.py")
+
+
+class PcmStream:
+    """ffmpeg -> s16le моно 16 кГц через pipe. Используется как контекстный менеджер."""
+
+    def __init__(self, path, sample_rate=SAMPLE_RATE, start=0.0, strict=True):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.start = start
+        self.strict = strict  # False — ошибка ffmpeg (например, недописанный файл) не исключение
+        self.process = None
+
+    def __enter__(self):
+        seek = ['-ss', f'{self.start:.3f}'] if self.start else []
+        cmd = [
+            'ffmpeg', '-nostdin', '-threads', '0', *seek, '-i', self.path,
+            '-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(self.sample_rate),
+            '-loglevel', 'error', '-',
+        ]
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.process.stdout.close()
+        if exc_type is not None:
+            self.process.kill()
+        stderr = self.process.stderr.read().decode(errors='replace')
+        self.process.stderr.close()
+        returncode = self.process.wait()
+        if exc_type is None and returncode != 0 and self.strict:
+            raise RuntimeError(f"ffmpeg не смог декодировать {self.path}: {stderr.strip()}")
+
+    def readinto(self, out):
+        """Читает до len(out) сэмплов int16 в готовый массив. Возвращает число прочитанных."""
+        view = memoryview(out).cast('B')
+        total = 0
+        while total < len(view):
+            n = self.process.stdout.readinto(view[total:])
+            if not n:
+                break
+            total += n
+        return total // 2
+
+
+class WindowBuffer:
+    """
+    Буфер фиксированного размера под одно окно Whisper (30 c).
+    После обработки окна сдвигаем необработанный хвост в начало
+    и дочитываем недостающее из ffmpeg — новых массивов не создаём.
+    """
+
+    def __init__(self, size=N_SAMPLES):
+        self.samples = np.zeros(size, dtype=np.float32)
+        self._frame = np.zeros(READ_FRAME_SAMPLES, dtype=np.int16)
+        self.length = 0
+        self.eof = False
+
+    def fill(self, stream):
+        while self.length < len(self.samples) and not self.eof:
+            want = min(READ_FRAME_SAMPLES, len(self.samples) - self.length)
+            n = stream.readinto(self._frame[:want])
+            if n == 0:
+                self.eof = True
+                break
+            np.multiply(self._frame[:n], 1 / 32768.0, out=self.samples[self.length:self.length + n])
+            self.length += n
+        return self.length
+
+    def view(self):
+        return self.samples[:self.length]
+
+    def consume(self, n):
+        n = min(n, self.length)
+        rest = self.length - n
+        if rest:
+            self.samples[:rest] = self.samples[n:self.length]
+        self.length = rest
+
+
+def decode_from(path, start=0.0, strict=True):
+    """Декодирует запись с позиции start (секунды) до конца в один массив float32."""
+    parts = []
+    frame = np.zeros(READ_FRAME_SAMPLES, dtype=np.int16)
+    with PcmStream(path, start=start, strict=strict) as stream:
+        while True:
+            n = stream.readinto(frame)
+            if n == 0:
+                break
+            parts.append(frame[:n].astype(np.float32) / 32768.0)
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+
+
+def iter_windows(path):
+    """Окна по 30 c без перекрытия: (смещение в секундах, сэмплы). Массив переиспользуется!"""
+    buffer = WindowBuffer()
+    offset = 0
+    with PcmStream(path) as stream:
+        while buffer.fill(stream):
+            yield offset / SAMPLE_RATE, buffer.view()
+            offset += buffer.length
+            buffer.consume(buffer.length)
+
+
+def window_mel(samples, n_mels):
+    """
+    Лог-мел окна [n_mels, 3000]. Короткое (последнее) окно дополняем нулями в PCM,
+    до спектрограммы, как model.transcribe(): нули, дописанные в готовую спектрограмму, —
+    не тишина, и декодер "слышит" в хвосте окна то, чего в записи нет.
+    """
+    return whisper.log_mel_spectrogram(samples, n_mels, padding=N_SAMPLES - len(samples))
+
+
+def iter_mel_windows(path, n_mels=80):
+    """Лог-мел окна [n_mels, 3000] по одному — для декодера Whisper."""
+    for offset, samples in iter_windows(path):
+        yield offset, len(samples) / SAMPLE_RATE, window_mel(samples, n_mels)
+
+
+def decoding_options(model, options, language, prompt):
+    """
+    Переводим параметры model.transcribe() в DecodingOptions для одного окна —
+    список, по одному на температуру расписания (см. decode_with_fallback).
+    """
+    fields = DecodingOptions.__dataclass_fields__
+    kwargs = {k: v for k, v in options.items() if k in fields and k != 'temperature'}
+    if model.device.type == 'cpu':
+        kwargs['fp16'] = False  # как и model.transcribe(): на CPU fp16 не поддерживается
+    kwargs['language'] = language
+    kwargs['without_timestamps'] = False
+    if prompt and options.get('condition_on_previous_text', True):
+        kwargs['prompt'] = prompt
+
+    temperatures = options.get('temperature', TEMPERATURES)
+    if isinstance(temperatures, (int, float)):
+        temperatures = (temperatures,)
+    schedule = []
+    for temperature in temperatures:
+        attempt = dict(kwargs)
+        if temperature > 0:
+            # Сэмплирование: лучевой поиск не нужен
+            attempt.pop('beam_size', None)
+            attempt.pop('patience', None)
+        else:
+            attempt.pop('best_of', None)
+        schedule.append(DecodingOptions(**attempt, temperature=temperature))
+    return schedule
+
+
+def needs_fallback(result, options):
+    """
+    Как model.transcribe(): окно повторяем с температурой выше, если текст зациклился
+    (сильно сжимается) или модель в нем не уверена; неуверенность на тишине — не повод.
+    """
+    compression_ratio = options.get('compression_ratio_threshold', COMPRESSION_RATIO_THRESHOLD)
+    logprob = options.get('logprob_threshold', LOGPROB_THRESHOLD)
+    no_speech = options.get('no_speech_threshold', NO_SPEECH_THRESHOLD)
+
+    unsure = logprob is not None and result.avg_logprob < logprob
+    if unsure and no_speech is not None and result.no_speech_prob > no_speech:
+        return False
+    return unsure or (compression_ratio is not None and result.compression_ratio > compression_ratio)
+
+
+def decode_with_fallback(model, mel, schedule, options):
+    """
+    whisper.decode по расписанию температур, пока результат не пройдет needs_fallback.
+    mel — окно [n_mels, 3000] или батч окон: в батче повторяются только неудачные окна.
+    Вызывать под whisper_models.inference(model).
+    """
+    single = mel.ndim == 2
+    if single:
+        mel = mel[None]
+    results = [None] * len(mel)
+    pending = list(range(len(mel)))
+    for decoding in schedule:
+        for index, result in zip(pending, whisper.decode(model, mel[pending], decoding)):
+            results[index] = result
+        pending = [index for index in pending if needs_fallback(results[index], options)]
+        if not pending:
+            break
+    return results[0] if single else results
+
+
+def split_segments(tokens, tokenizer, window_seconds):
+    """
+    Разбираем токены с таймкодами <|t|> текст <|t|> на сегменты.
+    Возвращает (сегменты, конец последнего закрытого сегмента или None).
+    """
+    segments = []
+    start = None
+    text_tokens = []
+    last_closed = None
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            t = (token - tokenizer.timestamp_begin) * SECONDS_PER_TIMESTAMP
+            if start is not None and text_tokens:
+                segments.append((start, t, tokenizer.decode(text_tokens)))
+                text_tokens = []
+                last_closed = t
+                start = None
+            else:
+                start = t
+        elif token < tokenizer.eot:
+            text_tokens.append(token)
+    if text_tokens:
+        segments.append((start or 0.0, window_seconds, tokenizer.decode(text_tokens)))
+        last_closed = None
+    return segments, last_closed
+
+
+class PcmWindows:
+    """Окна для transcribe_windows из потока ffmpeg: лог-мел считается по каждому окну."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = WindowBuffer()
+
+    def next(self, n_mels):
+        """(мел-окно [n_mels, 3000], сэмплов в окне, дошли ли до конца записи) или None."""
+        if not self.buffer.fill(self.stream):
+            return None
+        return window_mel(self.buffer.view(), n_mels), self.buffer.length, self.buffer.eof
+
+    def advance(self, samples):
+        self.buffer.consume(samples)
+
+
+def transcribe_stream(model, path, options=None, on_progress=None):
+    """
+    Распознаёт файл окно за окном с постоянным потреблением памяти.
+    Возвращает словарь как у model.transcribe(): {'text', 'segments', 'language'}.
+    on_progress(None, новые сегменты, processed_seconds=...) вызывается после каждого окна
+    (общая длина записи заранее неизвестна).
+    """
+    with PcmStream(path) as stream:
+        return transcribe_windows(model, PcmWindows(stream), options, on_progress)
+
+
+def transcribe_windows(model, windows, options=None, on_progress=None):
+    """
+    Цикл декодирования по окнам 30 c. windows — источник мел-окон: PcmWindows (ffmpeg)
+    или FeatureWindows (готовые признаки, api/feature_cache.py).
+    Если последний сегмент окна закрыт таймкодом, следующее окно начинается с него
+    (как в model.transcribe), чтобы не резать слова на границе.
+    """
+    options = options or {}
+    language = options.get('language')
+    tokenizer = None
+    prompt = []
+    segments = []
+
+    offset = 0
+    while True:
+        window = windows.next(model.dims.n_mels)
+        if window is None:
+            break
+        mel, length, eof = window
+        window_seconds = length / SAMPLE_RATE
+        mel = mel.to(model.device)
+
+        with whisper_models.inference(model):
+            result = decode_with_fallback(model, mel, decoding_options(model, options, language, prompt), options)
+        if language is None:
+            language = result.language
+        if tokenizer is None:
+            tokenizer = whisper.tokenizer.get_tokenizer(
+                model.is_multilingual, num_languages=model.num_languages,
+                language=language, task=options.get('task', 'transcribe'),
+            )
+
+        window_segments, last_closed = split_segments(result.tokens, tokenizer, window_seconds)
+        first_new = len(segments)
+        for start, end, text in window_segments:
+            segments.append({
+                'id': len(segments),
+                'start': offset / SAMPLE_RATE + start,
+                'end': offset / SAMPLE_RATE + min(end, window_seconds),
+                'text': text,
+                'avg_logprob': result.avg_logprob,
+                'no_speech_prob': result.no_speech_prob,
+            })
+        prompt = [t for t in result.tokens if t < tokenizer.eot][-(model.dims.n_text_ctx // 2 - 1):]
+        if result.temperature > 0.5:
+            # Как model.transcribe(): текст, полученный сэмплированием, не тянем в подсказку
+            prompt = []
+
+        # Сдвигаемся на конец последнего сегмента, если окно было полным
+        consumed = length
+        if not eof and last_closed and int(last_closed * SAMPLE_RATE) > 0:
+            consumed = min(consumed, int(last_closed * SAMPLE_RATE))
+        windows.advance(consumed)
+        offset += consumed
+        if on_progress is not None:
+            on_progress(None, segments[first_new:], processed_seconds=round(offset / SAMPLE_RATE, 1))
+
+    return {
+        'text': ''.join(seg['text'] for seg in segments),
+        'segments': segments,
+        'language': language,
+    }
@@ -0,0 +1,102 @@
+"""
+Подключаемые движки транскрибации.
+
+Движок выбирается настройкой TRANSCRIPTION_BACKEND. Все движки возвращают
+один и тот же формат (как model.transcribe()): {'text', 'segments', 'language'},
+поэтому остальной конвейер (кэш, отчеты, сегменты) от выбора не зависит.
+"""
+from django.conf import settings
+
+from . import audio_stream, feature_cache, whisper_models
+
+SEGMENT_FIELDS = ('start', 'end', 'text', 'avg_logprob', 'no_speech_prob')
+
+
+class TranscriptionBackend:
+    """Базовый интерфейс движка."""
+
+    name = None
+    compute_type = None  # None = WHISPER_COMPUTE_TYPE из настроек
+
+    def __init__(self, model_name=None, device=None):
+        self.model_name = model_name or settings.WHISPER_MODEL
+        self.device = device or settings.WHISPER_DEVICE
+
+    @property
+    def label(self):
+        """Имя для ключа кэша транскрибаций: разные движки = разные результаты."""
+        return self.model_name
+
+    @property
+    def model(self):
+        """Тёплая модель Whisper из реестра процесса (нужна и для оконного декодирования)."""
+        return whisper_models.get_model(self.model_name, self.device, self.compute_type)
+
+    def transcribe(self, audio, **options):
+        raise NotImplementedError
+
+    def transcribe_features(self, features, **options):
+        """
+        Распознавание по готовым лог-мел признакам (api/feature_cache.py) оконным декодером,
+        как в потоковом режиме: без ffmpeg и STFT. Признаки — для self.model.dims.n_mels фильтров.
+        """
+        windows = feature_cache.FeatureWindows(features)
+        # Блокировку модели берет сам оконный декодер — на каждое окно
+        return self._normalize(audio_stream.transcribe_windows(self.model, windows, options))
+
+    @staticmethod
+    def _normalize(result):
+        return {
+            'text': result['text'],
+            'language': result.get('language'),
+            'segments': [
+                {k: seg[k] for k in SEGMENT_FIELDS if k in seg}
+                for seg in result['segments']
+            ],
+        }
+
+
+class WhisperBackend(TranscriptionBackend):
+    """openai-whisper как есть: fp32 PyTorch (или fp16 на GPU)."""
+
+    name = 'whisper'
+
+    def transcribe(self, audio, **options):
+        if self.device == 'cpu':
+            options.setdefault('fp16', False)
+        with whisper_models.inference(self.model) as model:
+            result = model.transcribe(audio, **options)
+        return self._normalize(result)
+
+
+class QuantizedWhisperBackend(WhisperBackend):
+    """Те же веса, но линейные слои квантованы в int8 (только CPU): быстрее и в ~2 раза меньше памяти."""
+
+    name = 'whisper-int8'
+    compute_type = 'int8'
+
+    @property
+    def label(self):
+        return f"{self.model_name}@int8"
+
+
+BACKENDS = {
+    WhisperBackend.name: WhisperBackend,
+    QuantizedWhisperBackend.name: QuantizedWhisperBackend,
+}
+
+
+def get_backend(model_name=None, name=None):
+    """Движок из настроек (или явно по имени)."""
+    name = name or settings.TRANSCRIPTION_BACKEND
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Неизвестный движок транскрибации: {name}. Доступны: {', '.join(BACKENDS)}")
+    return backend_class(model_name)
+
+
+def preload(names=None):
+    """Прогрев моделей выбранного движка при старте воркера."""
+    for name in names if names is not None else settings.WHISPER_PRELOAD_MODELS:
+        get_backend(name).model
@@ -0,0 +1,217 @@
+"""
+Пакетный планировщик транскрибации.
+
+Вместо "одна консультация = один вызов модели" собираем 30-секундные окна
+из нескольких записей в один батч и прогоняем энкодер/декодер Whisper разом.
+Размер батча и максимальное ожидание попутчиков настраиваются
+(WHISPER_BATCH_MAX_SIZE / WHISPER_BATCH_MAX_WAIT): задержка против пропускной способности.
+"""
+import time
+from collections import OrderedDict
+
+import torch
+import whisper
+from django.conf import settings
+
+from . import audio_stream, backends, progress, transcription_cache, transcription_queue, whisper_models
+from .models import Consultation
+from .tasks import ensure_audio_hash, save_transcription_and_report
+
+
+class _Recording:
+    """Одна запись в работе: генератор окон и уже распознанные окна по порядку."""
+
+    def __init__(self, path, n_mels):
+        self.windows = audio_stream.iter_mel_windows(path, n_mels)
+        self.results = {}
+        self.submitted = 0
+        self.exhausted = False
+        self.error = None
+
+    @property
+    def finished(self):
+        return self.exhausted and len(self.results) == self.submitted
+
+    def result(self):
+        segments = []
+        for index in range(self.submitted):
+            for seg in self.results[index]:
+                segments.append(dict(seg, id=len(segments)))
+        return {
+            'text': ''.join(seg['text'] for seg in segments),
+            'segments': segments,
+        }
+
+
+class BatchTranscriber:
+    """Склеивает окна нескольких записей в один батч декодера."""
+
+    def __init__(self, model, options=None, max_batch_size=8):
+        self.model = model
+        self.options = options or {}
+        self.max_batch_size = max_batch_size
+        self.decoding_options = audio_stream.decoding_options(
+            model, self.options, self.options.get('language'), prompt=None,
+        )
+        self.recordings = OrderedDict()
+        self._tokenizers = {}
+
+    def __len__(self):
+        return len(self.recordings)
+
+    def add(self, key, path):
+        self.recordings[key] = _Recording(path, self.model.dims.n_mels)
+
+    def has_unstarted(self):
+        return any(rec.submitted == 0 and not rec.exhausted for rec in self.recordings.values())
+
+    def _tokenizer(self, language):
+        if language not in self._tokenizers:
+            self._tokenizers[language] = whisper.tokenizer.get_tokenizer(
+                self.model.is_multilingual, num_languages=self.model.num_languages,
+                language=language, task=self.options.get('task', 'transcribe'),
+            )
+        return self._tokenizers[language]
+
+    def _collect(self):
+        """По кругу берём по одному окну от каждой записи, пока батч не заполнится."""
+        batch = []
+        while len(batch) < self.max_batch_size:
+            added = False
+            for key, rec in self.recordings.items():
+                if len(batch) >= self.max_batch_size:
+                    break
+                if rec.exhausted:
+                    continue
+                try:
+                    window = next(rec.windows, None)
+                except Exception as e:  # ffmpeg не смог прочитать файл
+                    rec.error = e
+                    rec.exhausted = True
+                    continue
+                if window is None:
+                    rec.exhausted = True
+                    continue
+                batch.append((key, rec.submitted, window))
+                rec.submitted += 1
+                added = True
+            if not added:
+                break
+        return batch
+
+    def step(self):
+        """
+        Один батч через модель.
+        Возвращает [(key, result, error)] по записям, которые закончились на этом шаге.
+        """
+        batch = self._collect()
+        if batch:
+            mel = torch.stack([mel for _key, _index, (_offset, _duration, mel) in batch]).to(self.model.device)
+            with whisper_models.inference(self.model):
+                decoded = audio_stream.decode_with_fallback(self.model, mel, self.decoding_options, self.options)
+
+            for (key, index, (offset, duration, _mel)), res in zip(batch, decoded):
+                tokenizer = self._tokenizer(res.language)
+                window_segments, _last_closed = audio_stream.split_segments(res.tokens, tokenizer, duration)
+                self.recordings[key].results[index] = [
+                    {
+                        'start': offset + start,
+                        'end': offset + min(end, duration),
+                        'text': text,
+                        'avg_logprob': res.avg_logprob,
+                        'no_speech_prob': res.no_speech_prob,
+                    }
+                    for start, end, text in window_segments
+                ]
+
+        finished = []
+        for key, rec in list(self.recordings.items()):
+            if rec.finished or rec.error is not None:
+                finished.append((key, None if rec.error else rec.result(), rec.error))
+                del self.recordings[key]
+        return finished
+
+
+def claim_consultations(limit, owner=''):
+    """
+    Забираем записи из очереди транскрибации (api/transcription_queue.py):
+    она сама решает, чья очередь — срочные, клиники по справедливости, короткие раньше длинных.
+    owner — аренда на планировщик: упадет он — reap() вернет записи в очередь.
+    """
+    ids = transcription_queue.claim(limit, owner)
+    Consultation.objects.filter(id__in=ids).update(status='processing')
+    for consultation_id in ids:
+        progress.status(consultation_id, 'processing', percent=0)
+    consultations = Consultation.objects.in_bulk(ids)
+    return [consultations[consultation_id] for consultation_id in ids if consultation_id in consultations]
+
+
+def _finish(consultation, result, error, options, model_label, owner=''):
+    if error is not None:
+        print(f"❌ [Batch] Ошибка в консультации {consultation.id}: {error}")
+        consultation.set_status('error')
+        progress.status(consultation.id, 'error')
+        transcription_queue.finish(consultation.id, ok=False, owner=owner)
+        return
+    transcription_cache.put(consultation.audio_hash, model_label, options, result)
+    save_transcription_and_report(consultation, result['text'], result['segments'])
+    transcription_queue.finish(consultation.id, owner=owner)
+    print(f"🎉 [Batch] Консультация {consultation.id} готова")
+
+
+def run(max_batch_size=None, max_wait=None, poll_interval=1.0, once=False):
+    """
+    Основной цикл планировщика. once=True — обработать то, что есть, и выйти.
+    """
+    max_batch_size = max_batch_size or settings.WHISPER_BATCH_MAX_SIZE
+    max_wait = settings.WHISPER_BATCH_MAX_WAIT if max_wait is None else max_wait
+    options = settings.WHISPER_DECODE_OPTIONS
+
+    backend = backends.get_backend()
+    transcriber = BatchTranscriber(backend.model, options, max_batch_size)
+    consultations = {}
+    waiting_since = None
+    owner = transcription_queue.worker_id()
+    renewed_at = time.monotonic()
+
+    print(f"🧺 [Batch] Планировщик запущен: батч до {max_batch_size}, ожидание до {max_wait} c")
+    while True:
+        # Продлеваем аренду своих записей и подбираем брошенные упавшими процессами
+        if time.monotonic() - renewed_at > settings.TRANSCRIPTION_LEASE_SECONDS / 3:
+            transcription_queue.renew(list(consultations), owner)
+            transcription_queue.reap()
+            renewed_at = time.monotonic()
+
+        free = max_batch_size - len(transcriber)
+        if free > 0:
+            for consultation in claim_consultations(free, owner):
+                ensure_audio_hash(consultation)
+                cached = transcription_cache.get(consultation.audio_hash, backend.label, options)
+                if cached is not None:
+                    _finish(consultation, cached, None, options, backend.label, owner)
+                    continue
+                transcriber.add(consultation.id, consultation.audio_file.path)
+                consultations[consultation.id] = consultation
+
+        if not len(transcriber):
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        # Новая запись ждёт попутчиков для неполного батча, но не дольше max_wait
+        if not once and len(transcriber) < max_batch_size and transcriber.has_unstarted():
+            waiting_since = waiting_since or time.monotonic()
+            if time.monotonic() - waiting_since < max_wait:
+                time.sleep(min(poll_interval, max_wait))
+                continue
+        waiting_since = None
+
+        for key, result, error in transcriber.step():
+            try:
+                _finish(consultations.pop(key), result, error, options, backend.label, owner)
+            except Exception as e:
+                print(f"❌ [Batch] Не удалось сохранить консультацию {key}: {e}")
+                Consultation.objects.filter(id=key).update(status='error')
+                progress.status(key, 'error')
+                transcription_queue.finish(key, ok=False, owner=owner)
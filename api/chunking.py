@@ -0,0 +1,248 @@
+"""
+Транскрибация длинных записей по кускам.
+
+Аудио декодируется через ffmpeg один раз, режется по паузам (энергетический VAD),
+куски распознаются параллельно в пуле процессов и склеиваются обратно по порядку.
+Результат каждого куска сохраняется на диск, поэтому повторный запуск задачи
+(таймаут Django Q, падение воркера) продолжает с места остановки.
+"""
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import whisper
+from django.conf import settings
+
+from . import metrics
+
+SAMPLE_RATE = whisper.audio.SAMPLE_RATE
+
+# Параметры детектора пауз
+FRAME_MS = 30
+MIN_SILENCE_MS = 400
+SILENCE_MARGIN_DB = 6.0
+
+
+def decode_audio(path):
+    """Один проход ffmpeg: файл -> float32 моно 16 кГц."""
+    with metrics.span('decode'):
+        return whisper.audio.load_audio(path, sr=SAMPLE_RATE)
+
+
+def as_float32(samples):
+    """
+    Участок записи -> float32 для Whisper. Нормализованный PCM (api/normalization.py)
+    приходит int16 через mmap: переводим только нужный участок, а не всю запись.
+    """
+    if samples.dtype == np.int16:
+        return samples.astype(np.float32) / 32768.0
+    return samples
+
+
+def find_silences(audio, sr=SAMPLE_RATE):
+    """
+    Ищем паузы по энергии кадров. Порог = уровень шума (20-й перцентиль) + запас,
+    но не выше, чем на 20 дБ ниже пика. Возвращает [(start_sample, end_sample), ...].
+    """
+    frame = int(sr * FRAME_MS / 1000)
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return []
+
+    # Блоками по минуте: int16 из mmap переводим во float по частям
+    block = 60 * 1000 // FRAME_MS
+    db = np.empty(n_frames)
+    for first in range(0, n_frames, block):
+        last = min(n_frames, first + block)
+        frames = as_float32(audio[first * frame:last * frame]).reshape(last - first, frame)
+        db[first:last] = 20 * np.log10(np.sqrt(np.mean(frames ** 2, axis=1)) + 1e-10)
+    threshold = min(np.percentile(db, 20) + SILENCE_MARGIN_DB, db.max() - 20)
+    silent = db < threshold
+
+    min_frames = max(1, MIN_SILENCE_MS // FRAME_MS)
+    silences = []
+    start = None
+    for i, is_silent in enumerate(np.append(silent, False)):
+        if is_silent and start is None:
+            start = i
+        elif not is_silent and start is not None:
+            if i - start >= min_frames:
+                silences.append((start * frame, i * frame))
+            start = None
+    return silences
+
+
+def plan_chunks(total_samples, silences, sr=SAMPLE_RATE):
+    """
+    Делим запись на куски ~WHISPER_CHUNK_SECONDS, разрезая посередине паузы.
+    Если подходящей паузы нет, режем жёстко по WHISPER_CHUNK_MAX_SECONDS.
+    """
+    target = int(settings.WHISPER_CHUNK_SECONDS * sr)
+    max_len = int(settings.WHISPER_CHUNK_MAX_SECONDS * sr)
+    min_len = target // 2
+
+    cuts = [0]
+    pos = 0
+    while total_samples - pos > max_len:
+        candidates = [
+            (start + end) // 2 for start, end in silences
+            if pos + min_len <= (start + end) // 2 <= pos + max_len
+        ]
+        if candidates:
+            cut = min(candidates, key=lambda c: abs(c - (pos + target)))
+        else:
+            cut = pos + max_len
+        cuts.append(cut)
+        pos = cut
+    cuts.append(total_samples)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+# --- Чекпоинты -------------------------------------------------------------
+
+def _checkpoint_dir(checkpoint_key):
+    return os.path.join(settings.MEDIA_ROOT, 'chunks', checkpoint_key)
+
+
+def _write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)  # атомарно: недописанный файл не примем за готовый
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# --- Воркеры пула ------------------------------------------------------------
+
+def _init_worker(model_name, threads):
+    """Инициализация процесса пула: снимаем привязку к одному ядру, поднимаем Django и греем модель."""
+    import django
+    import torch
+    from django.apps import apps
+
+    # forkserver/spawn: процесс новый, реестр моделей пуст (backends тянет api.models)
+    if not apps.ready:
+        django.setup()
+
+    # Воркер Django Q может быть привязан к одному CPU (cpu_affinity) — дети это наследуют
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, range(os.cpu_count()))
+    torch.set_num_threads(threads)
+    # Процесс чистый (forkserver/spawn): модель грузим один раз до первого куска
+    from . import backends
+    backends.get_backend(model_name).model
+
+
+def _transcribe_chunk(model_name, samples, options):
+    # Импорт здесь: дочерний процесс импортирует этот модуль до django.setup()
+    from . import backends
+    return backends.get_backend(model_name).transcribe(as_float32(samples), **options)
+
+
+def shift_segment(seg, offset, limit=None):
+    """Сдвиг таймкодов сегмента (и его слов, если есть) на начало куска; limit — не дальше конца куска."""
+    end = seg['end'] + offset
+    shifted = dict(seg, start=seg['start'] + offset, end=end if limit is None else min(end, limit))
+    if seg.get('words'):
+        shifted['words'] = [dict(w, start=w['start'] + offset, end=w['end'] + offset) for w in seg['words']]
+    return shifted
+
+
+def _stitch(chunks, results, sr=SAMPLE_RATE):
+    """Склеиваем куски: сдвигаем таймкоды сегментов на начало куска."""
+    segments = []
+    for (start, _end), result in zip(chunks, results):
+        offset = start / sr
+        for seg in result['segments']:
+            seg = shift_segment(seg, offset)
+            seg['id'] = len(segments)
+            segments.append(seg)
+    return {
+        'text': ' '.join(r['text'].strip() for r in results if r['text'].strip()),
+        'segments': segments,
+        'language': next((r['language'] for r in results if r.get('language')), None),
+    }
+
+
+def transcribe_file(audio_path, model_name, options, checkpoint_key, on_progress=None, audio=None):
+    """
+    Распознаёт файл, возвращает словарь как у model.transcribe():
+    {'text': ..., 'segments': [...], 'language': ...}.
+    on_progress(доля готового, новые сегменты) вызывается после каждого куска.
+    audio — уже декодированная запись (api/normalization.py), тогда файл не читаем.
+    """
+    if audio is None:
+        audio = decode_audio(audio_path)
+
+    ckpt_dir = _checkpoint_dir(checkpoint_key)
+    os.makedirs(ckpt_dir, exist_ok=True)
+
+    # План разбиения тоже сохраняем — при повторе куски должны совпасть
+    plan_path = os.path.join(ckpt_dir, 'plan.json')
+    chunks = _read_json(plan_path)
+    if chunks is None:
+        chunks = plan_chunks(len(audio), find_silences(audio))
+        _write_json(plan_path, chunks)
+    chunks = [tuple(chunk) for chunk in chunks]
+
+    chunk_paths = [os.path.join(ckpt_dir, f'chunk_{i:04d}.json') for i in range(len(chunks))]
+    results = [_read_json(path) for path in chunk_paths]
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    print(f"✂️ [Chunks] Кусков: {len(chunks)}, осталось распознать: {len(pending)}")
+
+    def chunk_done(i):
+        _write_json(chunk_paths[i], results[i])
+        if on_progress is not None:
+            offset = chunks[i][0] / SAMPLE_RATE
+            done = sum(result is not None for result in results)
+            on_progress(done / len(chunks), [
+                dict(seg, start=seg['start'] + offset, end=seg['end'] + offset)
+                for seg in results[i]['segments']
+            ])
+
+    workers = min(settings.WHISPER_CHUNK_WORKERS, len(pending))
+
+    if workers <= 1:
+        for i in pending:
+            start, end = chunks[i]
+            results[i] = _transcribe_chunk(model_name, audio[start:end], options)
+            chunk_done(i)
+    else:
+        # Не fork: воркер Django Q многопоточный (пул, аренда, heartbeat), и ребенок унаследовал бы
+        # чужие захваченные блокировки. forkserver/spawn стартуют чистым процессом
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(model_name, threads),
+        ) as pool:
+            futures = {
+                pool.submit(_transcribe_chunk, model_name, audio[chunks[i][0]:chunks[i][1]], options): i
+                for i in pending
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                chunk_done(i)
+                print(f"✅ [Chunks] Кусок {i + 1}/{len(chunks)} готов")
+
+    return _stitch(chunks, results)
+
+
+def clear_checkpoints(checkpoint_key):
+    """Удаляем чекпоинты после того, как результат сохранён в базу."""
+    shutil.rmtree(_checkpoint_dir(checkpoint_key), ignore_errors=True)
@@ -0,0 +1,138 @@
+"""
+SSE-поток хода обработки: GET /api/consultations/<id>/events/
+
+Клиент открывает одно соединение и получает смену статуса, проценты
+и распознанные сегменты по мере работы воркера — без опроса списка консультаций.
+Отдаётся напрямую из ClinSpeech/asgi.py (нужен ASGI-сервер, например uvicorn).
+Поддерживается заголовок Last-Event-ID: после переподключения придут только новые события.
+Консультация уже готова (или с ошибкой), и клиент все видел — 204: EventSource
+на этот ответ перестает переподключаться.
+"""
+import asyncio
+import json
+import re
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import Consultation, ConsultationEvent
+from .progress import TERMINAL_STATUSES
+
+EVENTS_PATH = re.compile(r'^/api/consultations/(?P<pk>\d+)/events/?$')
+
+# Комментарий-пинг, чтобы прокси не закрывали "молчащее" соединение
+HEARTBEAT_SECONDS = 15
+# Событий за один запрос к базе
+FETCH_LIMIT = 100
+
+
+@sync_to_async
+def _snapshot(pk):
+    consultation = Consultation.objects.filter(pk=pk).only('status').first()
+    if consultation is None:
+        return None
+    last_event_id = (
+        ConsultationEvent.objects.filter(consultation_id=pk)
+        .order_by('-id').values_list('id', flat=True).first()
+    )
+    return {'status': consultation.status, 'last_event_id': last_event_id or 0}
+
+
+@sync_to_async
+def _fetch(pk, after_id):
+    # Узкий запрос по индексу (consultation_id, id) — только новые строки
+    return list(
+        ConsultationEvent.objects.filter(consultation_id=pk, id__gt=after_id)
+        .order_by('id').values_list('id', 'kind', 'payload')[:FETCH_LIMIT]
+    )
+
+
+def _format(kind, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {kind}")
+    lines.append(f"data: {data}")
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+async def sse_application(scope, receive, send):
+    pk = int(EVENTS_PATH.match(scope['path'])['pk'])
+    headers = dict(scope.get('headers') or [])
+
+    snapshot = await _snapshot(pk)
+    if snapshot is None:
+        await send({'type': 'http.response.start', 'status': 404,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': b'{"error": "Consultation not found"}'})
+        return
+
+    last_id = headers.get(b'last-event-id', b'').decode()
+    resumed = last_id.isdigit()
+    terminal = snapshot['status'] in TERMINAL_STATUSES
+    if resumed and terminal and snapshot['last_event_id'] <= int(last_id):
+        await send({'type': 'http.response.start', 'status': 204,
+                    'headers': [(b'access-control-allow-origin', b'*')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),  # nginx не должен буферизовать поток
+            (b'access-control-allow-origin', b'*'),  # как CORS_ALLOW_ALL_ORIGINS для API
+        ],
+    })
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        if resumed:
+            last_id = int(last_id)
+        else:
+            # Новое подключение: текущий статус, дальше — только новые события
+            last_id = snapshot['last_event_id']
+            await send({
+                'type': 'http.response.body',
+                'body': _format('status', json.dumps({'status': snapshot['status']}), last_id),
+                'more_body': True,
+            })
+            if terminal:
+                return
+
+        idle = 0.0
+        while not disconnected.is_set():
+            finished = False
+            rows = await _fetch(pk, last_id)
+            for event_id, kind, payload in rows:
+                last_id = event_id
+                await send({'type': 'http.response.body', 'body': _format(kind, payload, event_id), 'more_body': True})
+                if kind == 'status' and json.loads(payload).get('status') in TERMINAL_STATUSES:
+                    finished = True
+                idle = 0.0
+            # Консультация завершилась до переподключения: досылаем пропущенное и закрываем
+            if finished or (terminal and len(rows) < FETCH_LIMIT):
+                return
+
+            try:
+                await asyncio.wait_for(disconnected.wait(), timeout=settings.PROGRESS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                idle += settings.PROGRESS_POLL_INTERVAL
+                if idle >= HEARTBEAT_SECONDS:
+                    idle = 0.0
+                    await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+    finally:
+        watcher.cancel()
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
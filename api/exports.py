@@ -0,0 +1,205 @@
+"""
+Массовая выгрузка PDF-заключений в ZIP.
+
+Отчеты рендерятся в пуле процессов (xhtml2pdf упирается в CPU, потоки тут не помогут),
+уже отрендеренные берутся из кэша api/pdf_reports.py. Данные для шаблона читает
+родительский процесс, дети только рендерят — в базу из пула никто не ходит.
+ZIP отдается потоком по мере готовности файлов: в памяти не больше нескольких PDF.
+Для больших периодов — фоновая задача ExportJob, которую можно продолжить после сбоя.
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+from django.utils.dateparse import parse_date
+
+from . import pdf_reports
+from .models import Consultation, ExportJob
+
+FILTER_FIELDS = ('patient', 'doctor', 'organization', 'date_from', 'date_to')
+
+# Кусок, которым PDF переливается в ZIP
+COPY_CHUNK = 64 * 1024
+
+
+def clean_filters(params):
+    """Фильтры из запроса -> словарь для JSON. Ошибка формата -> ValueError."""
+    filters = {}
+    for field in FILTER_FIELDS:
+        value = params.get(field)
+        if value in (None, ''):
+            continue
+        if field.startswith('date_'):
+            if parse_date(str(value)) is None:
+                raise ValueError(f"{field}: ожидается дата в формате ГГГГ-ММ-ДД")
+            filters[field] = str(value)
+        else:
+            filters[field] = int(value)
+    return filters
+
+
+def filter_consultations(filters):
+    qs = Consultation.objects.select_related('doctor', 'patient', 'content').order_by('id')
+    if 'patient' in filters:
+        qs = qs.filter(patient_id=filters['patient'])
+    if 'doctor' in filters:
+        qs = qs.filter(doctor_id=filters['doctor'])
+    if 'organization' in filters:
+        qs = qs.filter(patient__organization_id=filters['organization'])
+    if 'date_from' in filters:
+        qs = qs.filter(created_at__date__gte=parse_date(filters['date_from']))
+    if 'date_to' in filters:
+        qs = qs.filter(created_at__date__lte=parse_date(filters['date_to']))
+    return qs
+
+
+def archive_name(consultation):
+    return f"{consultation.created_at:%Y-%m-%d}_{consultation.patient.last_name}_{consultation.id}.pdf"
+
+
+def _init_worker():
+    # При spawn (Windows) Django в дочернем процессе еще не настроен
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def _render(consultation_id, context, etag):
+    return pdf_reports.store(consultation_id, context, etag)
+
+
+def iter_reports(consultations, workers=None):
+    """
+    (консультация, путь к PDF) по мере готовности — порядок не гарантируется.
+    В работе одновременно не больше 2 * workers отчетов.
+    """
+    workers = workers or settings.EXPORT_WORKERS
+    pool = None
+    pending = {}
+    try:
+        for consultation in consultations.iterator(chunk_size=200):
+            context = pdf_reports.build_context(consultation)
+            etag = pdf_reports.content_hash(context)
+            path = pdf_reports.cached_path(consultation.id, etag)
+            if path is not None:
+                yield consultation, path
+                continue
+
+            if pool is None:
+                methods = multiprocessing.get_all_start_methods()
+                pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('fork' if 'fork' in methods else 'spawn'),
+                    initializer=_init_worker,
+                )
+            pending[pool.submit(_render, consultation.id, context, etag)] = consultation
+
+            while len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+class _StreamSink:
+    """Файлоподобный буфер для zipfile: всё записанное забирается кусками через drain()."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def _add_file(archive, name, path):
+    # PDF уже сжат, повторно не жмем
+    with open(path, 'rb') as src, archive.open(zipfile.ZipInfo(name), 'w') as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK)
+
+
+def stream_zip(consultations, workers=None):
+    """Генератор байтов ZIP для StreamingHttpResponse."""
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for consultation, path in iter_reports(consultations, workers):
+            _add_file(archive, archive_name(consultation), path)
+            yield sink.drain()
+    yield sink.drain()
+
+
+# --- Фоновые выгрузки ---
+
+def job_dir(job):
+    return os.path.join(settings.EXPORT_DIR, f"job_{job.id}")
+
+
+def run_job_batch(job):
+    """
+    Одна пачка фоновой выгрузки. PDF складываются в папку задачи,
+    last_id сохраняется только после всей пачки — при сбое пачка просто повторится.
+    Возвращает True, если выгрузка закончена.
+    """
+    filters = json.loads(job.filters or '{}')
+    if job.status == 'queued':
+        job.total = filter_consultations(filters).count()
+        job.status = 'running'
+        job.save()
+
+    directory = job_dir(job)
+    os.makedirs(directory, exist_ok=True)
+    batch = filter_consultations(filters).filter(id__gt=job.last_id)[:settings.EXPORT_JOB_BATCH]
+    batch_ids = list(batch.values_list('id', flat=True))
+    if not batch_ids:
+        job.archive = build_archive(job)
+        job.status = 'ready'
+        job.save()
+        return True
+
+    for consultation, path in iter_reports(Consultation.objects.select_related('doctor', 'patient', 'content')
+                                           .filter(id__in=batch_ids)):
+        shutil.copyfile(path, os.path.join(directory, archive_name(consultation)))
+
+    job.last_id = batch_ids[-1]
+    job.done = len([name for name in os.listdir(directory) if name.endswith('.pdf')])
+    job.save()
+    return False
+
+
+def build_archive(job):
+    directory = job_dir(job)
+    archive_path = f"{directory}.zip"
+    tmp_path = f"{archive_path}.part"
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name in sorted(os.listdir(directory)):
+            _add_file(archive, name, os.path.join(directory, name))
+    os.replace(tmp_path, archive_path)
+    shutil.rmtree(directory, ignore_errors=True)
+    return archive_path
+
+
+def create_job(filters, user=None):
+    return ExportJob.objects.create(
+        filters=json.dumps(filters, ensure_ascii=False),
+        requested_by=user if user is not None and user.is_authenticated else None,
+    )
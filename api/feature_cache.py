@@ -0,0 +1,169 @@
+"""
+Кэш лог-мел признаков по хэшу аудио.
+
+Повторная транскрибация (другая модель, другие параметры декодирования, новые правила)
+раньше каждый раз декодировала запись и заново считала спектрограмму. Здесь признаки
+считаются один раз на запись и лежат в MEDIA_ROOT/features/<хэш>-<n_mels>.npy
+(float16, [n_mels, кадры по 10 мс]). Читатели открывают файл через mmap и берут окна
+срезами, без копирования всего массива; подходит любой движок и размер модели
+с тем же числом мел-фильтров (80 у всех, кроме large-v3 со 128).
+
+Хранится "сырой" log10 мел-спектр, до нормализации Whisper (обрезка на 8 дБ ниже
+максимума и масштаб): ее делаем по окну при чтении — ровно как log_mel_spectrogram()
+для окна потокового режима (api/audio_stream.py).
+Размер кэша ограничен FEATURE_CACHE_MAX_MB: удаляются давно не читанные файлы.
+"""
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import whisper
+from django.conf import settings
+from whisper.audio import HOP_LENGTH, N_FFT, N_FRAMES, SAMPLE_RATE, mel_filters
+
+from . import chunking, metrics, normalization
+
+FEATURES_DIR = 'features'
+# Спектрограмма считается блоками: память не растет с длиной записи
+BLOCK_FRAMES = N_FRAMES
+# log10 мел-спектра нулевого PCM (clamp 1e-10 в log_mel_spectrogram)
+SILENCE_LOG_MEL = -10.0
+
+
+def _base(audio_hash, n_mels):
+    return os.path.join(settings.MEDIA_ROOT, FEATURES_DIR, f'{audio_hash}-{n_mels}')
+
+
+def raw_log_mel(audio, n_mels, out):
+    """
+    log10 мел-спектр как в whisper.log_mel_spectrogram(), но без нормализации,
+    блоками по BLOCK_FRAMES кадров прямо в out ([n_mels, len(audio) // HOP_LENGTH]).
+    """
+    filters = mel_filters('cpu', n_mels)
+    window = torch.hann_window(N_FFT)
+    half = N_FFT // 2
+    n_frames = out.shape[1]
+    for first in range(0, n_frames, BLOCK_FRAMES):
+        last = min(n_frames, first + BLOCK_FRAMES)
+        # Кадр t центрирован на сэмпле t * HOP_LENGTH; по краям записи — отражение, как center=True в torch.stft
+        lo, hi = first * HOP_LENGTH - half, (last - 1) * HOP_LENGTH + half
+        piece = torch.from_numpy(np.ascontiguousarray(chunking.as_float32(audio[max(lo, 0):min(hi, len(audio))])))
+        left, right = max(0, -lo), max(0, hi - len(audio))
+        if left or right:
+            piece = F.pad(piece[None, None], (left, right), mode='reflect')[0, 0]
+        stft = torch.stft(piece, N_FFT, HOP_LENGTH, window=window, center=False, return_complex=True)
+        mel = filters @ stft.abs() ** 2
+        out[:, first:last] = torch.clamp(mel, min=1e-10).log10().numpy()
+
+
+def normalize_window(raw):
+    """
+    Нормализация Whisper для окна сырых признаков -> тензор [n_mels, 3000].
+    Короткое окно дополняем кадрами тишины (log10 от нулевого PCM) до нормализации —
+    как audio_stream.window_mel, а не нулями в готовой спектрограмме.
+    """
+    log_spec = torch.from_numpy(np.asarray(raw, dtype=np.float32))
+    log_spec = F.pad(log_spec, (0, max(0, N_FRAMES - log_spec.shape[1])), value=SILENCE_LOG_MEL)
+    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+    return whisper.pad_or_trim((log_spec + 4.0) / 4.0, N_FRAMES)
+
+
+def read_meta(audio_hash, n_mels):
+    try:
+        with open(_base(audio_hash, n_mels) + '.json', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if os.path.exists(_base(audio_hash, n_mels) + '.npy') else None
+
+
+def compute(consultation, n_mels):
+    """
+    Считает и сохраняет признаки записи. Аудио берется как у основного конвейера
+    (нормализованный PCM или ffmpeg), offset — обрезка тишины в начале.
+    """
+    with metrics.span('features'):
+        audio, offset = normalization.decoded_audio(consultation)
+        base = _base(consultation.audio_hash, n_mels)
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        n_frames = len(audio) // HOP_LENGTH if len(audio) >= N_FFT else 0
+        # open_memmap: массив сразу в файле, в памяти только текущий блок спектрограммы
+        out = np.lib.format.open_memmap(base + '.npy.tmp', mode='w+', dtype=np.float16, shape=(n_mels, n_frames))
+        raw_log_mel(audio, n_mels, out)
+        out.flush()
+        del out
+        os.replace(base + '.npy.tmp', base + '.npy')
+        meta = {'offset': offset, 'frames': n_frames, 'n_mels': n_mels}
+        with open(base + '.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(base + '.json.tmp', base + '.json')
+    print(f"📈 [Features] Консультация {consultation.id}: признаки {n_mels}x{n_frames} сохранены")
+    evict()
+    return meta
+
+
+def load(consultation, n_mels):
+    """
+    (признаки через mmap [n_mels, кадры], смещение обрезки в секундах).
+    Нет в кэше — считаем. Чтение обновляет mtime: по нему вытесняются давно не нужные.
+    """
+    meta = read_meta(consultation.audio_hash, n_mels)
+    if meta is None:
+        metrics.count('feature_cache_misses')
+        meta = compute(consultation, n_mels)
+    else:
+        metrics.count('feature_cache_hits')
+    path = _base(consultation.audio_hash, n_mels) + '.npy'
+    os.utime(path)
+    return np.load(path, mmap_mode='r'), meta['offset']
+
+
+def seconds(features):
+    """Длительность записи по числу кадров признаков."""
+    return features.shape[1] * HOP_LENGTH / SAMPLE_RATE
+
+
+class FeatureWindows:
+    """Окна для audio_stream.transcribe_windows из готовых признаков: срез mmap, без ffmpeg и STFT."""
+
+    def __init__(self, features):
+        self.features = features
+        self.position = 0  # кадр
+
+    def next(self, n_mels):
+        if n_mels != self.features.shape[0]:
+            raise ValueError(f"Признаки посчитаны для {self.features.shape[0]} мел-фильтров, модели нужно {n_mels}")
+        raw = self.features[:, self.position:self.position + N_FRAMES]
+        if raw.shape[1] == 0:
+            return None
+        eof = self.position + N_FRAMES >= self.features.shape[1]
+        return normalize_window(raw), raw.shape[1] * HOP_LENGTH, eof
+
+    def advance(self, samples):
+        self.position += samples // HOP_LENGTH
+
+
+def evict():
+    """Удаляет давно не читанные признаки, пока кэш больше FEATURE_CACHE_MAX_MB. Возвращает число удаленных."""
+    directory = os.path.join(settings.MEDIA_ROOT, FEATURES_DIR)
+    try:
+        entries = [entry for entry in os.scandir(directory) if entry.name.endswith('.npy')]
+    except FileNotFoundError:
+        return 0
+    files = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries))
+    total = sum(size for _mtime, size, _path in files)
+    limit = settings.FEATURE_CACHE_MAX_MB * 1024 * 1024
+    removed = 0
+    for _mtime, size, path in files:
+        if total <= limit:
+            break
+        for file_path in (path, path[:-len('.npy')] + '.json'):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        total -= size
+        removed += 1
+    return removed
@@ -0,0 +1,176 @@
+"""
+Живая транскрибация во время приема.
+
+Браузер (MediaRecorder) присылает куски webm/ogg, они дописываются в файл
+консультации. После каждого куска (не чаще, чем успевает воркер) распознаём
+"скользящее окно" — аудио от последней подтвержденной точки до конца.
+Сегмент подтверждается, когда два прохода подряд дали для него один и тот же
+текст и он не попадает в последние секунды окна (там слова еще могут измениться).
+Подтвержденный текст сразу дописывается в ConsultationContent.raw_transcription.
+
+Шаг берет аренду сессии коротким условным UPDATE (tick_owner/tick_until) и распознает
+вне транзакции: куски и /finish/ не ждут Whisper. Результат записывается, только если
+аренда еще наша и граница подтвержденного не сдвинулась (committed_seconds).
+"""
+import json
+import os
+import re
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import audio_stream, backends, progress, segment_store
+from .chunking import shift_segment
+from .models import LiveSession
+
+# Как часто финальный шаг проверяет, не закончился ли идущий шаг
+TICK_WAIT_INTERVAL = 0.5
+
+
+class OffsetMismatch(Exception):
+    """Клиент прислал кусок не с того места (повтор или пропуск)."""
+
+    def __init__(self, size):
+        super().__init__(f"Ожидался кусок со смещения {size}")
+        self.size = size
+
+
+def start_session(consultation):
+    return LiveSession.objects.create(consultation=consultation)
+
+
+def append_chunk(consultation, data, offset):
+    """
+    Дописывает кусок в файл записи. offset = сколько байт клиент уже отправил.
+    Проверка и запись — под блокировкой строки сессии: два запроса с одним offset
+    не допишут кусок дважды (второй получит OffsetMismatch).
+    """
+    path = consultation.audio_file.path
+    with transaction.atomic():
+        LiveSession.objects.select_for_update().only('id').get(consultation_id=consultation.id)
+        size = os.path.getsize(path)
+        if offset != size:
+            raise OffsetMismatch(size)
+        with open(path, 'ab') as f:
+            f.write(data)
+    return size + len(data)
+
+
+def claim_tick(consultation_id):
+    """True, если шаг распознавания нужно поставить в очередь (еще не стоит)."""
+    return LiveSession.objects.filter(
+        consultation_id=consultation_id, tick_pending=False, finished=False,
+    ).update(tick_pending=True) == 1
+
+
+def release_tick(consultation_id):
+    """Шаг так и не поставили в очередь — следующий кусок попробует снова."""
+    LiveSession.objects.filter(consultation_id=consultation_id).update(tick_pending=False)
+
+
+def _normalize(text):
+    return re.sub(r'\W+', ' ', text.lower()).strip()
+
+
+def _agreed_prefix(previous, current, stable_until):
+    """Сколько первых сегментов совпало с прошлой гипотезой и уже не у края окна."""
+    count = 0
+    for old, new in zip(previous, current):
+        if _normalize(old['text']) != _normalize(new['text']) or new['end'] > stable_until:
+            break
+        count += 1
+    return count
+
+
+def _claim(consultation_id, owner):
+    """Аренда шага: свободна или истекла (воркер умер посреди распознавания) — берем."""
+    now = timezone.now()
+    return LiveSession.objects.filter(consultation_id=consultation_id).filter(
+        Q(tick_until__isnull=True) | Q(tick_until__lt=now),
+    ).update(tick_owner=owner, tick_until=now + timedelta(seconds=settings.TRANSCRIPTION_LEASE_SECONDS)) == 1
+
+
+def _release(consultation_id, owner):
+    LiveSession.objects.filter(consultation_id=consultation_id, tick_owner=owner).update(
+        tick_owner='', tick_until=None,
+    )
+
+
+def tick(consultation_id, final=False):
+    """
+    Один шаг: распознаём неподтвержденный хвост и подтверждаем стабильные сегменты.
+    final=True (конец приема) — подтверждаем всё, что осталось.
+    """
+    # Снимаем флаг до работы: кусок, пришедший во время распознавания, поставит новый шаг
+    LiveSession.objects.filter(consultation_id=consultation_id).update(tick_pending=False)
+
+    owner = uuid.uuid4().hex
+    if not _claim(consultation_id, owner):
+        if not final:
+            # Идет другой шаг: накопленное заберет он или шаг следующего куска
+            return
+        # Финал ждет, пока закончится идущий шаг, — хвост должен распознаться после него
+        deadline = time.monotonic() + settings.TRANSCRIPTION_LEASE_SECONDS
+        while not _claim(consultation_id, owner):
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Шаг живой записи {consultation_id} не освободился")
+            time.sleep(TICK_WAIT_INTERVAL)
+
+    try:
+        _tick(consultation_id, owner, final)
+    finally:
+        _release(consultation_id, owner)
+
+
+def _tick(consultation_id, owner, final):
+    session = LiveSession.objects.select_related('consultation').get(consultation_id=consultation_id)
+    consultation = session.consultation
+    base = session.committed_seconds
+
+    # Последний кусок может быть недописан — ошибки ffmpeg в конце файла не критичны
+    audio = audio_stream.decode_from(consultation.audio_file.path, base, strict=False)
+    window = len(audio) / audio_stream.SAMPLE_RATE
+    if not final and window < settings.LIVE_MIN_WINDOW_SECONDS:
+        return
+
+    current = []
+    if len(audio):
+        result = backends.get_backend().transcribe(audio, **settings.WHISPER_DECODE_OPTIONS)
+        current = [shift_segment(seg, base) for seg in result['segments']]
+
+    if final:
+        commit_count = len(current)
+    else:
+        previous = json.loads(session.hypothesis or '[]')
+        commit_count = _agreed_prefix(previous, current, base + window - settings.LIVE_HOLDBACK_SECONDS)
+        # Окно разрослось (человек говорит без пауз) — подтверждаем всё, кроме последнего сегмента
+        if window > settings.LIVE_MAX_WINDOW_SECONDS:
+            commit_count = max(commit_count, len(current) - 1)
+
+    committed = current[:commit_count]
+    with transaction.atomic():
+        # Оптимистичная проверка: аренду не забрали и границу никто не сдвинул, пока шло распознавание
+        updated = LiveSession.objects.filter(
+            id=session.id, tick_owner=owner, committed_seconds=base,
+        ).update(
+            committed_seconds=committed[-1]['end'] if committed else base,
+            hypothesis=json.dumps(current[commit_count:], ensure_ascii=False),
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            print(f"⚠️ [Live] Консультация {consultation.id}: сессию обновил другой шаг, результат отброшен")
+            return
+        if committed:
+            content = consultation.get_content()
+            content.raw_transcription += ''.join(seg['text'] for seg in committed)
+            content.save(update_fields=['raw_transcription'])
+            segment_store.append(consultation, committed)
+
+    if committed:
+        progress.segments(consultation.id, committed)
+        print(f"🎙️ [Live] Консультация {consultation.id}: подтверждено до {committed[-1]['end']:.1f} c")
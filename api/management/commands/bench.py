@@ -0,0 +1,289 @@
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from api import metrics, pdf_reports, tasks, transcription_cache, transcription_queue
+from api.models import Consultation, Organization, Patient, PipelineRun, TranscriptionCache, User
+
+MEMORY_DATABASE = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+
+# Что сравниваем с прошлым прогоном (--compare); для запросов регрессия — любой рост
+COMPARED = ('wall_seconds', 'rtf', 'pdf_seconds', 'queries_total')
+
+
+def use_database(config):
+    """Подменяем базу default до первого запроса и создаем в ней таблицы."""
+    connections.close_all()
+    connections.settings['default'] = connections.configure_settings({'default': dict(config)})['default']
+    try:
+        del connections['default']
+    except AttributeError:
+        pass
+    call_command('migrate', verbosity=0, interactive=False)
+
+
+def use_memory_database():
+    """
+    SQLite в памяти: бенчмарк не трогает рабочую MySQL, а прогоны не зависят от ее нагрузки и сети.
+    """
+    use_database(MEMORY_DATABASE)
+
+
+def parse_config(value):
+    """'int8:TRANSCRIPTION_BACKEND=whisper-int8,WHISPER_MODEL=base' -> ('int8', {...}). Значения — JSON или строка."""
+    name, _, assignments = value.partition(':')
+    overrides = {}
+    for assignment in filter(None, assignments.split(',')):
+        key, sep, raw = assignment.partition('=')
+        if not sep:
+            raise CommandError(f"Ожидается KEY=VALUE: {assignment}")
+        try:
+            overrides[key.strip()] = json.loads(raw)
+        except json.JSONDecodeError:
+            overrides[key.strip()] = raw
+    return name, overrides
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+class Command(BaseCommand):
+    help = (
+        "Сквозной бенчмарк: полный process_audio и PDF на записях из media/consultations/audio "
+        "в SQLite в памяти. Время этапов, RTF, пик памяти, SQL-запросы по этапам; результаты — в JSON "
+        "для сравнения с прошлым прогоном (--compare)."
+    )
+    # Проверки системы могут полезть в рабочую базу — она бенчмарку не нужна
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*',
+                            help="Аудиофайлы (по умолчанию всё из MEDIA_ROOT/consultations/audio)")
+        parser.add_argument('--config', action='append', default=[], metavar='NAME:KEY=VALUE,...',
+                            help="Конфигурация: переопределение настроек, можно несколько раз. "
+                                 "Например: base:WHISPER_MODEL=base  int8:TRANSCRIPTION_BACKEND=whisper-int8")
+        parser.add_argument('--repeat', type=int, default=1, help="Прогонов каждой записи (берется медиана)")
+        parser.add_argument('--limit', type=int, help="Взять только первые N записей")
+        parser.add_argument('--output', help="Куда записать JSON (по умолчанию bench/bench-<дата>.json)")
+        parser.add_argument('--compare', help="JSON прошлого прогона: показать разницу и упасть при регрессии")
+        parser.add_argument('--tolerance', type=float, default=0.15,
+                            help="Допустимый рост времени/RTF относительно --compare (0.15 = 15%%)")
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        files = self.collect_files(options['files'], options['limit'])
+        configs = [parse_config(value) for value in options['config']] or [('default', {})]
+
+        use_memory_database()
+        organization = Organization.objects.create(name="Bench")
+        doctor = User.objects.create(username='bench_doctor', first_name="Врач", last_name="Тестовый",
+                                     organization=organization)
+        patient = Patient.objects.create(first_name="Пациент", last_name="Тестовый", birth_date='1980-01-01',
+                                         organization=organization)
+
+        results = []
+        with tempfile.TemporaryDirectory() as pdf_dir:
+            for name, overrides in configs:
+                self.stdout.write(f"\n=== {name} {overrides or ''} ===")
+                # Задачи Django Q (prerender PDF) только ставятся в таблицу очереди: PDF меряем сами
+                with override_settings(PDF_CACHE_DIR=pdf_dir, WHISPER_BATCH_SCHEDULER=False, **overrides):
+                    for path, audio_hash in files:
+                        for repeat in range(options['repeat']):
+                            row = self.run_one(name, path, audio_hash, doctor, patient)
+                            row['repeat'] = repeat
+                            results.append(row)
+                            self.stdout.write(
+                                f"  {os.path.basename(path)[:40]:<40} {row['wall_seconds']:>7.1f} c  "
+                                f"RTF {row['rtf'] if row['rtf'] is not None else '-'}  "
+                                f"SQL {row['queries_total']}  PDF {row['pdf_seconds']:.2f} c"
+                            )
+
+        report = {
+            'meta': {
+                'created_at': timezone.now().isoformat(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'configs': {name: overrides for name, overrides in configs},
+                'files': [{'name': os.path.basename(path), 'sha256': audio_hash} for path, audio_hash in files],
+            },
+            'results': results,
+            'summary': self.summarize(results),
+        }
+        self.print_summary(report['summary'])
+
+        output = options['output'] or os.path.join(
+            settings.BASE_DIR, 'bench', f"bench-{timezone.now():%Y%m%d-%H%M%S}.json",
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(f"\nРезультаты: {output}")
+
+        if options['compare']:
+            self.compare(options['compare'], report, options['tolerance'])
+
+    def collect_files(self, files, limit):
+        """Одинаковые по содержимому файлы (копии с суффиксом) меряем один раз."""
+        files = files or sorted(glob.glob(os.path.join(settings.MEDIA_ROOT, 'consultations', 'audio', '*')))
+        unique = {}
+        for path in files:
+            with open(path, 'rb') as f:
+                unique.setdefault(transcription_cache.hash_file(f), os.path.abspath(path))
+        collected = sorted(((path, audio_hash) for audio_hash, path in unique.items()), key=lambda item: item[0])
+        if limit:
+            collected = collected[:limit]
+        if not collected:
+            raise CommandError("Нет файлов для бенчмарка")
+        media_root = os.path.abspath(settings.MEDIA_ROOT)
+        for path, _hash in collected:
+            if os.path.commonpath([path, media_root]) != media_root:
+                raise CommandError(f"Файл должен лежать в MEDIA_ROOT: {path}")
+        return collected
+
+    def run_one(self, config, path, audio_hash, doctor, patient):
+        consultation = Consultation.objects.create(
+            doctor=doctor, patient=patient, audio_hash=audio_hash,
+            audio_file=os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/'),
+        )
+        # Иначе вторая конфигурация с той же моделью возьмет текст из кэша
+        TranscriptionCache.objects.all().delete()
+        transcription_queue.enqueue(consultation)
+
+        queries = Counter()
+
+        def count_query(execute, sql, params, many, context):
+            queries[metrics.current_span() or 'other'] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            started = time.perf_counter()
+            tasks.process_audio(consultation.id)
+            wall = time.perf_counter() - started
+        run = PipelineRun.objects.filter(kind='transcription', consultation=consultation).latest('id')
+
+        # При sync-режиме Django Q prerender уже положил PDF в кэш — меряем честный рендер
+        shutil.rmtree(os.path.join(settings.PDF_CACHE_DIR, str(consultation.id)), ignore_errors=True)
+        pdf_queries = Counter()
+        with connection.execute_wrapper(lambda execute, *args: pdf_queries.update(['pdf']) or execute(*args)):
+            started = time.perf_counter()
+            pdf_reports.get_or_render(Consultation.objects.select_related('doctor', 'patient').get(id=consultation.id))
+            pdf_seconds = time.perf_counter() - started
+
+        consultation.refresh_from_db(fields=['status'])
+        return {
+            'config': config,
+            'file': os.path.basename(path),
+            'sha256': audio_hash,
+            'ok': consultation.status == 'ready',
+            'audio_seconds': run.audio_seconds,
+            'wall_seconds': round(wall, 3),
+            'rtf': round(run.rtf, 4) if run.rtf is not None else None,
+            'stages': json.loads(run.spans or '{}'),
+            'counters': json.loads(run.counters or '{}'),
+            'queries': dict(queries),
+            'queries_total': sum(queries.values()),
+            'pdf_seconds': round(pdf_seconds, 3),
+            'pdf_queries': pdf_queries['pdf'],
+            # Пик за жизнь процесса: для честного сравнения памяти запускайте конфигурации по отдельности
+            'peak_rss_bytes': metrics.peak_rss_bytes(),
+        }
+
+    def summarize(self, results):
+        summary = {}
+        for config in dict.fromkeys(row['config'] for row in results):
+            rows = [row for row in results if row['config'] == config]
+            audio = sum(row['audio_seconds'] or 0 for row in rows)
+            transcribe = sum(row['stages'].get('transcribe', 0) for row in rows)
+            stages = Counter()
+            stage_queries = Counter()
+            for row in rows:
+                stages.update(row['stages'])
+                stage_queries.update(row['queries'])
+            summary[config] = {
+                'runs': len(rows),
+                'failed': sum(not row['ok'] for row in rows),
+                'audio_seconds': round(audio, 2),
+                'wall_seconds': round(sum(row['wall_seconds'] for row in rows), 3),
+                'rtf': round(transcribe / audio, 4) if audio else None,
+                'pdf_seconds_p50': statistics.median(row['pdf_seconds'] for row in rows),
+                'queries_total': sum(row['queries_total'] for row in rows),
+                'stage_seconds': {name: round(value, 3) for name, value in stages.items()},
+                'stage_queries': dict(stage_queries),
+                'peak_rss_bytes': max((row['peak_rss_bytes'] or 0 for row in rows), default=0) or None,
+            }
+        return summary
+
+    def print_summary(self, summary):
+        self.stdout.write(f"\n{'конфигурация':<16}{'аудио, c':>10}{'время, c':>10}{'RTF':>8}"
+                          f"{'SQL':>7}{'PDF p50':>9}{'пик, МБ':>9}")
+        for config, data in summary.items():
+            rss = f"{data['peak_rss_bytes'] / 1024 / 1024:.0f}" if data['peak_rss_bytes'] else '-'
+            rtf = f"{data['rtf']:.3f}" if data['rtf'] is not None else '-'
+            self.stdout.write(f"{config:<16}{data['audio_seconds']:>10.1f}{data['wall_seconds']:>10.1f}{rtf:>8}"
+                              f"{data['queries_total']:>7}{data['pdf_seconds_p50']:>9.2f}{rss:>9}")
+            stages = ', '.join(
+                f"{name} {seconds:.2f} c/{data['stage_queries'].get(name, 0)} SQL"
+                for name, seconds in sorted(data['stage_seconds'].items(), key=lambda item: -item[1])
+            )
+            self.stdout.write(f"  этапы: {stages}")
+            if data['failed']:
+                self.stdout.write(self.style.ERROR(f"  с ошибкой: {data['failed']} из {data['runs']}"))
+
+    def compare(self, path, report, tolerance):
+        with open(path, encoding='utf-8') as f:
+            previous = json.load(f)
+
+        def medians(results):
+            grouped = {}
+            for row in results:
+                grouped.setdefault((row['config'], row['sha256']), []).append(row)
+            return {
+                key: {metric: statistics.median(row[metric] for row in rows) if rows[0][metric] is not None else None
+                      for metric in COMPARED} | {'file': rows[0]['file']}
+                for key, rows in grouped.items()
+            }
+
+        old, new = medians(previous['results']), medians(report['results'])
+        regressions = []
+        self.stdout.write(f"\nСравнение с {path} (коммит {previous['meta'].get('commit') or '?'}):")
+        for key in sorted(old.keys() & new.keys()):
+            for metric in COMPARED:
+                before, after = old[key][metric], new[key][metric]
+                if before is None or after is None:
+                    continue
+                if metric == 'queries_total':
+                    regressed = after > before
+                else:
+                    regressed = before > 0 and after > before * (1 + tolerance)
+                change = f"{(after - before) / before:+.0%}" if before else f"{after - before:+g}"
+                line = f"  {key[0]:<12} {new[key]['file'][:36]:<36} {metric:<14} {before:>9g} -> {after:<9g} {change}"
+                if regressed:
+                    regressions.append(line)
+                    self.stdout.write(self.style.ERROR(line))
+                elif self.verbosity > 1:
+                    self.stdout.write(line)
+
+        if regressions:
+            raise CommandError(f"Регрессии: {len(regressions)}")
+        self.stdout.write(self.style.SUCCESS("Регрессий нет"))
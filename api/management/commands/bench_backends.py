@@ -0,0 +1,97 @@
+import glob
+import os
+import re
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api import backends
+from api.chunking import SAMPLE_RATE, decode_audio
+
+
+def normalize_words(text):
+    return re.findall(r'\w+', text.lower().replace('ё', 'е'))
+
+
+def word_error_rate(reference, hypothesis):
+    """WER = (замены + вставки + удаления) / число слов эталона, расстояние Левенштейна по словам."""
+    ref = normalize_words(reference)
+    hyp = normalize_words(hypothesis)
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        current = [i] + [0] * len(hyp)
+        for j, hyp_word in enumerate(hyp, 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ref_word != hyp_word),
+            )
+        previous = current
+    return previous[-1] / len(ref)
+
+
+class Command(BaseCommand):
+    help = (
+        "WER и задержка движков транскрибации на файлах из media. "
+        "Эталон — файл <аудио>.txt рядом с записью, иначе результат --reference-backend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*',
+                            help="Аудиофайлы (по умолчанию всё из MEDIA_ROOT/consultations/audio)")
+        parser.add_argument('--model', default=settings.WHISPER_MODEL)
+        parser.add_argument('--backends', nargs='+', default=list(backends.BACKENDS))
+        parser.add_argument('--reference-backend', default='whisper')
+        parser.add_argument('--reference-model', default=None,
+                            help="Модель для эталона (по умолчанию та же, что --model)")
+
+    def handle(self, *args, **options):
+        files = options['files'] or sorted(
+            glob.glob(os.path.join(settings.MEDIA_ROOT, 'consultations', 'audio', '*'))
+        )
+        files = [path for path in files if not path.endswith('.txt')]
+        if not files:
+            self.stderr.write("Нет файлов для теста")
+            return
+
+        decode_options = dict(settings.WHISPER_DECODE_OPTIONS)
+        audio = {path: decode_audio(path) for path in files}
+        audio_seconds = sum(len(samples) for samples in audio.values()) / SAMPLE_RATE
+
+        # Эталонные тексты
+        references = {}
+        reference_backend = backends.get_backend(
+            options['reference_model'] or options['model'], options['reference_backend'],
+        )
+        for path in files:
+            txt_path = os.path.splitext(path)[0] + '.txt'
+            if os.path.exists(txt_path):
+                with open(txt_path, encoding='utf-8') as f:
+                    references[path] = f.read()
+            else:
+                references[path] = reference_backend.transcribe(audio[path], **decode_options)['text']
+
+        self.stdout.write(f"Файлов: {len(files)}, аудио: {audio_seconds:.1f} c, модель: {options['model']}")
+        self.stdout.write(f"{'движок':<16}{'загрузка, c':>13}{'время, c':>10}{'RTF':>8}{'WER':>8}")
+
+        for name in options['backends']:
+            backend = backends.get_backend(options['model'], name)
+
+            started = time.monotonic()
+            backend.model  # загрузка (и квантизация) считается отдельно от распознавания
+            load_seconds = time.monotonic() - started
+
+            errors = []
+            started = time.monotonic()
+            for path in files:
+                hypothesis = backend.transcribe(audio[path], **decode_options)['text']
+                errors.append(word_error_rate(references[path], hypothesis))
+            wall = time.monotonic() - started
+
+            self.stdout.write(
+                f"{name:<16}{load_seconds:>13.1f}{wall:>10.1f}{wall / audio_seconds:>8.3f}"
+                f"{sum(errors) / len(errors):>8.3f}"
+            )
@@ -0,0 +1,58 @@
+import glob
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api import audio_stream, backends
+from api.batch_scheduler import BatchTranscriber
+
+
+class Command(BaseCommand):
+    help = "Сравнение пакетного планировщика с обработкой по одной записи (без базы данных)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*',
+                            help="Аудиофайлы (по умолчанию всё из MEDIA_ROOT/consultations/audio)")
+        parser.add_argument('--model', default=settings.WHISPER_MODEL)
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8])
+
+    def handle(self, *args, **options):
+        files = options['files'] or sorted(
+            glob.glob(os.path.join(settings.MEDIA_ROOT, 'consultations', 'audio', '*'))
+        )
+        if not files:
+            self.stderr.write("Нет файлов для теста")
+            return
+
+        model = backends.get_backend(options['model']).model
+        decode_options = settings.WHISPER_DECODE_OPTIONS
+
+        audio_seconds = sum(
+            len(samples) / audio_stream.SAMPLE_RATE
+            for path in files for _offset, samples in audio_stream.iter_windows(path)
+        )
+        self.stdout.write(f"Файлов: {len(files)}, аудио: {audio_seconds:.1f} c, модель: {options['model']}")
+
+        rows = []
+
+        # Как сейчас: задача на каждую консультацию, батч = 1
+        started = time.monotonic()
+        for path in files:
+            audio_stream.transcribe_stream(model, path, decode_options)
+        rows.append(('по одной записи', time.monotonic() - started))
+
+        for batch_size in options['batch_sizes']:
+            transcriber = BatchTranscriber(model, decode_options, batch_size)
+            for index, path in enumerate(files):
+                transcriber.add(index, path)
+            started = time.monotonic()
+            while len(transcriber):
+                transcriber.step()
+            rows.append((f"батч {batch_size}", time.monotonic() - started))
+
+        baseline = rows[0][1]
+        self.stdout.write(f"{'режим':<18}{'время, c':>10}{'RTF':>8}{'ускорение':>11}")
+        for name, wall in rows:
+            self.stdout.write(f"{name:<18}{wall:>10.1f}{wall / audio_seconds:>8.3f}{baseline / wall:>10.2f}x")
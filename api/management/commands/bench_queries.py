@@ -0,0 +1,232 @@
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from api.models import Organization, User, Patient, Consultation, ConsultationContent
+
+from .bench import use_database, use_memory_database
+
+SEED_PREFIX = 'Bench clinic'
+SEED_AUDIO = 'consultations/audio/bench_seed.mp3'
+BENCH_ADMIN = 'bench_admin'
+LAST_NAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов',
+              'Новиков', 'Федоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов', 'Егоров']
+STATUS_WEIGHTS = {'ready': 90, 'error': 3, 'processing': 2, 'created': 5}
+
+# Индексы из миграций 0008/0009: для сравнения "до" их временно снимаем
+BENCH_INDEXES = {
+    Consultation: ['consultation_created_id_idx', 'consultation_status_idx', 'consultation_doctor_idx'],
+    Patient: ['patient_name_idx', 'patient_org_name_idx'],
+}
+
+
+@contextmanager
+def seeding_created_at():
+    """bulk_create с auto_now_add перезапишет дату — на время заливки отключаем."""
+    field = Consultation._meta.get_field('created_at')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+@contextmanager
+def without_indexes():
+    removed = []
+    try:
+        with connection.schema_editor() as editor:
+            for model, names in BENCH_INDEXES.items():
+                for index in model._meta.indexes:
+                    if index.name in names:
+                        editor.remove_index(model, index)
+                        removed.append((model, index))
+        yield
+    finally:
+        with connection.schema_editor() as editor:
+            for model, index in removed:
+                editor.add_index(model, index)
+
+
+class Command(BaseCommand):
+    help = (
+        "Заливает синтетические консультации и меряет задержку API и админки "
+        "с индексами горячих запросов и без них. По умолчанию — в SQLite в памяти; "
+        "на копии MySQL — через --database (алиас из DATABASES)."
+    )
+    # Проверки системы могут полезть в рабочую базу — до выбора базы она команде не нужна
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', metavar='ALIAS',
+                            help="Алиас тестовой базы из DATABASES: туда зальются данные, там снимаются индексы")
+        parser.add_argument('--allow-default', action='store_true',
+                            help="Разрешить --database default (рабочая база!)")
+        parser.add_argument('--rows', type=int, default=300_000, help="Сколько консультаций должно быть в базе")
+        parser.add_argument('--organizations', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--no-compare', action='store_true', help="Не мерить без индексов")
+        parser.add_argument('--clear', action='store_true', help="Удалить синтетические данные и выйти")
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        if alias is None:
+            if options['clear']:
+                raise CommandError("Данные в памяти удалять незачем: для --clear укажите --database")
+            # Сотни тысяч строк, снятые индексы и суперпользователь — только в одноразовой базе
+            use_memory_database()
+        elif alias not in settings.DATABASES:
+            raise CommandError(f"Нет базы {alias!r} в DATABASES")
+        elif alias == 'default' and not options['allow_default']:
+            raise CommandError("--database default — рабочая база: заливка и снятие индексов ударят "
+                               "по живым запросам. Если это действительно нужно, добавьте --allow-default")
+        else:
+            use_database(settings.DATABASES[alias])
+
+        if options['clear']:
+            deleted, _ = Organization.objects.filter(name__startswith=SEED_PREFIX).delete()
+            deleted += User.objects.filter(username=BENCH_ADMIN).delete()[0]
+            self.stdout.write(f"Удалено объектов: {deleted}")
+            return
+
+        self.seed(options['rows'], options['organizations'])
+
+        admin = User.objects.filter(is_superuser=True).first() or User.objects.create_superuser(
+            BENCH_ADMIN, password=None,
+        )
+        client = Client()
+        client.force_login(admin)
+        endpoints = self.endpoints()
+
+        with_indexes = self.measure(client, endpoints, options['repeat'])
+        without = None
+        if not options['no_compare']:
+            with without_indexes():
+                without = self.measure(client, endpoints, options['repeat'])
+
+        self.stdout.write(f"{'запрос':<44}{'с индексами, мс':>17}{'без индексов, мс':>18}")
+        for name in endpoints:
+            before = f"{without[name]:>18.1f}" if without else f"{'-':>18}"
+            self.stdout.write(f"{name:<44}{with_indexes[name]:>17.1f}{before}")
+
+    def seed(self, rows, organizations):
+        existing = Consultation.objects.count()
+        missing = rows - existing
+        if missing <= 0:
+            self.stdout.write(f"В базе уже {existing} консультаций, заливка не нужна")
+            return
+
+        rng = random.Random(0)
+        self.stdout.write(f"Заливаю {missing} консультаций...")
+        orgs = list(Organization.objects.filter(name__startswith=SEED_PREFIX))
+        if not orgs:
+            orgs = Organization.objects.bulk_create(
+                Organization(name=f"{SEED_PREFIX} {i}") for i in range(organizations)
+            )
+            doctors = [
+                User(username=f"bench_doctor_{org.id}_{i}", first_name="Врач", last_name=rng.choice(LAST_NAMES),
+                     organization=org)
+                for org in orgs for i in range(10)
+            ]
+            for doctor in doctors:
+                doctor.set_unusable_password()
+            User.objects.bulk_create(doctors, batch_size=1000)
+            Patient.objects.bulk_create(
+                (Patient(first_name="Пациент", last_name=f"{rng.choice(LAST_NAMES)}{i}",
+                         birth_date='1980-01-01', organization=org)
+                 for org in orgs for i in range(max(1, rows // organizations // 15))),
+                batch_size=5000,
+            )
+
+        doctors_by_org, patients_by_org = {}, {}
+        for org in orgs:
+            doctors_by_org[org.id] = list(User.objects.filter(organization=org).values_list('id', flat=True))
+            patients_by_org[org.id] = list(Patient.objects.filter(organization=org).values_list('id', flat=True))
+
+        now = timezone.now()
+        statuses = list(STATUS_WEIGHTS)
+        weights = list(STATUS_WEIGHTS.values())
+        batch = []
+        with seeding_created_at():
+            for i in range(missing):
+                org = rng.choice(orgs)
+                batch.append(Consultation(
+                    doctor_id=rng.choice(doctors_by_org[org.id]),
+                    patient_id=rng.choice(patients_by_org[org.id]),
+                    audio_file=SEED_AUDIO,
+                    status=rng.choices(statuses, weights)[0],
+                    created_at=now - timedelta(minutes=rng.randrange(365 * 24 * 60)),
+                ))
+                if len(batch) == 5000:
+                    self.bulk_create(batch)
+                    batch = []
+                    self.stdout.write(f"  {i + 1}/{missing}")
+            if batch:
+                self.bulk_create(batch)
+
+    def bulk_create(self, consultations):
+        Consultation.objects.bulk_create(consultations)
+        # bulk_create не вызывает сигналы (и на MySQL не возвращает id) — тексты добавляем сами
+        ids = Consultation.objects.filter(audio_file=SEED_AUDIO, content__isnull=True).values_list('id', flat=True)
+        ConsultationContent.objects.bulk_create(
+            ConsultationContent(
+                consultation_id=consultation_id,
+                raw_transcription="Пациент жалуется на головную боль и температуру. " * 20,
+                final_report='{"diagnosis": "ОРВИ (J06.9)"}',
+            )
+            for consultation_id in ids
+        )
+
+    def endpoints(self):
+        doctor_id = Consultation.objects.order_by('id').values_list('doctor_id', flat=True).first()
+        month_ago = (timezone.now() - timedelta(days=30)).isoformat()
+        return {
+            'API: список, первая страница': ('/api/consultations/', {}),
+            'API: список без текстов (?fields=)': ('/api/consultations/', {'fields': 'id,status,patient_info,created_at'}),
+            'API: 20 страниц подряд': ('cursor', 20),
+            'Админка: консультации': ('/admin/api/consultation/', {}),
+            'Админка: status=created': ('/admin/api/consultation/', {'status__exact': 'created'}),
+            'Админка: фильтр по врачу': ('/admin/api/consultation/', {'doctor__id__exact': doctor_id}),
+            'Админка: за последний месяц': ('/admin/api/consultation/', {'created_at__gte': month_ago}),
+            'Админка: поиск по фамилии пациента': ('/admin/api/consultation/', {'q': 'Петров'}),
+            'Админка: пациенты, поиск': ('/admin/api/patient/', {'q': 'Смирнов'}),
+            'Планировщик: 8 новых консультаций': ('query', None),
+        }
+
+    def measure(self, client, endpoints, repeat):
+        results = {}
+        for name, (url, params) in endpoints.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                if url == 'cursor':
+                    self.walk_cursor(client, params)
+                elif url == 'query':
+                    list(Consultation.objects.filter(status='created').order_by('created_at')
+                         .values_list('id', flat=True)[:8])
+                else:
+                    with override_settings(ALLOWED_HOSTS=['*']):
+                        response = client.get(url, params)
+                    if response.status_code != 200:
+                        raise RuntimeError(f"{url}: HTTP {response.status_code}")
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = statistics.median(timings)
+        return results
+
+    def walk_cursor(self, client, pages):
+        url, params = '/api/consultations/', {'fields': 'id'}
+        with override_settings(ALLOWED_HOSTS=['*']):
+            for _ in range(pages):
+                data = client.get(url, params).json()
+                url, params = data['next'], None
+                if not url:
+                    break
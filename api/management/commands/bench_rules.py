@@ -0,0 +1,88 @@
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.rule_engine import RuleEngine, normalize
+
+FILLER = (
+    "пациент жалуется на слабость последние несколько дней принимал лекарства "
+    "без эффекта аллергии отрицает хронические заболевания отрицает "
+)
+LETTERS = 'абвгдежзиклмнопрстуфхцчшщыэюя'
+
+
+def naive_match(rules, text):
+    """Как раньше, но со всеми совпадениями: отдельный поиск по тексту на каждую основу."""
+    text = normalize(text)
+    found = []
+    for order, rule in enumerate(rules):
+        for keyword in rule['keywords']:
+            stem = normalize(keyword if isinstance(keyword, str) else keyword['stem'])
+            start = text.find(stem)
+            while start != -1:
+                found.append((start, start + len(stem), order))
+                start = text.find(stem, start + 1)
+    return found
+
+
+class Command(BaseCommand):
+    help = "Скорость движка клинических правил на длинных транскриптах: Ахо-Корасик против поиска по каждой основе"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=None, help="Текст транскрипта (по умолчанию — синтетический)")
+        parser.add_argument('--chars', type=int, default=200_000, help="Длина синтетического текста")
+        parser.add_argument('--extra-rules', type=int, nargs='+', default=[0, 100, 1000],
+                            help="Сколько случайных правил добавить к файлу правил (по 3 основы)")
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        base = RuleEngine.from_file(settings.CLINICAL_RULES_FILE).rules
+        rng = random.Random(0)
+
+        if options['file']:
+            with open(options['file'], encoding='utf-8') as f:
+                text = f.read()
+        else:
+            stems = [k if isinstance(k, str) else k['stem'] for rule in base for k in rule['keywords']]
+            words = []
+            while sum(len(w) + 1 for w in words) < options['chars']:
+                words.append(rng.choice(stems) + 'а' if rng.random() < 0.05 else rng.choice(FILLER.split()))
+            text = ' '.join(words)
+
+        self.stdout.write(f"Текст: {len(text)} символов, повторов: {options['repeat']}")
+        self.stdout.write(f"{'правил':>8}{'основ':>8}{'сборка, мс':>12}{'по основам, мс':>16}{'автомат, мс':>13}{'ускорение':>11}")
+
+        for extra in options['extra_rules']:
+            rules = list(base) + [
+                {
+                    'id': f'synthetic_{i}', 'icd10': '', 'diagnosis': f'Правило {i}',
+                    'keywords': [''.join(rng.choice(LETTERS) for _ in range(rng.randint(4, 8))) for _ in range(3)],
+                }
+                for i in range(extra)
+            ]
+            stems_count = sum(len(rule['keywords']) for rule in rules)
+
+            started = time.perf_counter()
+            engine = RuleEngine(rules)
+            build_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                naive = naive_match(rules, text)
+            naive_ms = (time.perf_counter() - started) * 1000 / options['repeat']
+
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                findings = engine.match(text)
+            engine_ms = (time.perf_counter() - started) * 1000 / options['repeat']
+
+            matched = sum(len(f['matches']) for f in findings)
+            if matched != len(naive):
+                self.stderr.write(f"Расхождение: автомат {matched}, поиск по основам {len(naive)}")
+
+            self.stdout.write(
+                f"{len(rules):>8}{stems_count:>8}{build_ms:>12.1f}{naive_ms:>16.1f}{engine_ms:>13.1f}"
+                f"{naive_ms / engine_ms:>10.2f}x"
+            )
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api import metrics
+
+
+class Command(BaseCommand):
+    help = "Перцентили времени этапов, RTF и ожидания в очереди по последним прогонам обработки"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24, help="За сколько последних часов")
+        parser.add_argument('--kind', choices=['transcription', 'pdf'], help="Только один вид прогонов")
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(hours=options['hours'])
+        summary = metrics.summarize(metrics.recent_runs(since, options['kind']))
+        if not summary:
+            self.stdout.write(f"За последние {options['hours']:g} ч прогонов нет")
+            return
+
+        for kind, data in summary.items():
+            self.stdout.write(f"\n=== {kind}: прогонов {data['runs']}, с ошибкой {data['errors']}, "
+                              f"аудио {data['audio_seconds'] / 60:.1f} мин ===")
+            self.stdout.write(f"{'метрика':<26}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+            for name, values in sorted(data['series'].items(), key=lambda item: (item[0] != 'run', item[0])):
+                row = [metrics.percentile(values, q) for q in metrics.QUANTILES] + [values[-1]]
+                self.stdout.write(f"{name:<26}{len(values):>6}" + ''.join(f"{value:>10.3f}" for value in row))
+
+            counters = data['counters']
+            for name in ('model_cache', 'transcription_cache'):
+                hits, misses = counters.get(f'{name}_hits', 0), counters.get(f'{name}_misses', 0)
+                if hits + misses:
+                    self.stdout.write(f"{name}: попаданий {hits} из {hits + misses} ({hits / (hits + misses):.0%})")
+            if data['peak_rss_bytes'] is not None:
+                self.stdout.write(f"пик памяти воркера: {data['peak_rss_bytes'] / 1024 / 1024:.0f} МБ")
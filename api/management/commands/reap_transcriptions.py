@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import transcription_queue, uploads
+
+
+class Command(BaseCommand):
+    help = (
+        "Возвращает в очередь транскрибации задачи с истекшей арендой (воркер умер или задачу "
+        "убил timeout), раздает свободные слоты и удаляет брошенные загрузки по частям. "
+        "Запускать из cron или с --interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Повторять каждые N секунд (0 — один проход и выход)")
+
+    def handle(self, *args, **options):
+        while True:
+            requeued, failed = transcription_queue.reap()
+            dispatched = transcription_queue.dispatch()
+            expired = uploads.expire()
+            if requeued or failed or dispatched or expired:
+                self.stdout.write(
+                    f"Возвращено в очередь: {requeued}, попытки исчерпаны: {failed}, запущено: {len(dispatched)}, "
+                    f"брошенных загрузок удалено: {expired}"
+                )
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
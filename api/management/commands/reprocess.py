@@ -0,0 +1,153 @@
+import json
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import backends, reprocessing, rule_engine
+from api.models import Consultation, ReprocessJob
+
+
+def _date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f"Дата в формате ГГГГ-ММ-ДД, получено: {value}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Переобработка старых консультаций после смены модели, движка или правил отчета: "
+        "пачки задач в очереди с ограниченной параллельностью, неизмененные приемы пропускаются. "
+        "--dry-run только оценивает объем работы, --resume продолжает прерванную переобработку."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="ID консультаций (по умолчанию — по фильтрам)")
+        parser.add_argument('--organization', type=int, help="ID организации")
+        parser.add_argument('--since', type=_date, help="Созданные с этой даты (ГГГГ-ММ-ДД)")
+        parser.add_argument('--until', type=_date, help="Созданные по эту дату включительно")
+        parser.add_argument('--status', default='ready', help="Статус консультаций (по умолчанию ready)")
+        parser.add_argument('--from-model', dest='from_model',
+                            help="Только распознанные этой моделью ('' — старые приемы без отметки)")
+        parser.add_argument('--limit', type=int)
+        parser.add_argument('--model', default=settings.WHISPER_MODEL, help="Модель для распознавания")
+        parser.add_argument('--backend', default=None, help="Движок (по умолчанию TRANSCRIPTION_BACKEND)")
+        parser.add_argument('--batch-size', type=int, default=settings.REPROCESS_BATCH_SIZE,
+                            help="Консультаций в одной задаче очереди")
+        parser.add_argument('--parallelism', type=int, default=settings.REPROCESS_PARALLELISM,
+                            help="Сколько пачек обрабатывается одновременно")
+        parser.add_argument('--force', action='store_true', help="Переобработать всё, без пропусков и кэша")
+        parser.add_argument('--dry-run', action='store_true', help="Только оценить объем и время")
+        parser.add_argument('--no-wait', action='store_true', help="Поставить в очередь и выйти")
+        parser.add_argument('--interval', type=float, default=5, help="Как часто печатать прогресс, с")
+        parser.add_argument('--resume', type=int, metavar='JOB_ID',
+                            help="Перезапустить цепочки задачи переобработки (воркеры перезапускались)")
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            return self.resume(options)
+        if options['batch_size'] < 1 or options['parallelism'] < 1:
+            raise CommandError("--batch-size и --parallelism должны быть не меньше 1")
+        try:
+            backend = backends.get_backend(options['model'], options['backend'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        consultations = Consultation.objects.order_by('id')
+        if options['ids']:
+            consultations = consultations.filter(id__in=options['ids'])
+        else:
+            consultations = consultations.filter(status=options['status'])
+        if options['organization']:
+            consultations = consultations.filter(patient__organization_id=options['organization'])
+        if options['since']:
+            consultations = consultations.filter(created_at__date__gte=options['since'])
+        if options['until']:
+            consultations = consultations.filter(created_at__date__lte=options['until'])
+        if options['from_model'] is not None:
+            consultations = consultations.filter(content__transcription_model=options['from_model'])
+        consultations = consultations.exclude(queue_job__status__in=reprocessing.ACTIVE_JOB_STATUSES)
+        if options['limit']:
+            consultations = Consultation.objects.filter(
+                id__in=list(consultations.values_list('id', flat=True)[:options['limit']])
+            ).order_by('id')
+
+        plan = reprocessing.estimate(consultations, backend.label, rule_engine.rules_version(), options['force'])
+        self.stdout.write(
+            f"Модель: {backend.label}. Без изменений: {plan['skip']}, только отчет: {plan['report']}, "
+            f"распознать заново: {plan['transcribe']} (из них есть в кэше транскрибаций: {plan['cached']})"
+        )
+        self.print_cost(plan, options['parallelism'])
+        if options['dry_run'] or not plan['ids']:
+            return
+
+        job = reprocessing.create_job(
+            plan['ids'], options['model'], options['backend'], options['force'],
+            options['batch_size'], options['parallelism'],
+            filters={key: options[key] for key in ('ids', 'organization', 'since', 'until', 'status', 'from_model')},
+            heavy=plan['heavy'],
+        )
+        # Каждая цепочка сама берет следующую пачку, так что в работе не больше parallelism пачек
+        reprocessing.start_chains(job)
+        self.stdout.write(f"Задача переобработки {job.id}: {job.total} консультаций, "
+                          f"{len(json.loads(job.batches))} пачек до {job.batch_size}, параллельно {job.parallelism}")
+        if not options['no_wait']:
+            self.wait(job, options['interval'])
+
+    def resume(self, options):
+        try:
+            job = ReprocessJob.objects.get(id=options['resume'])
+        except ReprocessJob.DoesNotExist:
+            raise CommandError(f"Нет задачи переобработки {options['resume']}")
+        if job.status == 'ready':
+            self.stdout.write(f"Задача переобработки {job.id} уже готова")
+            return
+        # Пачки, взятые убитыми задачами, новые цепочки заберут, когда истечет их аренда
+        ReprocessJob.objects.filter(id=job.id).update(status='running', error='')
+        reprocessing.start_chains(job)
+        self.stdout.write(f"Задача переобработки {job.id} продолжена")
+        if not options['no_wait']:
+            self.wait(job, options['interval'])
+
+    def print_cost(self, plan, parallelism):
+        line = f"Аудио к распознаванию: {plan['audio_seconds'] / 3600:.2f} ч"
+        if plan['unknown_duration']:
+            line += f" (у {plan['unknown_duration']} записей длительность оценена по средней)"
+        rtf = reprocessing.recent_rtf()
+        if rtf is None:
+            line += "; RTF неизвестен (нет истории транскрибаций), время не оценить"
+        else:
+            # RTF по истории текущей модели: для другой модели — грубая оценка
+            compute = plan['audio_seconds'] * rtf / 3600
+            line += (f"; при RTF {rtf:.2f} это ~{compute:.2f} ч работы воркера, "
+                     f"~{compute / parallelism:.2f} ч при параллельности {parallelism}")
+        self.stdout.write(line)
+
+    def wait(self, job, interval):
+        restarted_at = None
+        while True:
+            job.refresh_from_db()
+            finished = job.done + job.skipped + job.failed
+            # По времени последней завершенной пачки: скорость не проседает между опросами
+            elapsed = max((job.updated_at - job.created_at).total_seconds(), 1e-3)
+            line = (f"[{job.status}] {finished}/{job.total}: обновлено {job.done}, пропущено {job.skipped}, "
+                    f"ошибок {job.failed}; {finished / elapsed * 60:.1f} консультаций/мин")
+            if job.audio_seconds:
+                line += f", RTF {elapsed / job.audio_seconds:.3f}"
+            self.stdout.write(line)
+            if job.status == 'error':
+                raise CommandError(f"Переобработка прервалась: {job.error}")
+            if job.status == 'ready' or finished >= job.total:
+                return
+            if reprocessing.is_stalled(job):
+                # Цепочки пропали (воркер убил задачу по timeout, перезапуск qcluster) — запускаем заново.
+                # Не помог и перезапуск — очередь не разбирается, ждать бессмысленно
+                if restarted_at == job.updated_at:
+                    raise CommandError(f"Переобработка {job.id} не продвигается: работает ли qcluster? "
+                                       f"Продолжить: manage.py reprocess --resume {job.id}")
+                self.stdout.write("Пачки давно не разбираются, перезапускаю цепочки")
+                restarted_at = job.updated_at
+                reprocessing.start_chains(job)
+            time.sleep(interval)
@@ -0,0 +1,90 @@
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import backends, reprocessing, tasks
+from api.models import Consultation
+
+
+def _date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f"Дата в формате ГГГГ-ММ-ДД, получено: {value}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Повторная транскрибация архивных консультаций другой моделью или движком по кэшу "
+        "лог-мел признаков (api/feature_cache.py): запись декодируется и спектрограмма считается "
+        "один раз, следующие прогоны читают признаки через mmap."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="ID консультаций (по умолчанию — по фильтрам)")
+        parser.add_argument('--since', type=_date, help="Созданные с этой даты (ГГГГ-ММ-ДД)")
+        parser.add_argument('--until', type=_date, help="Созданные по эту дату включительно")
+        parser.add_argument('--organization', type=int, help="ID организации")
+        parser.add_argument('--status', default='ready', help="Статус консультаций (по умолчанию ready)")
+        parser.add_argument('--limit', type=int)
+        parser.add_argument('--model', default=settings.WHISPER_MODEL)
+        parser.add_argument('--backend', default=None, help="Движок (по умолчанию TRANSCRIPTION_BACKEND)")
+        parser.add_argument('--report', action='store_true', help="Заново построить и отчет")
+        parser.add_argument('--force', action='store_true',
+                            help="Распознавать, даже если результат есть в кэше транскрибаций")
+
+    def handle(self, *args, **options):
+        try:
+            backend = backends.get_backend(options['model'], options['backend'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        consultations = Consultation.objects.order_by('id')
+        if options['ids']:
+            consultations = consultations.filter(id__in=options['ids'])
+        else:
+            consultations = consultations.filter(status=options['status'])
+        if options['since']:
+            consultations = consultations.filter(created_at__date__gte=options['since'])
+        if options['until']:
+            consultations = consultations.filter(created_at__date__lte=options['until'])
+        if options['organization']:
+            consultations = consultations.filter(patient__organization_id=options['organization'])
+        # Записи в очереди или у воркера не трогаем: их результат перезапишет конвейер
+        consultations = consultations.exclude(queue_job__status__in=reprocessing.ACTIVE_JOB_STATUSES)
+        if options['limit']:
+            consultations = consultations[:options['limit']]
+        consultations = list(consultations)
+        if not consultations:
+            self.stderr.write("Нет консультаций для повторной транскрибации")
+            return
+
+        self.stdout.write(f"Консультаций: {len(consultations)}, движок: {backend.name}, модель: {backend.label}")
+
+        started = time.monotonic()
+        audio_seconds = 0.0
+        done = failed = 0
+        for consultation in consultations:
+            item_started = time.monotonic()
+            try:
+                result, source, seconds = reprocessing.transcribe(consultation, backend, options['force'])
+                audio_seconds += seconds
+                tasks.save_transcription(consultation, result['text'], result['segments'], model_name=backend.label)
+                if options['report']:
+                    tasks.save_report(consultation, result['text'])
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"❌ Консультация {consultation.id}: {e}")
+                continue
+            done += 1
+            self.stdout.write(
+                f"✅ Консультация {consultation.id}: {time.monotonic() - item_started:.1f} c ({source})"
+            )
+
+        wall = time.monotonic() - started
+        summary = f"Готово: {done}, ошибок: {failed}, время: {wall:.1f} c"
+        if audio_seconds:
+            summary += f", аудио распознано: {audio_seconds:.1f} c, RTF {wall / audio_seconds:.3f}"
+        self.stdout.write(summary)
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api import batch_scheduler
+
+
+class Command(BaseCommand):
+    help = "Пакетный планировщик: забирает консультации из очереди транскрибации и распознаёт их батчами"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-batch-size', type=int, default=settings.WHISPER_BATCH_MAX_SIZE)
+        parser.add_argument('--max-wait', type=float, default=settings.WHISPER_BATCH_MAX_WAIT,
+                            help="Сколько секунд новая запись ждёт попутчиков для батча")
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true', help="Обработать текущую очередь и выйти")
+
+    def handle(self, *args, **options):
+        batch_scheduler.run(
+            max_batch_size=options['max_batch_size'],
+            max_wait=options['max_wait'],
+            poll_interval=options['poll_interval'],
+            once=options['once'],
+        )
@@ -0,0 +1,274 @@
+"""
+Метрики конвейера обработки.
+
+Задача открывает прогон: `with metrics.run('transcription', consultation_id)`.
+Внутри этапы оборачиваются в `metrics.span('decode')`, события — `metrics.count(...)`.
+Текущий прогон лежит в contextvars, поэтому span()/count() можно звать из глубины кода
+(chunking, реестр моделей, правила): вне прогона они ничего не делают.
+
+Воркеры Django Q и веб-процесс — разные процессы, поэтому прогон в конце сохраняется
+в PipelineRun. /api/metrics/ собирает из последних прогонов текст в формате Prometheus,
+manage.py metrics_report печатает перцентили.
+"""
+import contextvars
+import json
+import sys
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+# Модели импортируются внутри функций: span()/count() зовутся и из дочерних процессов
+# пула (chunking), где при spawn Django еще не настроен
+
+_current = contextvars.ContextVar('pipeline_run', default=None)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Recorder:
+    def __init__(self, kind, consultation_id=None):
+        self.kind = kind
+        self.consultation_id = consultation_id
+        self.spans = {}
+        self.counters = {}
+        self.values = {}
+        self.stack = []  # открытые сейчас этапы, внутренний — последний
+        self.ok = True
+        self.started = time.perf_counter()
+
+    def add_span(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def save(self):
+        from .models import PipelineRun
+
+        audio_seconds = self.values.get('audio_seconds')
+        rtf = None
+        if audio_seconds and 'transcribe' in self.spans and not self.counters.get('transcription_cache_hits'):
+            rtf = self.spans['transcribe'] / audio_seconds
+        PipelineRun.objects.create(
+            kind=self.kind,
+            consultation_id=self.consultation_id,
+            ok=self.ok,
+            duration=round(time.perf_counter() - self.started, 3),
+            audio_seconds=audio_seconds,
+            rtf=rtf,
+            queue_wait=self.values.get('queue_wait'),
+            peak_rss_bytes=peak_rss_bytes(),
+            spans=json.dumps({name: round(value, 3) for name, value in self.spans.items()}),
+            counters=json.dumps(self.counters),
+        )
+        prune()
+
+
+@contextmanager
+def run(kind, consultation_id=None):
+    """Прогон задачи. Исключение внутри помечает прогон неуспешным и пробрасывается дальше."""
+    recorder = Recorder(kind, consultation_id)
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    except BaseException:
+        recorder.ok = False
+        raise
+    finally:
+        _current.reset(token)
+        try:
+            recorder.save()
+        except Exception as e:
+            # Метрики не должны ронять обработку
+            print(f"⚠️ [Metrics] Не удалось сохранить метрики: {e}")
+
+
+@contextmanager
+def span(name):
+    recorder = _current.get()
+    if recorder is None:
+        yield
+        return
+    started = time.perf_counter()
+    recorder.stack.append(name)
+    try:
+        yield
+    finally:
+        recorder.stack.pop()
+        recorder.add_span(name, time.perf_counter() - started)
+
+
+def current_span():
+    """Имя самого внутреннего открытого этапа (для подсчета SQL-запросов по этапам в manage.py bench)."""
+    recorder = _current.get()
+    return recorder.stack[-1] if recorder is not None and recorder.stack else None
+
+
+def count(name, value=1):
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.count(name, value)
+
+
+def peak_rss_bytes():
+    """
+    Пик памяти за жизнь процесса (и его пулов), не за один прогон:
+    воркер Django Q перезапускается только по recycle. На Windows недоступно.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux отдает килобайты, macOS — байты
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def prune():
+    from .models import PipelineRun
+
+    PipelineRun.objects.filter(
+        created_at__lt=timezone.now() - timedelta(days=settings.METRICS_RETENTION_DAYS),
+    ).delete()
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по ближайшему рангу; sorted_values уже отсортирован."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def recent_runs(since, kind=None):
+    from .models import PipelineRun
+
+    runs = PipelineRun.objects.filter(created_at__gte=since).order_by()
+    if kind is not None:
+        runs = runs.filter(kind=kind)
+    return list(runs.values('kind', 'ok', 'duration', 'audio_seconds', 'rtf', 'queue_wait',
+                            'peak_rss_bytes', 'spans', 'counters'))
+
+
+def summarize(runs):
+    """
+    Сводка по прогонам: {kind: {'runs', 'errors', 'audio_seconds', 'peak_rss_bytes',
+    'series': {имя: отсортированные значения}, 'counters': {имя: сумма}}}.
+    В series — этапы ('stage:decode'), 'run', 'rtf', 'queue_wait'.
+    """
+    summary = {}
+    for row in runs:
+        kind = summary.setdefault(row['kind'], {
+            'runs': 0, 'errors': 0, 'audio_seconds': 0.0, 'peak_rss_bytes': None, 'series': {}, 'counters': {},
+        })
+        kind['runs'] += 1
+        kind['errors'] += 0 if row['ok'] else 1
+        kind['audio_seconds'] += row['audio_seconds'] or 0.0
+        if row['peak_rss_bytes'] is not None:
+            kind['peak_rss_bytes'] = max(kind['peak_rss_bytes'] or 0, row['peak_rss_bytes'])
+
+        series = kind['series']
+        series.setdefault('run', []).append(row['duration'])
+        for name in ('rtf', 'queue_wait'):
+            if row[name] is not None:
+                series.setdefault(name, []).append(row[name])
+        for stage, seconds in json.loads(row['spans'] or '{}').items():
+            series.setdefault(f'stage:{stage}', []).append(seconds)
+        for name, value in json.loads(row['counters'] or '{}').items():
+            kind['counters'][name] = kind['counters'].get(name, 0) + value
+
+    for kind in summary.values():
+        for values in kind['series'].values():
+            values.sort()
+    return summary
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _summary_lines(lines, name, values, **labels):
+    for q in QUANTILES:
+        lines.append(f"{name}{_labels(**labels, quantile=q)} {percentile(values, q):.6g}")
+    lines.append(f"{name}_sum{_labels(**labels)} {sum(values):.6g}")
+    lines.append(f"{name}_count{_labels(**labels)} {len(values)}")
+
+
+def render_prometheus():
+    """Текстовый формат Prometheus: сводки за последние METRICS_WINDOW_MINUTES + состояние очереди."""
+    from . import ai_service, transcription_queue
+
+    window = settings.METRICS_WINDOW_MINUTES
+    summary = summarize(recent_runs(timezone.now() - timedelta(minutes=window)))
+    lines = []
+
+    def header(name, kind, text):
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    header('clinspeech_runs', 'gauge', f"Прогоны обработки за последние {window} мин")
+    for kind, data in summary.items():
+        lines.append(f"clinspeech_runs{_labels(kind=kind, result='ok')} {data['runs'] - data['errors']}")
+        lines.append(f"clinspeech_runs{_labels(kind=kind, result='error')} {data['errors']}")
+
+    header('clinspeech_run_seconds', 'summary', "Длительность прогона целиком")
+    for kind, data in summary.items():
+        _summary_lines(lines, 'clinspeech_run_seconds', data['series']['run'], kind=kind)
+
+    header('clinspeech_stage_seconds', 'summary', "Время этапов: decode, model_load, transcribe, rules, db_write, pdf_render")
+    for kind, data in summary.items():
+        for name, values in sorted(data['series'].items()):
+            if name.startswith('stage:'):
+                _summary_lines(lines, 'clinspeech_stage_seconds', values, kind=kind, stage=name[len('stage:'):])
+
+    header('clinspeech_rtf', 'summary', "Real-time factor распознавания (время / длительность аудио)")
+    for kind, data in summary.items():
+        if data['series'].get('rtf'):
+            _summary_lines(lines, 'clinspeech_rtf', data['series']['rtf'], kind=kind)
+
+    header('clinspeech_audio_seconds', 'gauge', f"Секунд аудио обработано за последние {window} мин")
+    for kind, data in summary.items():
+        lines.append(f"clinspeech_audio_seconds{_labels(kind=kind)} {data['audio_seconds']:.6g}")
+
+    header('clinspeech_events', 'gauge', f"Счетчики событий (попадания в кэши и т.п.) за последние {window} мин")
+    for kind, data in summary.items():
+        for name, value in sorted(data['counters'].items()):
+            lines.append(f"clinspeech_events{_labels(kind=kind, event=name)} {value}")
+
+    header('clinspeech_peak_rss_bytes', 'gauge', "Максимальный пик памяти воркеров среди прогонов окна")
+    for kind, data in summary.items():
+        if data['peak_rss_bytes'] is not None:
+            lines.append(f"clinspeech_peak_rss_bytes{_labels(kind=kind)} {data['peak_rss_bytes']}")
+
+    queue = transcription_queue.stats()
+    header('clinspeech_queue_jobs', 'gauge', "Задачи транскрибации в очереди и в работе по клиникам")
+    for row in queue:
+        for state in ('queued', 'running'):
+            lines.append(f"clinspeech_queue_jobs{_labels(organization=row['organization'], state=state)} {row[state]}")
+    header('clinspeech_queue_wait_seconds', 'gauge', "Ожидание слота по клиникам за последний час (p50/p95)")
+    for row in queue:
+        for q, key in ((0.5, 'wait_p50_seconds'), (0.95, 'wait_p95_seconds')):
+            if row[key] is not None:
+                lines.append(f"clinspeech_queue_wait_seconds{_labels(organization=row['organization'], quantile=q)} {row[key]}")
+
+    executor = ai_service.stats()
+    header('clinspeech_executor_tasks', 'gauge', "Фоновые задачи в очереди исполнителя и в работе (Django Q или встроенный пул)")
+    if executor['queued'] is not None:
+        lines.append(f"clinspeech_executor_tasks{_labels(mode=executor['mode'], state='queued')} {executor['queued']}")
+    if executor['mode'] == 'local':
+        lines.append(f"clinspeech_executor_tasks{_labels(mode='local', state='running')} {executor['busy']}")
+        header('clinspeech_executor_rejected', 'counter', "Задачи, не принятые встроенным пулом (очередь полна)")
+        lines.append(f"clinspeech_executor_rejected {executor['rejected']}")
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_alter_consultation_audio_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscriptionCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('audio_hash', models.CharField(db_index=True, max_length=64)),
+                ('model_name', models.CharField(max_length=50)),
+                ('options', models.TextField(blank=True, verbose_name='Параметры распознавания (JSON)')),
+                ('text', models.TextField(blank=True, verbose_name='Текст из аудио')),
+                ('segments', models.TextField(blank=True, verbose_name='Сегменты (JSON)')),
+                ('size_bytes', models.PositiveIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='consultation',
+            name='audio_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, verbose_name='Хэш аудио'),
+        ),
+    ]
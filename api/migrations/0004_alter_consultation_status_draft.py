@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_consultation_audio_hash_transcriptioncache'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='consultation',
+            name='status',
+            field=models.CharField(choices=[('created', 'Создано'), ('processing', 'Обработка (Транскрибация)'), ('draft', 'Черновик готов (уточняется)'), ('refined', 'Текст уточнен'), ('generating', 'Генерация отчета'), ('ready', 'Готово'), ('error', 'Ошибка')], default='created', max_length=20),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_alter_consultation_status_draft'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsultationEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('status', 'Смена статуса'), ('progress', 'Прогресс'), ('segments', 'Распознанные сегменты')], max_length=20)),
+                ('payload', models.TextField(blank=True, verbose_name='Данные (JSON)')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('consultation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='api.consultation')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_consultationevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='consultation',
+            name='status',
+            field=models.CharField(choices=[('created', 'Создано'), ('recording', 'Идет запись (живая транскрибация)'), ('processing', 'Обработка (Транскрибация)'), ('draft', 'Черновик готов (уточняется)'), ('refined', 'Текст уточнен'), ('generating', 'Генерация отчета'), ('ready', 'Готово'), ('error', 'Ошибка')], default='created', max_length=20),
+        ),
+        migrations.CreateModel(
+            name='LiveSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('committed_seconds', models.FloatField(default=0, verbose_name='Подтверждено до (сек)')),
+                ('hypothesis', models.TextField(blank=True, verbose_name='Неподтвержденные сегменты (JSON)')),
+                ('tick_pending', models.BooleanField(default=False)),
+                ('tick_owner', models.CharField(blank=True, max_length=64)),
+                ('tick_until', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('consultation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='live_session', to='api.consultation')),
+            ],
+        ),
+    ]
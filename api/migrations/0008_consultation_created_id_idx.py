@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='consultation',
+            index=models.Index(fields=['-created_at', '-id'], name='consultation_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+TEXT_FIELDS = ('raw_transcription', 'generated_report', 'final_report')
+
+
+def copy_texts_to_content(apps, schema_editor):
+    Consultation = apps.get_model('api', 'Consultation')
+    ConsultationContent = apps.get_model('api', 'ConsultationContent')
+    batch = []
+    for row in Consultation.objects.values('id', *TEXT_FIELDS).iterator(chunk_size=1000):
+        batch.append(ConsultationContent(consultation_id=row.pop('id'), **row))
+        if len(batch) == 1000:
+            ConsultationContent.objects.bulk_create(batch)
+            batch = []
+    ConsultationContent.objects.bulk_create(batch)
+
+
+def copy_texts_back(apps, schema_editor):
+    Consultation = apps.get_model('api', 'Consultation')
+    ConsultationContent = apps.get_model('api', 'ConsultationContent')
+    for content in ConsultationContent.objects.iterator(chunk_size=1000):
+        Consultation.objects.filter(id=content.consultation_id).update(
+            **{field: getattr(content, field) for field in TEXT_FIELDS}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsultationContent',
+            fields=[
+                ('consultation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='content', serialize=False, to='api.consultation')),
+                ('raw_transcription', models.TextField(blank=True, verbose_name='Текст из аудио')),
+                ('generated_report', models.TextField(blank=True, verbose_name='AI структура (JSON)')),
+                ('final_report', models.TextField(blank=True, verbose_name='Финальный отчет')),
+            ],
+        ),
+        migrations.RunPython(copy_texts_to_content, copy_texts_back),
+        migrations.RemoveField(
+            model_name='consultation',
+            name='final_report',
+        ),
+        migrations.RemoveField(
+            model_name='consultation',
+            name='generated_report',
+        ),
+        migrations.RemoveField(
+            model_name='consultation',
+            name='raw_transcription',
+        ),
+    ]
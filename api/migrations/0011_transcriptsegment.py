@@ -0,0 +1,42 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def add_fulltext_index(apps, schema_editor):
+    # FULLTEXT есть только в MySQL; на других базах поиск идет через LIKE (api/segment_store.py)
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute('ALTER TABLE api_transcriptsegment ADD FULLTEXT INDEX segment_text_ft (text)')
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute('ALTER TABLE api_transcriptsegment DROP INDEX segment_text_ft')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_consultation_content'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscriptSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField(verbose_name='Номер сегмента')),
+                ('start', models.FloatField(verbose_name='Начало (сек)')),
+                ('end', models.FloatField(verbose_name='Конец (сек)')),
+                ('text', models.TextField()),
+                ('words', models.TextField(blank=True, verbose_name='Слова с таймкодами (JSON)')),
+                ('consultation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='api.consultation')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.organization')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('consultation', 'position'), name='segment_position_unique')],
+            },
+        ),
+        migrations.RunPython(add_fulltext_index, drop_fulltext_index),
+    ]
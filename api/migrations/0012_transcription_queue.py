@@ -0,0 +1,64 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def queue_waiting_consultations(apps, schema_editor):
+    """
+    Записи берутся только из очереди — ставим туда уже ждущие. Не зависит от настроек:
+    миграция одна для всех окружений, а режим можно сменить позже. Если у записи уже есть
+    задача в кластере Django Q, вторую запуск отсечет аренда (acquire()).
+    """
+    Consultation = apps.get_model('api', 'Consultation')
+    TranscriptionJob = apps.get_model('api', 'TranscriptionJob')
+    now = timezone.now()
+    TranscriptionJob.objects.bulk_create(
+        TranscriptionJob(consultation_id=consultation_id, organization_id=organization_id, enqueued_at=created_at or now)
+        for consultation_id, organization_id, created_at in Consultation.objects.filter(status='created')
+        .values_list('id', 'patient__organization_id', 'created_at').iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_transcriptsegment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='consultation',
+            name='is_urgent',
+            field=models.BooleanField(default=False, verbose_name='Срочно'),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='max_running_transcriptions',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Одновременных транскрибаций'),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='queue_limit',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Максимум записей в очереди'),
+        ),
+        migrations.CreateModel(
+            name='TranscriptionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('priority', models.PositiveSmallIntegerField(choices=[(0, 'Срочно'), (1, 'Короткая запись'), (2, 'Обычная')], default=2)),
+                ('duration', models.FloatField(blank=True, null=True, verbose_name='Длительность записи (сек)')),
+                ('status', models.CharField(choices=[('queued', 'В очереди'), ('running', 'Выполняется'), ('done', 'Готово'), ('error', 'Ошибка')], default='queued', max_length=20)),
+                ('enqueued_at', models.DateTimeField(verbose_name='Поставлена в очередь')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Отдана воркеру')),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('consultation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='queue_job', to='api.consultation')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.organization')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'organization'], name='transcription_job_active_idx'), models.Index(fields=['organization', 'started_at'], name='transcription_job_wait_idx')],
+            },
+        ),
+        migrations.RunPython(queue_waiting_consultations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_transcription_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transcriptionjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Попыток'),
+        ),
+        migrations.AddField(
+            model_name='transcriptionjob',
+            name='lease_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Аренда до'),
+        ),
+        migrations.AddField(
+            model_name='transcriptionjob',
+            name='owner',
+            field=models.CharField(blank=True, max_length=100, verbose_name='Воркер'),
+        ),
+        migrations.AddField(
+            model_name='transcriptionjob',
+            name='stage',
+            field=models.CharField(blank=True, choices=[('', 'Не начата'), ('transcribed', 'Текст распознан'), ('reported', 'Отчет сформирован')], default='', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='transcriptionjob',
+            index=models.Index(fields=['status', 'lease_until'], name='transcription_job_lease_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_transcription_job_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('transcription', 'Транскрибация и отчет'), ('pdf', 'PDF-заключение')], max_length=20)),
+                ('ok', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('duration', models.FloatField(verbose_name='Длительность прогона (сек)')),
+                ('audio_seconds', models.FloatField(blank=True, null=True, verbose_name='Длительность аудио (сек)')),
+                ('rtf', models.FloatField(blank=True, null=True)),
+                ('queue_wait', models.FloatField(blank=True, null=True, verbose_name='Ожидание в очереди (сек)')),
+                ('peak_rss_bytes', models.BigIntegerField(blank=True, null=True, verbose_name='Пик памяти процесса')),
+                ('spans', models.TextField(blank=True, verbose_name='Время этапов (JSON)')),
+                ('counters', models.TextField(blank=True, verbose_name='Счетчики (JSON)')),
+                ('consultation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='api.consultation')),
+            ],
+        ),
+    ]
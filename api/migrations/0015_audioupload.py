@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_pipelinerun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudioUpload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_urgent', models.BooleanField(default=False, verbose_name='Срочно')),
+                ('audio_file', models.CharField(max_length=255, verbose_name='Файл в хранилище')),
+                ('length', models.PositiveBigIntegerField(verbose_name='Размер файла (байт)')),
+                ('offset', models.PositiveBigIntegerField(default=0, verbose_name='Получено (байт)')),
+                ('codec', models.CharField(blank=True, max_length=32, verbose_name='Аудиокодек')),
+                ('duration', models.FloatField(blank=True, null=True, verbose_name='Длительность (сек)')),
+                ('status', models.CharField(choices=[('uploading', 'Загружается'), ('complete', 'Загружено'), ('rejected', 'Отклонено')], default='uploading', max_length=20)),
+                ('error', models.TextField(blank=True)),
+                ('lock_owner', models.CharField(blank=True, max_length=64)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('consultation', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload', to='api.consultation')),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.patient')),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_audioupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReprocessJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filters', models.TextField(blank=True, verbose_name='Фильтры (JSON)')),
+                ('model_name', models.CharField(max_length=50)),
+                ('backend', models.CharField(blank=True, max_length=30)),
+                ('force', models.BooleanField(default=False)),
+                ('consultation_ids', models.TextField(verbose_name='Консультации (JSON)')),
+                ('batches', models.TextField(default='[]', verbose_name='Пачки (JSON)')),
+                ('leases', models.TextField(default='{}', verbose_name='Пачки в работе (JSON)')),
+                ('batch_size', models.PositiveIntegerField(default=20)),
+                ('parallelism', models.PositiveIntegerField(default=1)),
+                ('status', models.CharField(choices=[('queued', 'В очереди'), ('running', 'Выполняется'), ('ready', 'Готово'), ('error', 'Ошибка')], default='queued', max_length=20)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('cursor', models.PositiveIntegerField(default=0)),
+                ('done', models.PositiveIntegerField(default=0)),
+                ('skipped', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('audio_seconds', models.FloatField(default=0, verbose_name='Распознано аудио (сек)')),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='consultationcontent',
+            name='report_version',
+            field=models.CharField(blank=True, max_length=16, verbose_name='Версия правил отчета'),
+        ),
+        migrations.AddField(
+            model_name='consultationcontent',
+            name='transcription_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='consultationcontent',
+            name='transcription_model',
+            field=models.CharField(blank=True, max_length=50, verbose_name='Модель транскрибации'),
+        ),
+    ]
@@ -7,6 +7,11 @@ class Organization(models.Model):
     name = models.CharField(max_length=255, verbose_name="Название клиники")
     address = models.TextField(blank=True, verbose_name="Адрес")
 
+    # Лимиты очереди транскрибации (api/transcription_queue.py); пусто — значения из настроек
+    max_running_transcriptions = models.PositiveSmallIntegerField(
+        null=True, blank=True, verbose_name="Одновременных транскрибаций")
+    queue_limit = models.PositiveIntegerField(null=True, blank=True, verbose_name="Максимум записей в очереди")
+
     def __str__(self):
         return self.name
 
@@ -45,6 +50,14 @@ class Patient(models.Model):
     birth_date = models.DateField(verbose_name="Дата рождения")
     organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            # Поиск по фамилии (админка, поиск консультаций по пациенту)
+            models.Index(fields=['last_name', 'first_name'], name='patient_name_idx'),
+            # Список пациентов клиники по алфавиту
+            models.Index(fields=['organization', 'last_name'], name='patient_org_name_idx'),
+        ]
+
     def __str__(self):
         return f"{self.last_name} {self.first_name}"
 
@@ -52,7 +65,10 @@ class Patient(models.Model):
 class Consultation(models.Model):
     STATUS_CHOICES = (
         ('created', 'Создано'),
+        ('recording', 'Идет запись (живая транскрибация)'),
         ('processing', 'Обработка (Транскрибация)'),
+        ('draft', 'Черновик готов (уточняется)'),
+        ('refined', 'Текст уточнен'),
         ('generating', 'Генерация отчета'),
         ('ready', 'Готово'),
         ('error', 'Ошибка'),
@@ -63,6 +79,58 @@ class Consultation(models.Model):
 
     audio_file = models.FileField(upload_to='consultations/audio/')
 
+    # Тексты (транскрибация, отчеты) — в ConsultationContent: строка приема остается маленькой
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='created')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # Срочный прием обрабатывается раньше остальных, в том числе других клиник
+    is_urgent = models.BooleanField(default=False, verbose_name="Срочно")
+
+    # SHA-256 содержимого аудио: одинаковые файлы = один и тот же хэш
+    audio_hash = models.CharField(max_length=64, blank=True, db_index=True, verbose_name="Хэш аудио")
+
+    audio_file = models.FileField(
+        upload_to='consultations/audio/',
+        # Разрешаем форматы: mp3, wav (обычные файлы), ogg, webm (запись с браузера), m4a (айфон)
+        validators=[FileExtensionValidator(allowed_extensions=['mp3', 'wav', 'ogg', 'webm', 'm4a'])]
+    )
+
+    class Meta:
+        indexes = [
+            # Ключ постраничного вывода списка (api/pagination.py)
+            models.Index(fields=['-created_at', '-id'], name='consultation_created_id_idx'),
+            # Планировщик ищет status='created' по порядку поступления, админка фильтрует по статусу
+            models.Index(fields=['status', 'created_at'], name='consultation_status_idx'),
+            # Приемы конкретного врача, новые сверху (фильтр админки, выгрузка)
+            models.Index(fields=['doctor', '-created_at'], name='consultation_doctor_idx'),
+        ]
+
+    def __str__(self):
+        return f"Прием {self.patient} - {self.created_at.strftime('%Y-%m-%d')}"
+
+    def get_content(self):
+        """Тексты приема; строки может не быть у записей, созданных в обход save()."""
+        try:
+            return self.content
+        except ConsultationContent.DoesNotExist:
+            self.content, _ = ConsultationContent.objects.get_or_create(consultation=self)
+            return self.content
+
+    def set_status(self, status):
+        """Смена статуса — UPDATE одной колонки, тексты не перезаписываются."""
+        self.status = status
+        self.save(update_fields=['status'])
+
+
+class ConsultationContent(models.Model):
+    """
+    Большие тексты приема. Отдельная таблица: смена статуса не переписывает
+    транскрипт и отчеты, а список и админка не читают их без надобности.
+    """
+    consultation = models.OneToOneField(Consultation, on_delete=models.CASCADE, primary_key=True,
+                                        related_name='content')
+
     # Результат Whisper
     raw_transcription = models.TextField(blank=True, verbose_name="Текст из аудио")
 
@@ -72,14 +140,247 @@ class Consultation(models.Model):
     # Финальный текст после правок врача
     final_report = models.TextField(blank=True, verbose_name="Финальный отчет")
 
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='created')
+    # Чем получены тексты: manage.py reprocess пропускает приемы, у которых ничего не поменялось
+    transcription_model = models.CharField(max_length=50, blank=True, verbose_name="Модель транскрибации")
+    # Ключ кэша транскрибаций: хэш аудио + модель + параметры распознавания
+    transcription_key = models.CharField(max_length=64, blank=True)
+    report_version = models.CharField(max_length=16, blank=True, verbose_name="Версия правил отчета")
+
+
+class TranscriptionCache(models.Model):
+    """
+    Кэш результатов Whisper по содержимому аудио.
+    Ключ = хэш файла + модель + параметры распознавания.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    audio_hash = models.CharField(max_length=64, db_index=True)
+    model_name = models.CharField(max_length=50)
+    options = models.TextField(blank=True, verbose_name="Параметры распознавания (JSON)")
+
+    text = models.TextField(blank=True, verbose_name="Текст из аудио")
+    segments = models.TextField(blank=True, verbose_name="Сегменты (JSON)")
+    size_bytes = models.PositiveIntegerField(default=0)
+
+    hits = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True, db_index=True)
 
-    audio_file = models.FileField(
-        upload_to='consultations/audio/',
-        # Разрешаем форматы: mp3, wav (обычные файлы), ogg, webm (запись с браузера), m4a (айфон)
-        validators=[FileExtensionValidator(allowed_extensions=['mp3', 'wav', 'ogg', 'webm', 'm4a'])]
+    def __str__(self):
+        return f"{self.model_name}: {self.audio_hash[:12]}"
+
+
+class ConsultationEvent(models.Model):
+    """
+    События конвейера обработки (статус, прогресс, распознанные сегменты).
+    Воркер пишет, а SSE-поток /api/consultations/<id>/events/ отдаёт их клиенту.
+    """
+    KIND_CHOICES = (
+        ('status', 'Смена статуса'),
+        ('progress', 'Прогресс'),
+        ('segments', 'Распознанные сегменты'),
+    )
+    consultation = models.ForeignKey(Consultation, on_delete=models.CASCADE, related_name='events')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    payload = models.TextField(blank=True, verbose_name="Данные (JSON)")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class LiveSession(models.Model):
+    """
+    Состояние живой транскрибации во время приема.
+    Подтвержденный текст сразу пишется в ConsultationContent.raw_transcription,
+    здесь — граница подтвержденного и последняя гипотеза для сравнения.
+    tick_owner/tick_until — аренда шага распознавания (api/live.py): шаги не идут параллельно.
+    """
+    consultation = models.OneToOneField(Consultation, on_delete=models.CASCADE, related_name='live_session')
+    committed_seconds = models.FloatField(default=0, verbose_name="Подтверждено до (сек)")
+    hypothesis = models.TextField(blank=True, verbose_name="Неподтвержденные сегменты (JSON)")
+    tick_pending = models.BooleanField(default=False)
+    tick_owner = models.CharField(max_length=64, blank=True)
+    tick_until = models.DateTimeField(null=True, blank=True)
+    finished = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class ExportJob(models.Model):
+    """
+    Фоновая выгрузка PDF-заключений в ZIP (для больших периодов).
+    Идет пачками через очередь задач; last_id — докуда дошли, чтобы продолжить после сбоя.
+    """
+    STATUS_CHOICES = (
+        ('queued', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('ready', 'Готово'),
+        ('error', 'Ошибка'),
     )
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    filters = models.TextField(blank=True, verbose_name="Фильтры (JSON)")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    last_id = models.PositiveIntegerField(default=0, verbose_name="Последняя выгруженная консультация")
+    archive = models.CharField(max_length=255, blank=True, verbose_name="Путь к ZIP")
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class ReprocessJob(models.Model):
+    """
+    Массовая переобработка старых приемов (manage.py reprocess, api/reprocessing.py).
+    Пачки до batch_size консультаций разбирают parallelism цепочек задач очереди;
+    cursor — сколько пачек уже роздано, leases — пачки в работе с арендой (как у TranscriptionJob).
+    """
+    STATUS_CHOICES = (
+        ('queued', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('ready', 'Готово'),
+        ('error', 'Ошибка'),
+    )
+    filters = models.TextField(blank=True, verbose_name="Фильтры (JSON)")
+    model_name = models.CharField(max_length=50)
+    backend = models.CharField(max_length=30, blank=True)
+    force = models.BooleanField(default=False)
+    consultation_ids = models.TextField(verbose_name="Консультации (JSON)")
+    batches = models.TextField(default='[]', verbose_name="Пачки (JSON)")
+    leases = models.TextField(default='{}', verbose_name="Пачки в работе (JSON)")
+    batch_size = models.PositiveIntegerField(default=20)
+    parallelism = models.PositiveIntegerField(default=1)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    total = models.PositiveIntegerField(default=0)
+    cursor = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    audio_seconds = models.FloatField(default=0, verbose_name="Распознано аудио (сек)")
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class AudioUpload(models.Model):
+    """
+    Загрузка записи по частям (api/uploads.py): файл растет кусками прямо на диске,
+    оборванная загрузка продолжается с offset. Консультация создается, только когда
+    пришел последний кусок и запись прошла проверку.
+    lock_owner/locked_until — аренда записи в файл: два PATCH не допишут кусок одновременно.
+    """
+    STATUS_CHOICES = (
+        ('uploading', 'Загружается'),
+        ('complete', 'Загружено'),
+        ('rejected', 'Отклонено'),
+    )
+    doctor = models.ForeignKey(User, on_delete=models.CASCADE)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+    is_urgent = models.BooleanField(default=False, verbose_name="Срочно")
+    audio_file = models.CharField(max_length=255, verbose_name="Файл в хранилище")
+    length = models.PositiveBigIntegerField(verbose_name="Размер файла (байт)")
+    offset = models.PositiveBigIntegerField(default=0, verbose_name="Получено (байт)")
+    # Заполняются ffprobe, как только пришла шапка файла
+    codec = models.CharField(max_length=32, blank=True, verbose_name="Аудиокодек")
+    duration = models.FloatField(null=True, blank=True, verbose_name="Длительность (сек)")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading')
+    error = models.TextField(blank=True)
+    consultation = models.OneToOneField(
+        Consultation, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload',
+    )
+    lock_owner = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class TranscriptSegment(models.Model):
+    """
+    Фраза транскрипта с таймкодами: по ней ищем и переходим к нужному месту записи.
+    На MySQL по text построен FULLTEXT-индекс (миграция 0011).
+    """
+    consultation = models.ForeignKey(Consultation, on_delete=models.CASCADE, related_name='segments')
+    # Копия patient.organization: поиск всегда идет в пределах одной клиники, без JOIN
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    position = models.PositiveIntegerField(verbose_name="Номер сегмента")
+    start = models.FloatField(verbose_name="Начало (сек)")
+    end = models.FloatField(verbose_name="Конец (сек)")
+    text = models.TextField()
+    # [[начало, конец, слово], ...] — если Whisper запускали с word_timestamps
+    words = models.TextField(blank=True, verbose_name="Слова с таймкодами (JSON)")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['consultation', 'position'], name='segment_position_unique'),
+        ]
+
+
+class TranscriptionJob(models.Model):
+    """
+    Место консультации в очереди транскрибации (api/transcription_queue.py).
+    В Django Q задача попадает, только когда очередь выделила ей слот.
+    """
+    PRIORITY_CHOICES = (
+        (0, 'Срочно'),
+        (1, 'Короткая запись'),
+        (2, 'Обычная'),
+    )
+    STATUS_CHOICES = (
+        ('queued', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('done', 'Готово'),
+        ('error', 'Ошибка'),
+    )
+    # Пройденные этапы: повтор задачи продолжает со следующего, а не с начала
+    STAGE_CHOICES = (
+        ('', 'Не начата'),
+        ('transcribed', 'Текст распознан'),
+        ('reported', 'Отчет сформирован'),
+    )
+    consultation = models.OneToOneField(Consultation, on_delete=models.CASCADE, related_name='queue_job')
+    # Копия patient.organization: очередь делится по клиникам без JOIN
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
+    priority = models.PositiveSmallIntegerField(choices=PRIORITY_CHOICES, default=2)
+    duration = models.FloatField(null=True, blank=True, verbose_name="Длительность записи (сек)")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    enqueued_at = models.DateTimeField(verbose_name="Поставлена в очередь")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Отдана воркеру")
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    stage = models.CharField(max_length=20, choices=STAGE_CHOICES, blank=True, default='')
+    # Аренда: кто обрабатывает задачу и до какого времени. Истекла — задачу заберет reap()
+    owner = models.CharField(max_length=100, blank=True, verbose_name="Воркер")
+    lease_until = models.DateTimeField(null=True, blank=True, verbose_name="Аренда до")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="Попыток")
+
+    class Meta:
+        indexes = [
+            # Выборка активных задач при раздаче слотов
+            models.Index(fields=['status', 'organization'], name='transcription_job_active_idx'),
+            # Поиск задач с истекшей арендой
+            models.Index(fields=['status', 'lease_until'], name='transcription_job_lease_idx'),
+            # Время ожидания за последний час (метрики)
+            models.Index(fields=['organization', 'started_at'], name='transcription_job_wait_idx'),
+        ]
 
     def __str__(self):
-        return f"Прием {self.patient} - {self.created_at.strftime('%Y-%m-%d')}"
\ No newline at end of file
+        return f"{self.consultation_id}: {self.status}"
+
+
+class PipelineRun(models.Model):
+    """
+    Метрики одного прогона обработки (api/metrics.py): время этапов, длительность аудио,
+    RTF, ожидание в очереди, пик памяти воркера. Из них собирается /api/metrics/.
+    """
+    KIND_CHOICES = (
+        ('transcription', 'Транскрибация и отчет'),
+        ('pdf', 'PDF-заключение'),
+    )
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    consultation = models.ForeignKey(Consultation, on_delete=models.SET_NULL, null=True, blank=True)
+    ok = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    duration = models.FloatField(verbose_name="Длительность прогона (сек)")
+    audio_seconds = models.FloatField(null=True, blank=True, verbose_name="Длительность аудио (сек)")
+    # Real-time factor: время распознавания / длительность аудио (меньше 1 — быстрее реального времени)
+    rtf = models.FloatField(null=True, blank=True)
+    queue_wait = models.FloatField(null=True, blank=True, verbose_name="Ожидание в очереди (сек)")
+    peak_rss_bytes = models.BigIntegerField(null=True, blank=True, verbose_name="Пик памяти процесса")
+    spans = models.TextField(blank=True, verbose_name="Время этапов (JSON)")
+    counters = models.TextField(blank=True, verbose_name="Счетчики (JSON)")
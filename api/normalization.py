@@ -0,0 +1,276 @@
+"""
+Нормализация записи: один раз после загрузки приводим ее к 16 кГц моно.
+
+Раньше каждый прогон Whisper (и каждый повтор задачи) заново декодировал исходный
+mp3/m4a/webm через ffmpeg. Теперь первое распознавание записи (промах кэша транскрибаций)
+декодирует файл один раз и кладет рядом (MEDIA_ROOT/consultations/normalized/<хэш аудио>.*):
+- .npy — PCM int16 для конвейера, без тишины в начале и конце, громкость выровнена.
+  Следующие этапы и повторы открывают его через mmap, без ffmpeg; после отчета удаляется
+  (AUDIO_KEEP_PCM=True — оставить);
+- .opus — архивная копия (вся запись, с выровненной громкостью) в несколько раз меньше
+  исходника, пишется отдельной задачей после отчета; при AUDIO_KEEP_ORIGINAL=False
+  заменяет исходный файл консультации;
+- .json — смещение обрезки, длительность, усиление.
+
+Таймкоды распознанного по обрезанному PCM сдвигаются на offset обратно — сегменты
+и ссылки #t= указывают в исходную запись. Имя по хэшу: одинаковые файлы нормализуем один раз.
+Потоковый режим (WHISPER_STREAMING) читает исходник окнами и PCM не делает: целиком запись
+в памяти не держим, Opus-копия пишется с усилением из готовых метаданных или без него.
+"""
+import json
+import os
+import subprocess
+
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from . import chunking, metrics
+from .chunking import SAMPLE_RATE, shift_segment
+from .models import Consultation, TranscriptionJob
+
+NORMALIZED_DIR = 'consultations/normalized'
+FRAME_SECONDS = 0.03
+# Больше не усиливаем: тихая запись с шумом станет просто громким шумом
+MAX_GAIN_DB = 30.0
+# Уровень речи — этот перцентиль громкости кадров: редкий кашель или щелчок его не сдвигает
+SPEECH_PERCENTILE = 95
+PEAK_LIMIT = 0.99
+
+
+def _base(audio_hash):
+    return os.path.join(settings.MEDIA_ROOT, NORMALIZED_DIR, audio_hash)
+
+
+def pcm_path(audio_hash):
+    return _base(audio_hash) + '.npy'
+
+
+def opus_name(audio_hash):
+    """Имя архивной копии в хранилище (как у FileField консультации)."""
+    return f'{NORMALIZED_DIR}/{audio_hash}.opus'
+
+
+def _frame_db(audio, sr=SAMPLE_RATE):
+    frame = int(sr * FRAME_SECONDS)
+    n_frames = len(audio) // frame
+    frames = audio[:n_frames * frame].reshape(n_frames, frame)
+    return frame, 20 * np.log10(np.sqrt(np.mean(frames ** 2, axis=1)) + 1e-10)
+
+
+def silence_threshold(db):
+    """
+    Порог тишины по громкости кадров db: AUDIO_TRIM_THRESHOLD_DB, а для тихой записи
+    (телефон далеко) — на AUDIO_TRIM_RANGE_DB ниже уровня ее речи, иначе обрежем саму речь.
+    """
+    if not len(db):
+        return settings.AUDIO_TRIM_THRESHOLD_DB
+    speech_db = float(np.percentile(db, SPEECH_PERCENTILE))
+    return min(settings.AUDIO_TRIM_THRESHOLD_DB, speech_db - settings.AUDIO_TRIM_RANGE_DB)
+
+
+def trim_bounds(audio, sr=SAMPLE_RATE):
+    """Границы без тишины в начале и конце [start, end) с запасом AUDIO_TRIM_PADDING секунд."""
+    frame, db = _frame_db(audio, sr)
+    voiced = np.flatnonzero(db > silence_threshold(db))
+    if len(voiced) == 0:
+        # Сплошная тишина (до очереди такие записи обычно не доходят) — не режем
+        return 0, len(audio)
+    padding = int(settings.AUDIO_TRIM_PADDING * sr)
+    start = max(0, voiced[0] * frame - padding)
+    end = min(len(audio), (voiced[-1] + 1) * frame + padding)
+    return start, end
+
+
+def loudness_gain(audio, sr=SAMPLE_RATE):
+    """
+    Линейное усиление до AUDIO_TARGET_DBFS по громкости речи (кадры выше порога тишины),
+    не выше MAX_GAIN_DB и без клиппинга пиков. Форму сигнала не меняем (компрессия искажает речь для Whisper).
+    """
+    if not len(audio):
+        return 1.0
+    _frame, db = _frame_db(audio, sr)
+    voiced = db[db > silence_threshold(db)]
+    if not len(voiced):
+        return 1.0
+    # Средняя мощность речевых кадров, а не всей записи: паузы не тянут уровень вниз
+    speech_db = 10 * np.log10(np.mean(10 ** (voiced / 10)))
+    gain_db = min(settings.AUDIO_TARGET_DBFS - speech_db, MAX_GAIN_DB)
+    peak = float(np.max(np.abs(audio)))
+    gain = 10 ** (gain_db / 20)
+    if peak > 0:
+        gain = min(gain, PEAK_LIMIT / peak)
+    return float(gain)
+
+
+def _to_pcm16(audio):
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def _encode_opus(source, path, gain_db):
+    """Исходник -> Opus (ogg) 16 кГц моно с усилением gain_db. False — ffmpeg не справился (нет libopus)."""
+    tmp_path = path + '.tmp'
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-y', '-i', source,
+             '-vn', '-ac', '1', '-ar', str(SAMPLE_RATE), '-af', f'volume={gain_db}dB',
+             '-c:a', 'libopus', '-b:a', settings.AUDIO_OPUS_BITRATE, '-application', 'voip',
+             '-f', 'ogg', tmp_path],
+            capture_output=True, timeout=3600,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"⚠️ [Normalize] Opus не записан: {e}")
+        return False
+    if result.returncode != 0:
+        print(f"⚠️ [Normalize] Opus не записан: {result.stderr.decode(errors='replace').strip()}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+def read_meta(audio_hash):
+    try:
+        with open(_base(audio_hash) + '.json', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if os.path.exists(pcm_path(audio_hash)) else None
+
+
+def normalize(consultation):
+    """
+    Декодирует запись один раз и сохраняет нормализованные копии. Уже сделано
+    (та же запись загружалась раньше или повтор задачи) — просто возвращает метаданные.
+    """
+    meta = read_meta(consultation.audio_hash)
+    if meta is not None:
+        return meta
+
+    with metrics.span('normalize'):
+        audio = chunking.decode_audio(consultation.audio_file.path)
+        source_samples = len(audio)
+        start, end = trim_bounds(audio)
+        gain = loudness_gain(audio[start:end])
+        pcm = _to_pcm16(audio[start:end] * gain)
+        del audio
+
+        base = _base(consultation.audio_hash)
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        # np.save сам добавит .npy к имени без него — пишем через открытый файл
+        with open(pcm_path(consultation.audio_hash) + '.tmp', 'wb') as f:
+            np.save(f, pcm)
+        os.replace(pcm_path(consultation.audio_hash) + '.tmp', pcm_path(consultation.audio_hash))
+
+        meta = {
+            'sample_rate': SAMPLE_RATE,
+            'offset': round(start / SAMPLE_RATE, 3),
+            'duration': round((end - start) / SAMPLE_RATE, 3),
+            'source_duration': round(source_samples / SAMPLE_RATE, 3),
+            'gain_db': round(20 * float(np.log10(gain)), 2),
+        }
+        with open(base + '.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(base + '.json.tmp', base + '.json')  # метаданные последними: есть .json — готово всё
+
+    print(
+        f"🎚️ [Normalize] Консультация {consultation.id}: {meta['source_duration']:.1f} c -> {meta['duration']:.1f} c "
+        f"(обрезано в начале {meta['offset']:.1f} c), усиление {meta['gain_db']:+.1f} дБ"
+    )
+    return meta
+
+
+def archive(consultation):
+    """
+    Opus-копия всей записи — без обрезки, чтобы таймкоды совпадали с исходником, с тем же
+    усилением, что у PCM. Кодирование небыстрое, поэтому идет отдельной задачей после отчета.
+    Копия этой записи уже есть (та же запись загружалась раньше) — ничего не декодируем.
+    При AUDIO_KEEP_ORIGINAL=False копия заменяет исходный файл.
+    """
+    name = opus_name(consultation.audio_hash)
+    try:
+        if not default_storage.exists(name):
+            if settings.WHISPER_STREAMING:
+                # Ради усиления запись целиком не декодируем
+                gain_db = (read_meta(consultation.audio_hash) or {}).get('gain_db', 0.0)
+            else:
+                gain_db = normalize(consultation)['gain_db']
+            if not _encode_opus(consultation.audio_file.path, default_storage.path(name), gain_db):
+                return False
+            print(f"🗜️ [Normalize] Консультация {consultation.id}: Opus-копия {name} "
+                  f"({default_storage.size(name) // 1024} КБ)")
+        if not settings.AUDIO_KEEP_ORIGINAL:
+            replace_original(consultation)
+        return True
+    finally:
+        # Конвейер прошел: PCM в разы больше сжатого исходника, а повтор создаст его заново за одно декодирование.
+        # Файлы общие для всех консультаций с этой записью — пока другая в очереди или в работе, не трогаем
+        if not settings.AUDIO_KEEP_PCM and not pcm_in_use(consultation.audio_hash, consultation.id):
+            discard_pcm(consultation.audio_hash)
+
+
+def pcm_in_use(audio_hash, consultation_id=None):
+    """Ждет ли эту запись (кроме consultation_id) транскрибация: задача в очереди или у воркера."""
+    return (
+        TranscriptionJob.objects.filter(consultation__audio_hash=audio_hash, status__in=('queued', 'running'))
+        .exclude(consultation_id=consultation_id).exists()
+    )
+
+
+def discard_pcm(audio_hash):
+    for suffix in ('.npy', '.json'):
+        try:
+            os.remove(_base(audio_hash) + suffix)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Windows не дает удалить файл, открытый через mmap другим потоком
+            print(f"⚠️ [Normalize] PCM {audio_hash[:12]} не удален: {e}")
+
+
+def replace_original(consultation):
+    """Консультации с этой записью переходят на Opus-копию, исходник удаляется."""
+    archive = opus_name(consultation.audio_hash)
+    same_audio = Consultation.objects.filter(audio_hash=consultation.audio_hash).exclude(audio_file=archive)
+    originals = set(same_audio.values_list('audio_file', flat=True))
+    same_audio.update(audio_file=archive)
+    consultation.audio_file.name = archive
+    for original in originals:
+        if original and not Consultation.objects.filter(audio_file=original).exists():
+            default_storage.delete(original)
+            print(f"🗜️ [Normalize] Исходник {original} заменен на {archive}")
+
+
+def load(consultation):
+    """
+    (PCM int16 через mmap, смещение обрезки в секундах). Во float32 его переводят потребители
+    по кускам (chunking.as_float32) — полную копию записи в памяти не делаем.
+    Нет нормализованной копии (удалили, старая запись) — сначала делаем ее.
+    """
+    meta = normalize(consultation)
+    try:
+        pcm = np.load(pcm_path(consultation.audio_hash), mmap_mode='r')
+    except FileNotFoundError:
+        # Между normalize() и чтением копию удалил archive() консультации с той же записью
+        meta = normalize(consultation)
+        pcm = np.load(pcm_path(consultation.audio_hash), mmap_mode='r')
+    return pcm, meta['offset']
+
+
+def decoded_audio(consultation):
+    """
+    Запись для Whisper и сдвиг ее таймкодов относительно исходного файла.
+    При AUDIO_NORMALIZE — готовый PCM int16 (mmap), без ffmpeg и без тишины по краям; иначе — float32 от ffmpeg.
+    """
+    if settings.AUDIO_NORMALIZE:
+        return load(consultation)
+    return chunking.decode_audio(consultation.audio_file.path), 0.0
+
+
+def shift_result(result, offset):
+    """Таймкоды распознанного по обрезанной записи -> таймкоды исходной."""
+    if not offset:
+        return result
+    return dict(result, segments=[shift_segment(seg, offset) for seg in result['segments']])
+
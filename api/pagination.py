@@ -0,0 +1,12 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ConsultationCursorPagination(CursorPagination):
+    """
+    Постраничный вывод по ключу (created_at, id) вместо OFFSET:
+    каждая страница — один запрос по индексу, сколько бы записей ни было до нее.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
@@ -0,0 +1,132 @@
+"""
+PDF-заключения с кэшем на диске.
+
+xhtml2pdf тратит сотни миллисекунд CPU на каждый рендер, а один и тот же отчет
+скачивают много раз. Готовый PDF лежит в PDF_CACHE_DIR/<id>/<хэш>.pdf, где хэш —
+от данных для шаблона (отчет, врач, пациент, дата) и содержимого report.html.
+Поменялся отчет или шаблон — поменялся хэш, старый файл удаляется при следующем рендере.
+Хэш же отдается как ETag.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.template.loader import get_template, render_to_string
+from xhtml2pdf import pisa
+
+from . import metrics
+
+TEMPLATE_NAME = 'report.html'
+
+_template_lock = threading.Lock()
+_template_version = (None, None)  # (mtime, хэш)
+
+
+class PdfRenderError(Exception):
+    pass
+
+
+def template_version():
+    """Хэш report.html; пересчитывается, только если файл изменился."""
+    global _template_version
+    path = get_template(TEMPLATE_NAME).origin.name
+    mtime = os.stat(path).st_mtime_ns
+    with _template_lock:
+        if _template_version[0] != mtime:
+            with open(path, 'rb') as f:
+                _template_version = (mtime, hashlib.sha256(f.read()).hexdigest()[:16])
+        return _template_version[1]
+
+
+def build_context(consultation):
+    """Данные для шаблона (парсим JSON от ИИ)."""
+    content = consultation.get_content()
+    try:
+        # Если в базе лежит текст JSON, превращаем его в словарь
+        if content.final_report:
+            report_data = json.loads(content.final_report)
+        else:
+            raise ValueError("Отчет пуст")
+    except (json.JSONDecodeError, ValueError, TypeError):
+        # Заглушка, если ИИ еще думает или произошла ошибка
+        report_data = {
+            "complaints": content.raw_transcription or "Транскрибация в процессе...",
+            "anamnesis": "Данные обрабатываются...",
+            "diagnosis": "Диагноз не сформирован",
+            "recommendations": "Ожидайте завершения анализа."
+        }
+
+    return {
+        'doctor': consultation.doctor.get_full_name() if consultation.doctor else "Дежурный врач",
+        'patient': f"{consultation.patient.last_name} {consultation.patient.first_name}",
+        'date': consultation.created_at.strftime("%d.%m.%Y"),
+        'report': report_data,
+        'report_id': consultation.id
+    }
+
+
+def content_hash(context):
+    payload = json.dumps(context, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(f"{template_version()}\n{payload}".encode('utf-8')).hexdigest()[:32]
+
+
+def _cache_dir(consultation_id):
+    return os.path.join(settings.PDF_CACHE_DIR, str(consultation_id))
+
+
+def render(context):
+    """HTML из шаблона -> PDF (байты)."""
+    html_string = render_to_string(TEMPLATE_NAME, context)
+    with tempfile.SpooledTemporaryFile() as buffer:
+        pisa_status = pisa.CreatePDF(html_string, dest=buffer)
+        if pisa_status.err:
+            raise PdfRenderError("Ошибка конвертации в PDF")
+        buffer.seek(0)
+        return buffer.read()
+
+
+def cached_path(consultation_id, etag):
+    path = os.path.join(_cache_dir(consultation_id), f"{etag}.pdf")
+    return path if os.path.exists(path) else None
+
+
+def store(consultation_id, context, etag=None):
+    """Рендерит PDF в кэш и удаляет устаревшие версии. Базу не трогает — можно звать из пула процессов."""
+    etag = etag or content_hash(context)
+    directory = _cache_dir(consultation_id)
+    path = os.path.join(directory, f"{etag}.pdf")
+
+    with metrics.span('pdf_render'):
+        pdf = render(context)
+    os.makedirs(directory, exist_ok=True)
+    # Пишем во временный файл и переименовываем: параллельный запрос не увидит половину PDF
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(pdf)
+    os.replace(tmp_path, path)
+
+    # Старые версии этого отчета больше не нужны
+    for name in os.listdir(directory):
+        if name.endswith('.pdf') and name != os.path.basename(path):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+    return path
+
+
+def get_or_render(consultation, context=None):
+    """
+    Путь к PDF и его ETag. Рендерим, только если актуальной версии еще нет на диске.
+    """
+    context = context or build_context(consultation)
+    etag = content_hash(context)
+    path = cached_path(consultation.id, etag) or store(consultation.id, context, etag)
+    return path, etag
+
+
+def is_cached(consultation):
+    return cached_path(consultation.id, content_hash(build_context(consultation))) is not None
@@ -0,0 +1,66 @@
+"""
+Публикация хода обработки консультации.
+
+Воркер Django Q и веб-процесс — разные процессы, поэтому события пишутся
+в маленькую таблицу ConsultationEvent. SSE-поток (api/events.py) читает
+только новые строки по id, а не перечитывает список консультаций целиком.
+"""
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import ConsultationEvent
+
+TERMINAL_STATUSES = ('ready', 'error')
+
+
+def emit(consultation_id, kind, **payload):
+    ConsultationEvent.objects.create(
+        consultation_id=consultation_id,
+        kind=kind,
+        payload=json.dumps(payload, ensure_ascii=False),
+    )
+
+
+def status(consultation_id, new_status, percent=None):
+    emit(consultation_id, 'status', status=new_status, percent=percent)
+    if new_status in TERMINAL_STATUSES:
+        prune()
+
+
+def progress(consultation_id, percent, **extra):
+    emit(consultation_id, 'progress', percent=round(percent, 1), **extra)
+
+
+def segments(consultation_id, new_segments):
+    if new_segments:
+        emit(consultation_id, 'segments', segments=[
+            {'start': round(seg['start'], 2), 'end': round(seg['end'], 2), 'text': seg['text']}
+            for seg in new_segments
+        ])
+
+
+def reporter(consultation_id, start=5.0, end=90.0, time_offset=0.0):
+    """
+    Колбэк для транскрибаторов: fraction (0..1 или None, если длина неизвестна)
+    переводится в проценты в диапазоне [start, end], сегменты уходят клиенту сразу.
+    time_offset — сколько секунд обрезано в начале записи (api/normalization.py).
+    """
+    def report(fraction, new_segments=(), **extra):
+        if time_offset:
+            new_segments = [dict(seg, start=seg['start'] + time_offset, end=seg['end'] + time_offset)
+                             for seg in new_segments]
+        segments(consultation_id, new_segments)
+        if fraction is not None:
+            progress(consultation_id, start + (end - start) * fraction, **extra)
+        elif extra:
+            emit(consultation_id, 'progress', percent=None, **extra)
+    return report
+
+
+def prune():
+    """Старые события больше не нужны: статус и так лежит в Consultation."""
+    border = timezone.now() - timedelta(hours=settings.PROGRESS_EVENTS_TTL_HOURS)
+    ConsultationEvent.objects.filter(created_at__lt=border).delete()
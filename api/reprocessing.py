@@ -0,0 +1,314 @@
+"""
+Массовая переобработка старых приемов после смены модели Whisper или правил отчета.
+
+Раньше старый прием обновлялся только повторной загрузкой записи — задача очереди на
+каждый. manage.py reprocess отбирает консультации и создает ReprocessJob: пачки до
+batch_size разбирают parallelism цепочек задач очереди (следующая пачка — новой задачей,
+как у выгрузок в api/exports.py). В пачке не больше одной записи, которую надо прогнать
+через Whisper, — задача укладывается в timeout воркера, как обычная транскрибация.
+Пачка выдается в аренду на TRANSCRIPTION_LEASE_SECONDS: задачу убили — аренда истекает,
+и пачку забирает следующая цепочка (после TRANSCRIPTION_MAX_ATTEMPTS попыток ее приемы
+считаются ошибкой). Все цепочки умерли — manage.py reprocess --resume.
+Для каждого приема сравниваем, чем получены его тексты
+(ConsultationContent.transcription_key и report_version), с текущей конфигурацией:
+- ничего не поменялось — пропускаем;
+- поменялись только правила — перестраиваем отчет по сохраненному тексту;
+- модель или параметры распознавания — распознаем заново по кэшу признаков
+  (api/feature_cache.py), если такого результата еще нет в кэше транскрибаций.
+Результаты пачки пишутся bulk_update: несколько запросов на пачку, а не на каждый прием.
+"""
+import json
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import (
+    ai_service, backends, feature_cache, metrics, normalization, rule_engine, segment_store, tasks, transcription_cache,
+    transcription_queue,
+)
+from .models import Consultation, ConsultationContent, PipelineRun, ReprocessJob, TranscriptionCache
+
+PLAN_SKIP = 'skip'
+PLAN_REPORT = 'report'
+PLAN_TRANSCRIBE = 'transcribe'
+
+# Приемы в очереди или у воркера не трогаем: их результат перезапишет конвейер
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+
+CONTENT_FIELDS = [
+    'raw_transcription', 'generated_report', 'final_report',
+    'transcription_model', 'transcription_key', 'report_version',
+]
+
+
+def plan(consultation, model_name, rules_version, force=False):
+    """Что нужно сделать с приемом: PLAN_SKIP, PLAN_REPORT или PLAN_TRANSCRIBE."""
+    content = consultation.get_content()
+    if force or not consultation.audio_hash:
+        return PLAN_TRANSCRIBE
+    key = transcription_cache.make_key(consultation.audio_hash, model_name, settings.WHISPER_DECODE_OPTIONS)
+    if content.transcription_key != key:
+        return PLAN_TRANSCRIBE
+    if content.report_version != rules_version:
+        return PLAN_REPORT
+    return PLAN_SKIP
+
+
+def transcribe(consultation, backend, force=False):
+    """
+    Распознавание записи движком backend: из кэша транскрибаций или по кэшу признаков.
+    Возвращает (результат, откуда он, сколько секунд аудио распознано).
+    """
+    tasks.ensure_audio_hash(consultation)
+    options = settings.WHISPER_DECODE_OPTIONS
+    if not force:
+        cached = transcription_cache.get(consultation.audio_hash, backend.label, options)
+        if cached is not None:
+            return cached, 'кэш транскрибаций', 0.0
+
+    n_mels = backend.model.dims.n_mels
+    hit = feature_cache.read_meta(consultation.audio_hash, n_mels) is not None
+    features, offset = feature_cache.load(consultation, n_mels)
+    result = normalization.shift_result(backend.transcribe_features(features, **options), offset)
+    transcription_cache.put(consultation.audio_hash, backend.label, options, result)
+    return result, 'признаки из кэша' if hit else 'признаки посчитаны', feature_cache.seconds(features)
+
+
+def split_batches(consultation_ids, batch_size, heavy=()):
+    """Пачки подряд по batch_size, но не больше одной записи из heavy (нужен Whisper) в пачке."""
+    heavy = set(heavy)
+    batches, batch, has_heavy = [], [], False
+    for consultation_id in consultation_ids:
+        if batch and (len(batch) >= batch_size or (consultation_id in heavy and has_heavy)):
+            batches.append(batch)
+            batch, has_heavy = [], False
+        batch.append(consultation_id)
+        has_heavy = has_heavy or consultation_id in heavy
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def create_job(consultation_ids, model_name, backend='', force=False, batch_size=None, parallelism=None,
+               filters=None, heavy=()):
+    """heavy — приемы, которые распознаются заново (estimate()['heavy']): по одному на пачку."""
+    batch_size = batch_size or settings.REPROCESS_BATCH_SIZE
+    return ReprocessJob.objects.create(
+        filters=json.dumps(filters or {}, ensure_ascii=False, default=str),
+        model_name=model_name,
+        backend=backend or '',
+        force=force,
+        consultation_ids=json.dumps(consultation_ids),
+        batches=json.dumps(split_batches(consultation_ids, batch_size, heavy)),
+        batch_size=batch_size,
+        parallelism=parallelism or settings.REPROCESS_PARALLELISM,
+        total=len(consultation_ids),
+    )
+
+
+def _close_if_finished(job, batches, leases):
+    """Все пачки розданы и ни одна не в работе — задача готова."""
+    if job.cursor >= len(batches) and not leases and job.status != 'error':
+        job.status = 'ready'
+
+
+def claim(job, owner):
+    """
+    Следующая пачка: (номер, id) или (None, []), если раздавать нечего. Сначала — пачки
+    с истекшей арендой (задачу убили), потом новые. Строку задачи блокируем на время
+    выбора: параллельные цепочки не возьмут одну пачку дважды.
+    """
+    now = time.time()
+    with transaction.atomic():
+        locked = ReprocessJob.objects.select_for_update().get(id=job.id)
+        batches = json.loads(locked.batches)
+        leases = json.loads(locked.leases)
+        before = (locked.leases, locked.status)
+        index = None
+        for key in sorted((key for key, lease in leases.items() if lease['until'] < now), key=int):
+            if leases[key]['attempts'] >= settings.TRANSCRIPTION_MAX_ATTEMPTS:
+                # Пачка раз за разом не укладывается в timeout — ее приемы в ошибки
+                print(f"❌ [Reprocess] Задача {job.id}: пачка {key} не закончена за "
+                      f"{leases[key]['attempts']} попыток, пропускаю")
+                locked.failed += len(batches[int(key)])
+                del leases[key]
+            elif index is None:
+                index = int(key)
+                print(f"♻️ [Reprocess] Задача {job.id}: аренда пачки {key} истекла, беру заново")
+        if index is None and locked.cursor < len(batches):
+            index = locked.cursor
+            locked.cursor += 1
+        if index is not None:
+            attempts = leases.get(str(index), {}).get('attempts', 0) + 1
+            leases[str(index)] = {'owner': owner, 'until': now + settings.TRANSCRIPTION_LEASE_SECONDS,
+                                  'attempts': attempts}
+            locked.status = 'running'
+        _close_if_finished(locked, batches, leases)
+        locked.leases = json.dumps(leases)
+        # Пустой заход цепочки не трогает updated_at: по нему видно, что работа стоит (is_stalled)
+        if (locked.leases, locked.status) != before:
+            locked.save(update_fields=['cursor', 'leases', 'failed', 'status', 'updated_at'])
+    return (None, []) if index is None else (index, batches[index])
+
+
+def complete(job, index, owner, done, skipped, failed, audio_seconds):
+    """
+    Пачка обработана: снимаем аренду и прибавляем счетчики. Аренду уже забрала другая цепочка
+    (эта задача шла дольше аренды) — счетчики прибавит та, результат записан одинаковый.
+    """
+    with transaction.atomic():
+        locked = ReprocessJob.objects.select_for_update().get(id=job.id)
+        batches = json.loads(locked.batches)
+        leases = json.loads(locked.leases)
+        if leases.get(str(index), {}).get('owner') != owner:
+            print(f"⚠️ [Reprocess] Задача {job.id}: пачка {index} уже у другой цепочки")
+            return False
+        del leases[str(index)]
+        locked.done += done
+        locked.skipped += skipped
+        locked.failed += failed
+        locked.audio_seconds += audio_seconds
+        locked.leases = json.dumps(leases)
+        _close_if_finished(locked, batches, leases)
+        locked.save(update_fields=['leases', 'done', 'skipped', 'failed', 'audio_seconds', 'status', 'updated_at'])
+    return True
+
+
+def process(job, ids):
+    """Пачка приемов. Возвращает (обновлено, пропущено, ошибок, секунд аудио)."""
+    backend = backends.get_backend(job.model_name, job.backend or None)
+    rules_version = rule_engine.rules_version()
+    consultations = list(
+        Consultation.objects.filter(id__in=ids).select_related('content')
+        .exclude(queue_job__status__in=ACTIVE_JOB_STATUSES)
+    )
+    # Удаленные за это время и попавшие в очередь — пропущены
+    skipped = len(ids) - len(consultations)
+    failed = 0
+    audio_seconds = 0.0
+    contents, segments, updated_ids = [], [], []
+
+    for consultation in consultations:
+        try:
+            action = plan(consultation, backend.label, rules_version, job.force)
+            if action == PLAN_SKIP:
+                skipped += 1
+                continue
+            content = consultation.get_content()
+            if action == PLAN_TRANSCRIBE:
+                result, source, seconds = transcribe(consultation, backend, job.force)
+                audio_seconds += seconds
+                content.raw_transcription = result['text']
+                tasks.mark_transcription(consultation, content, backend.label)
+                segments.append((consultation, result['segments']))
+                print(f"🔁 [Reprocess] Консультация {consultation.id}: распознано заново ({source})")
+            report = tasks.build_report(content.raw_transcription)
+            # Финальный отчет, который врач правил, не перезаписываем — обновится только AI-версия
+            if content.final_report == content.generated_report:
+                content.final_report = report
+            content.generated_report = report
+            content.report_version = rules_version
+        except Exception as e:
+            failed += 1
+            print(f"❌ [Reprocess] Консультация {consultation.id}: {e}")
+            continue
+        contents.append(content)
+        updated_ids.append(consultation.id)
+
+    # bulk_update не шлет post_save: PDF старых приемов перерендерятся при скачивании, а не все разом
+    with transaction.atomic():
+        segment_store.replace_many(segments)
+        ConsultationContent.objects.bulk_update(contents, CONTENT_FIELDS, batch_size=500)
+        Consultation.objects.filter(id__in=updated_ids).exclude(status='ready').update(status='ready')
+    return len(contents), skipped, failed, audio_seconds
+
+
+def run_batch(job):
+    """Одна пачка. False — раздавать больше нечего, цепочка задач заканчивается."""
+    owner = transcription_queue.worker_id()
+    index, ids = claim(job, owner)
+    if index is None:
+        return False
+    complete(job, index, owner, *process(job, ids))
+    return True
+
+
+def start_chains(job):
+    """Ставит в очередь цепочки пачек: не больше parallelism и не больше, чем осталось пачек."""
+    remaining = len(json.loads(job.batches)) - job.cursor + len(json.loads(job.leases))
+    for _ in range(max(1, min(job.parallelism, remaining))):
+        ai_service.async_task('api.tasks.reprocess_batch', job.id)
+
+
+def is_stalled(job):
+    """Давно никто не брал и не сдавал пачек: цепочки умерли вместе с задачами (или очередь стоит)."""
+    if job.status in ('ready', 'error'):
+        return False
+    return (timezone.now() - job.updated_at).total_seconds() > settings.TRANSCRIPTION_LEASE_SECONDS
+
+
+def recent_rtf():
+    """Медиана RTF последних транскрибаций (api/metrics.py); None — истории еще нет."""
+    values = sorted(
+        PipelineRun.objects.filter(kind='transcription', ok=True, rtf__isnull=False)
+        .order_by('-id').values_list('rtf', flat=True)[:200]
+    )
+    return metrics.percentile(values, 0.5) if values else None
+
+
+def estimate(consultations, model_name, rules_version, force=False):
+    """
+    План по выборке: сколько приемов пропустим, сколько только перестроим отчет, сколько
+    распознаем заново (и скольким хватит кэша транскрибаций), сколько секунд аудио;
+    ids — приемы, которым нужна работа (их и получит ReprocessJob), heavy — из них те,
+    что пойдут через Whisper (в create_job по одному на пачку).
+    """
+    options = settings.WHISPER_DECODE_OPTIONS
+    counts = {PLAN_SKIP: 0, PLAN_REPORT: 0, PLAN_TRANSCRIBE: 0}
+    pending_keys = {}
+    ids = []
+    known_seconds, unknown = 0.0, 0
+    # Длительность записи — из задачи очереди, загрузки по частям или по последнему сегменту
+    consultations = consultations.select_related('content').annotate(
+        known_duration=Coalesce('queue_job__duration', 'upload__duration', Max('segments__end')),
+    )
+    for consultation in consultations.iterator(chunk_size=500):
+        action = plan(consultation, model_name, rules_version, force)
+        counts[action] += 1
+        if action != PLAN_SKIP:
+            ids.append(consultation.id)
+        if action != PLAN_TRANSCRIBE:
+            continue
+        if consultation.audio_hash and not force:
+            pending_keys[transcription_cache.make_key(consultation.audio_hash, model_name, options)] = consultation
+        else:
+            pending_keys[consultation.id] = consultation
+
+    cached = set(
+        TranscriptionCache.objects
+        .filter(key__in=[key for key in pending_keys if isinstance(key, str)])
+        .values_list('key', flat=True)
+    )
+    to_transcribe = [consultation for key, consultation in pending_keys.items() if key not in cached]
+    for consultation in to_transcribe:
+        if consultation.known_duration is not None:
+            known_seconds += consultation.known_duration
+        else:
+            unknown += 1
+    # Длительность неизвестна (старые записи без задачи очереди и сегментов) — считаем по средней
+    known = len(to_transcribe) - unknown
+    audio_seconds = known_seconds + (known_seconds / known * unknown if known else 0.0)
+    return {
+        'skip': counts[PLAN_SKIP],
+        'report': counts[PLAN_REPORT],
+        'transcribe': counts[PLAN_TRANSCRIBE],
+        'cached': len(pending_keys) - len(to_transcribe),
+        'audio_seconds': audio_seconds,
+        'unknown_duration': unknown,
+        'ids': ids,
+        'heavy': [consultation.id for consultation in to_transcribe],
+    }
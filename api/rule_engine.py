@@ -0,0 +1,171 @@
+"""
+Клинические правила: ключевое слово/основа -> код МКБ-10, диагноз, рекомендации.
+
+Правила лежат в JSON-файле (CLINICAL_RULES_FILE) и компилируются в автомат
+Ахо-Корасик: все основы всех правил ищутся за один проход по тексту,
+а не отдельным поиском на каждое слово. Возвращаются все сработавшие правила
+с позициями совпадений и баллами, отсортированные по убыванию балла.
+Файл перечитывается при изменении (по mtime) — воркеры перезапускать не нужно.
+
+Формат файла:
+    {"version": 1, "rules": [{"id": "...", "icd10": "...", "diagnosis": "...",
+      "recommendations": "...", "keywords": ["основа", {"stem": "основа", "weight": 0.5}]}]}
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+
+
+def normalize(text):
+    """Нижний регистр и ё -> е. Длина строки сохраняется, чтобы позиции совпадали с исходником."""
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # Редкие символы (например, 'İ') при lower() превращаются в два
+        lowered = ''.join(ch.lower()[0] for ch in text)
+    return lowered.replace('ё', 'е')
+
+
+class Automaton:
+    """Автомат Ахо-Корасик по набору строк. payload — что вернуть при совпадении строки."""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+        for pattern, payload in patterns:
+            state = 0
+            for ch in pattern:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            self.output[state] += ((len(pattern), payload),)
+
+        # Суффиксные ссылки обходом в ширину; выходы наследуются по ним
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(ch, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+        self.alphabet = frozenset(ch for edges in self.goto for ch in edges)
+
+    def iter_matches(self, text):
+        """(начало, конец, payload) для всех вхождений, включая перекрывающиеся."""
+        goto, fail, output, alphabet = self.goto, self.fail, self.output, self.alphabet
+        state = 0
+        for index, ch in enumerate(text):
+            if ch not in alphabet:
+                # Символ не встречается ни в одной основе — сразу в корень
+                state = 0
+                continue
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for length, payload in output[state]:
+                yield index + 1 - length, index + 1, payload
+
+
+class RuleEngine:
+    def __init__(self, rules, version=None):
+        self.rules = rules
+        self.version = version
+        # Отпечаток содержимого правил: по нему manage.py reprocess понимает, что отчеты устарели
+        self.digest = hashlib.sha256(
+            json.dumps([version, rules], sort_keys=True, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()[:16]
+        patterns = []
+        for order, rule in enumerate(rules):
+            for keyword in rule.get('keywords', []):
+                if isinstance(keyword, str):
+                    keyword = {'stem': keyword}
+                stem = normalize(keyword['stem'])
+                if stem:
+                    patterns.append((stem, (order, keyword['stem'], float(keyword.get('weight', 1.0)))))
+        self.automaton = Automaton(patterns)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['rules'], data.get('version'))
+
+    def match(self, text):
+        """
+        Все сработавшие правила, лучшие первыми. Балл = сумма весов совпадений;
+        при равенстве выше то правило, что раньше в файле.
+        """
+        found = {}
+        for start, end, (order, keyword, weight) in self.automaton.iter_matches(normalize(text)):
+            finding = found.get(order)
+            if finding is None:
+                rule = self.rules[order]
+                finding = found[order] = {
+                    'rule': rule['id'],
+                    'icd10': rule.get('icd10', ''),
+                    'diagnosis': rule['diagnosis'],
+                    'recommendations': rule.get('recommendations', ''),
+                    'score': 0.0,
+                    'matches': [],
+                }
+            finding['score'] += weight
+            finding['matches'].append({'keyword': keyword, 'start': start, 'end': end, 'text': text[start:end]})
+
+        ordered = sorted(found.items(), key=lambda item: (-item[1]['score'], item[0]))
+        for _order, finding in ordered:
+            finding['score'] = round(finding['score'], 3)
+        return [finding for _order, finding in ordered]
+
+
+_lock = threading.Lock()
+_engine = None
+_loaded_mtime = None
+
+
+def get_engine():
+    """Движок по текущему файлу правил. Если файл поменялся — перекомпилируем."""
+    global _engine, _loaded_mtime
+    path = settings.CLINICAL_RULES_FILE
+    mtime = os.stat(path).st_mtime_ns
+    if _engine is not None and mtime == _loaded_mtime:
+        return _engine
+    with _lock:
+        if _engine is None or mtime != _loaded_mtime:
+            try:
+                engine = RuleEngine.from_file(path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                if _engine is None:
+                    raise
+                # Ошибка в новом файле не должна ломать отчеты — работаем по старым правилам
+                print(f"⚠️ [Rules] Не удалось перечитать {path}: {e}. Оставляю прежние правила")
+                _loaded_mtime = mtime
+                return _engine
+            _engine, _loaded_mtime = engine, mtime
+            print(f"📚 [Rules] Загружено правил: {len(engine.rules)} (версия {engine.version})")
+    return _engine
+
+
+def rules_version():
+    return get_engine().digest
+
+
+def analyze(text):
+    return get_engine().match(text)
+
+
+def format_diagnosis(finding):
+    return f"{finding['diagnosis']} ({finding['icd10']})" if finding['icd10'] else finding['diagnosis']
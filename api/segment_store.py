@@ -0,0 +1,116 @@
+"""
+Хранилище сегментов транскрипта и поиск по фразе.
+
+Whisper отдает сегменты с таймкодами — храним их построчно (TranscriptSegment),
+чтобы врач нашел фразу по всем приемам клиники и сразу перешел к этому месту
+записи, не скачивая и не перечитывая транскрипты. На MySQL поиск идет по
+FULLTEXT-индексу (MATCH ... AGAINST), на других базах — LIKE.
+Фраза, разорванная границей сегментов, не находится.
+"""
+import json
+import re
+
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+
+from .models import Patient, TranscriptSegment
+
+
+def normalize_words(text):
+    return re.findall(r'\w+', text.lower().replace('ё', 'е'))
+
+
+def _compact_words(words):
+    return json.dumps(
+        [[round(w['start'], 2), round(w['end'], 2), w['word'].strip()] for w in words],
+        ensure_ascii=False,
+    ) if words else ''
+
+
+def _rows(consultation, segments, first_position, organization_id=None):
+    if organization_id is None:
+        organization_id = Patient.objects.filter(id=consultation.patient_id).values_list('organization_id', flat=True)[0]
+    return [
+        TranscriptSegment(
+            consultation_id=consultation.id,
+            organization_id=organization_id,
+            position=first_position + i,
+            start=round(seg['start'], 2),
+            end=round(seg['end'], 2),
+            text=seg['text'].strip(),
+            words=_compact_words(seg.get('words')),
+        )
+        for i, seg in enumerate(segments)
+        if seg['text'].strip()
+    ]
+
+
+def replace(consultation, segments):
+    """Сегменты всей записи (после полной транскрибации)."""
+    with transaction.atomic():
+        TranscriptSegment.objects.filter(consultation_id=consultation.id).delete()
+        TranscriptSegment.objects.bulk_create(_rows(consultation, segments, 0), batch_size=500)
+
+
+def replace_many(items):
+    """replace() для пачки [(консультация, сегменты)]: один DELETE и один INSERT на всех."""
+    if not items:
+        return
+    organizations = dict(Patient.objects.filter(
+        id__in={consultation.patient_id for consultation, _segments in items},
+    ).values_list('id', 'organization_id'))
+    rows = []
+    for consultation, segments in items:
+        rows.extend(_rows(consultation, segments, 0, organizations[consultation.patient_id]))
+    with transaction.atomic():
+        TranscriptSegment.objects.filter(consultation_id__in=[consultation.id for consultation, _segments in items]).delete()
+        TranscriptSegment.objects.bulk_create(rows, batch_size=500)
+
+
+def append(consultation, segments):
+    """Дописать сегменты в конец (живая транскрибация подтверждает их по частям)."""
+    last = (
+        TranscriptSegment.objects.filter(consultation_id=consultation.id)
+        .order_by('-position').values_list('position', flat=True).first()
+    )
+    TranscriptSegment.objects.bulk_create(_rows(consultation, segments, 0 if last is None else last + 1))
+
+
+def _phrase_offset(segment, phrase_words):
+    """Время начала фразы внутри сегмента по пословным таймкодам; иначе — начало сегмента."""
+    if not segment.words or not phrase_words:
+        return segment.start
+    words = json.loads(segment.words)
+    normalized = [' '.join(normalize_words(word)) for _start, _end, word in words]
+    n = len(phrase_words)
+    for i in range(len(words) - n + 1):
+        window = normalized[i:i + n]
+        # Последнее слово фразы может быть началом слова ("головн" -> "головная")
+        if window[:-1] == phrase_words[:-1] and window[-1].startswith(phrase_words[-1]):
+            return words[i][0]
+    return segment.start
+
+
+def search(organization_id, phrase, limit=50):
+    """
+    Сегменты клиники, где встречается фраза: [(сегмент, время начала фразы), ...].
+    Новые приемы первыми.
+    """
+    phrase_words = normalize_words(phrase)
+    if not phrase_words:
+        return []
+
+    qs = TranscriptSegment.objects.filter(organization_id=organization_id)
+    if connection.vendor == 'mysql':
+        # Фраза целиком в кавычках: boolean mode ищет слова подряд
+        qs = qs.alias(relevance=RawSQL(
+            'MATCH (api_transcriptsegment.text) AGAINST (%s IN BOOLEAN MODE)', ['"%s"' % ' '.join(phrase_words)],
+        )).filter(relevance__gt=0)
+    else:
+        qs = qs.filter(text__icontains=phrase.strip())
+
+    segments = (
+        qs.select_related('consultation__patient')
+        .order_by('-consultation__created_at', 'consultation_id', 'position')[:limit]
+    )
+    return [(segment, _phrase_offset(segment, phrase_words)) for segment in segments]
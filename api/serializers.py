@@ -1,5 +1,6 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import User, Organization, Patient, Consultation
+from .models import User, Organization, Patient, Consultation, ExportJob, AudioUpload
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -11,11 +12,45 @@ class PatientSerializer(serializers.ModelSerializer):
         model = Patient
         fields = '__all__'
 
-class ConsultationSerializer(serializers.ModelSerializer):
+class SparseFieldsMixin:
+    """
+    ?fields=id,status,... — отдаем только перечисленные поля.
+    Списку не нужны большие тексты отчетов, а они весят больше всего остального.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        requested = requested_fields(request)
+        if requested is None:
+            return
+        unknown = requested - set(self.fields)
+        if unknown:
+            raise serializers.ValidationError({'fields': f"Неизвестные поля: {', '.join(sorted(unknown))}"})
+        for name in set(self.fields) - requested:
+            self.fields.pop(name)
+
+
+def requested_fields(request):
+    """Множество полей из ?fields= или None, если параметр не передан."""
+    if request is None or request.method != 'GET':
+        return None
+    value = request.query_params.get('fields')
+    if not value:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class ConsultationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     # Добавляем вложенную информацию о пациенте (чтобы видеть имя, а не просто ID)
     patient_info = PatientSerializer(source='patient', read_only=True)
     doctor_name = serializers.CharField(source='doctor.get_full_name', read_only=True)
 
+    # Тексты хранятся в ConsultationContent (отдельная таблица)
+    raw_transcription = serializers.CharField(source='content.raw_transcription', read_only=True)
+    generated_report = serializers.CharField(source='content.generated_report', read_only=True)
+    final_report = serializers.CharField(source='content.final_report', required=False, allow_blank=True)
+
     class Meta:
         model = Consultation
         fields = [
@@ -24,8 +59,73 @@ class ConsultationSerializer(serializers.ModelSerializer):
             'patient', 'patient_info',
             'audio_file',
             'status',
+            'is_urgent',
+            'raw_transcription',
             'generated_report',
             'final_report',
             'created_at'
         ]
-        read_only_fields = ['generated_report', 'status'] # Эти поля меняет только AI, а не юзер
\ No newline at end of file
+        read_only_fields = ['raw_transcription', 'generated_report', 'status'] # Эти поля меняет только AI, а не юзер
+
+    def create(self, validated_data):
+        content = validated_data.pop('content', {})
+        instance = super().create(validated_data)
+        if content:
+            save_content(instance, content)
+        return instance
+
+    def update(self, instance, validated_data):
+        content = validated_data.pop('content', {})
+        instance = super().update(instance, validated_data)
+        if content:
+            save_content(instance, content)
+        return instance
+
+
+def save_content(consultation, values):
+    """Правка врача пишет только измененные колонки ConsultationContent."""
+    content = consultation.get_content()
+    for name, value in values.items():
+        setattr(content, name, value)
+    content.save(update_fields=list(values))
+
+class LiveConsultationSerializer(serializers.ModelSerializer):
+    """Начало живой записи: аудио придет кусками, файла пока нет."""
+    format = serializers.ChoiceField(choices=['webm', 'ogg'], default='webm', write_only=True)
+
+    class Meta:
+        model = Consultation
+        fields = ['doctor', 'patient', 'format']
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ExportJob
+        fields = ['id', 'filters', 'status', 'total', 'done', 'error', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+
+class AudioUploadSerializer(serializers.ModelSerializer):
+    """Загрузка по частям: размер (Upload-Length) и имя файла — при создании, дальше только PATCH-куски."""
+    filename = serializers.CharField(write_only=True)
+
+    class Meta:
+        model = AudioUpload
+        fields = [
+            'id', 'doctor', 'patient', 'is_urgent', 'filename', 'length', 'offset',
+            'codec', 'duration', 'status', 'error', 'consultation', 'created_at',
+        ]
+        read_only_fields = ['offset', 'codec', 'duration', 'status', 'error', 'consultation']
+
+    def validate_filename(self, value):
+        # Те же форматы, что и у обычной загрузки (валидатор Consultation.audio_file)
+        allowed = Consultation._meta.get_field('audio_file').validators[0].allowed_extensions
+        extension = value.rsplit('.', 1)[-1].lower() if '.' in value else ''
+        if extension not in allowed:
+            raise serializers.ValidationError(f"Допустимые форматы: {', '.join(allowed)}")
+        return value
+
+    def validate_length(self, value):
+        if not 0 < value <= settings.UPLOAD_MAX_BYTES:
+            raise serializers.ValidationError(f"Размер файла должен быть от 1 до {settings.UPLOAD_MAX_BYTES} байт")
+        return value
@@ -0,0 +1,68 @@
+import os
+import shutil
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+try:
+    from django_q.signals import post_spawn
+except ImportError:
+    # Без django_q задачи выполняет встроенный пул, он прогревает модели сам (api/ai_service.py)
+    post_spawn = None
+
+from . import ai_service
+from .models import Consultation, ConsultationContent
+
+
+def preload_whisper_models(sender, proc_name, **kwargs):
+    """
+    Воркер Django Q только что запустился — прогреваем модели заранее,
+    чтобы первая задача не ждала загрузку.
+    """
+    if not settings.WHISPER_PRELOAD_MODELS:
+        return
+    # Импорт внутри функции: веб-процессу torch/whisper не нужны
+    from . import backends
+    print(f"🔥 [Worker {proc_name}] Прогреваю модели: {settings.WHISPER_PRELOAD_MODELS}")
+    backends.preload()
+
+
+if post_spawn is not None:
+    post_spawn.connect(preload_whisper_models)
+
+
+@receiver(post_save, sender=Consultation)
+def create_consultation_content(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ConsultationContent.objects.get_or_create(consultation=instance)
+
+
+@receiver(post_save, sender=Consultation)
+@receiver(post_save, sender=ConsultationContent)
+def prerender_report_pdf(sender, instance, raw=False, **kwargs):
+    """
+    Отчет готов или врач его отредактировал — рендерим PDF в фоне,
+    чтобы скачивание отдавало готовый файл.
+    """
+    if raw:
+        return
+    consultation = instance.consultation if sender is ConsultationContent else instance
+    if consultation.status != 'ready' or not consultation.get_content().final_report:
+        return
+    from . import pdf_reports
+
+    def enqueue():
+        if not pdf_reports.is_cached(consultation):
+            try:
+                ai_service.async_task('api.tasks.prerender_pdf', consultation.id)
+            except ai_service.ExecutorFull:
+                pass  # Встроенный пул занят — PDF отрендерится при скачивании
+
+    transaction.on_commit(enqueue)
+
+
+@receiver(post_delete, sender=Consultation)
+def drop_report_pdf(sender, instance, **kwargs):
+    shutil.rmtree(os.path.join(settings.PDF_CACHE_DIR, str(instance.id)), ignore_errors=True)
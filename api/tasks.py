@@ -1,90 +1,319 @@
 import json
-import os
-import shutil
-import whisper  # Библиотека ИИ
-from .models import Consultation
+from django.conf import settings
+from .ai_service import async_task
+from .models import Consultation, ExportJob, ReprocessJob
+from . import audio_stream, backends, chunking, exports, live, metrics, normalization, pdf_reports, progress, rule_engine, segment_store, transcription_cache, transcription_queue, two_tier
 
 
-def process_audio(consultation_id):
+def process_audio(consultation_id, owner=None, job=None):
     """
-    Эта функция запускается в фоне через Django Q.
+    Эта функция запускается в фоне через Django Q (или во встроенном пуле, api/ai_service.py).
+    Задача идет по этапам (api/transcription_queue.py): повтор после сбоя продолжает
+    с последнего пройденного, а дубль при живой аренде другого воркера пропускается.
+    owner/job — аренда, уже взятая вызывающим (ai_service.start_ai_task).
     """
-    try:
-        # 1. Находим консультацию в базе
-        print(f"⚡ [Worker] Взял в работу задачу ID: {consultation_id}")
-        consultation = Consultation.objects.get(id=consultation_id)
+    if job is None:
+        owner = transcription_queue.worker_id()
+        job = transcription_queue.acquire(consultation_id, owner)
+        if job is None:
+            print(f"⏭️ [Worker] Консультация {consultation_id} уже готова или в работе у другого воркера, пропускаю")
+            return
+
+    ok = False
+    # Время этапов, RTF и ожидание в очереди — в PipelineRun (api/metrics.py)
+    with metrics.run('transcription', consultation_id) as run:
+        run.set('audio_seconds', job.duration)
+        if job.started_at is not None:
+            run.set('queue_wait', (job.started_at - job.enqueued_at).total_seconds())
+        try:
+            # 1. Находим консультацию в базе
+            print(f"⚡ [Worker] Взял в работу задачу ID: {consultation_id} (попытка {job.attempts})")
+            consultation = Consultation.objects.get(id=consultation_id)
 
-        # Ставим статус "В обработке"
-        consultation.status = 'processing'
-        consultation.save()
+            # Ставим статус "В обработке" (UPDATE одной колонки)
+            consultation.set_status('processing')
+            progress.status(consultation.id, 'processing', percent=0)
 
-        # 2. Проверяем FFmpeg (без него Whisper не работает)
-        if not shutil.which("ffmpeg"):
-            # Если не нашли в системе, пробуем искать в корне проекта
-            if os.path.exists('ffmpeg.exe'):
-                os.environ["PATH"] += os.pathsep + os.getcwd()
+            # Этап 1: распознавание. Если текст уже сохранен прошлой попыткой — Whisper не запускаем.
+            # Хэш нужен для кэша транскрибаций; декодирование в 16 кГц моно (api/normalization.py) —
+            # только если до Whisper дойдет: не при попадании в кэш и не в потоковом режиме
+            if not job.stage:
+                with metrics.span('read'):
+                    ensure_audio_hash(consultation)
+                # Аренда продлевается, пока идет Whisper: длинную запись reap() не отнимет
+                with metrics.span('transcribe'), transcription_queue.heartbeat(job):
+                    text, segments = transcribe(consultation)
+                if run.values.get('audio_seconds') is None and segments:
+                    run.set('audio_seconds', segments[-1]['end'])
+                print(f"✅ Распознано: {text[:50]}...")
+                save_transcription(consultation, text, segments)
+                transcription_queue.checkpoint(job, 'transcribed')
             else:
-                print("❌ ОШИБКА: FFmpeg не найден! Положите ffmpeg.exe рядом с manage.py")
-                consultation.status = 'error'
-                consultation.save()
-                return
+                print("♻️ Текст распознан в прошлой попытке, перехожу к отчету")
+                text = consultation.get_content().raw_transcription
+
+            # Этап 2: отчет
+            if job.stage == 'transcribed':
+                save_report(consultation, text)
+                transcription_queue.checkpoint(job, 'reported')
+
+            consultation.set_status('ready')
+            progress.status(consultation.id, 'ready', percent=100)
+            print(f"🎉 Задача {consultation_id} полностью готова!")
+            ok = True
+            if settings.AUDIO_NORMALIZE:
+                async_task('api.tasks.archive_audio', consultation_id)
+
+        except transcription_queue.LeaseLost as e:
+            # Задачу уже отдали другому воркеру — не трогаем ни ее, ни статус консультации
+            print(f"⚠️ [Worker] {e}, останавливаюсь")
+            run.ok = False
+            return
+        except Exception as e:
+            print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: {e}")
+            # Если что-то сломалось, пишем статус Error
+            try:
+                Consultation.objects.filter(id=consultation_id).update(status='error')
+                progress.status(consultation_id, 'error')
+            except:
+                pass
+        run.ok = ok
+
+    # Слот освободился — отдаем его следующей записи из очереди
+    transcription_queue.finish(consultation_id, ok, owner)
+    transcription_queue.dispatch()
 
-        # 3. Запускаем Whisper (Транскрибация)
+
+def transcribe(consultation):
+    """Текст и сегменты записи: из кэша транскрибаций или через Whisper."""
+    # 2. Такой же файл уже распознавали этой моделью? Тогда сразу к отчету
+    options = settings.WHISPER_DECODE_OPTIONS
+    # Ключ кэша учитывает модель и движок (TRANSCRIPTION_BACKEND)
+    model_name = model_label()
+    cached = transcription_cache.get(consultation.audio_hash, model_name, options)
+
+    if cached is not None:
+        metrics.count('transcription_cache_hits')
+        print(f"♻️ Файл уже распознавался (хэш {consultation.audio_hash[:12]}), беру текст из кэша")
+        text = cached['text']
+        segments = cached['segments']
+    else:
+        metrics.count('transcription_cache_misses')
+        # 3. FFmpeg проверяется один раз при старте процесса (api/audio_stream.py)
+        if not audio_stream.FFMPEG_AVAILABLE:
+            raise RuntimeError("FFmpeg не найден! Положите ffmpeg.exe рядом с manage.py")
+
+        # 4. Запускаем Whisper (Транскрибация)
         audio_path = consultation.audio_file.path
-        print(f"🎙️ Загружаю модель Whisper и слушаю файл: {audio_path}...")
+        print(f"🎙️ Беру модель Whisper из кэша процесса и слушаю файл: {audio_path}...")
 
-        # 'medium' — отличное качество распознавания для медицинских терминов
-        # Альтернативы: 'small' (быстрее), 'large' (ещё точнее, но очень медленная)
-        model = whisper.load_model("medium")
-        result = model.transcribe(audio_path)  # Указываем русский язык для лучшего качества
+        # По умолчанию 'medium' — отличное качество для медицинских терминов (см. WHISPER_MODEL)
+        # Модель загружается один раз на воркер и дальше живёт в памяти
+        if settings.WHISPER_TWO_TIER:
+            # Быстрый черновик сразу показываем врачу, потом уточняем сомнительные места
+            audio, offset = normalization.decoded_audio(consultation)
+            draft = two_tier.draft(audio, options)
+            content = consultation.get_content()
+            content.raw_transcription = draft['text']
+            content.save(update_fields=['raw_transcription'])
+            consultation.set_status('draft')
+            progress.status(consultation.id, 'draft', percent=30)
+            progress.segments(consultation.id, normalization.shift_result(draft, offset)['segments'])
+            print(f"📝 Черновик готов ({settings.WHISPER_DRAFT_MODEL}), уточняю...")
+            result = normalization.shift_result(two_tier.refine(audio, draft, options), offset)
+            # Уточненный текст виден сразу, отчет по нему еще строится
+            content.raw_transcription = result['text']
+            content.save(update_fields=['raw_transcription'])
+            consultation.set_status('refined')
+            progress.status(consultation.id, 'refined', percent=80)
+        elif settings.WHISPER_STREAMING:
+            # Потоковый режим: окна по 30 c, память не растёт с длиной записи
+            result = audio_stream.transcribe_stream(
+                backends.get_backend().model, audio_path, options,
+                on_progress=progress.reporter(consultation.id),
+            )
+        else:
+            # Длинные записи режутся по паузам и распознаются параллельно;
+            # готовые куски сохраняются, так что повтор задачи продолжит с места падения
+            audio, offset = normalization.decoded_audio(consultation)
+            checkpoint_key = transcription_cache.make_key(consultation.audio_hash, model_name, options)
+            result = chunking.transcribe_file(
+                audio_path, settings.WHISPER_MODEL, options, checkpoint_key,
+                on_progress=progress.reporter(consultation.id, time_offset=offset), audio=audio,
+            )
+            result = normalization.shift_result(result, offset)
+            chunking.clear_checkpoints(checkpoint_key)
         text = result["text"]
+        segments = result["segments"]
 
-        print(f"✅ Распознано: {text[:50]}...")
-
-        # Сохраняем сырой текст
-        consultation.raw_transcription = text
-        consultation.save()
+        transcription_cache.put(consultation.audio_hash, model_name, options, result)
 
-        # 4. Анализ текста (Имитация ума врача)
-        # Здесь мы формируем JSON для отчета
-        print("🧠 Формирую медицинский отчет...")
+    return text, segments
 
-        # Простая логика поиска ключевых слов
-        diagnosis = "Диагноз не уточнен"
-        recs = "Осмотр терапевта"
-        text_lower = text.lower()
 
-        if "голов" in text_lower or "мигрень" in text_lower:
-            diagnosis = "Головная боль напряжения (G44.2)"
-            recs = "Соблюдение режима сна, МРТ головного мозга."
-        elif "кашел" in text_lower or "температур" in text_lower:
-            diagnosis = "ОРВИ (J06.9)"
-            recs = "Обильное питье, постельный режим, парацетамол."
+def transcribe_live(consultation_id):
+    """
+    Шаг живой транскрибации: ставится в очередь после очередного куска аудио.
+    Ошибка шага не роняет запись — следующий кусок попробует снова.
+    """
+    try:
+        live.tick(consultation_id)
+    except Exception as e:
+        print(f"⚠️ [Live] Шаг для консультации {consultation_id} не удался: {e}")
 
-        report_data = {
-            "complaints": text,  # Жалобы = всё, что сказал пациент
-            "anamnesis": "Записано со слов пациента автоматически.",
-            "diagnosis": diagnosis,
-            "recommendations": recs
-        }
 
-        # Превращаем словарь в текст JSON
-        json_string = json.dumps(report_data, ensure_ascii=False)
+def finish_live(consultation_id):
+    """Прием окончен: дораспознаём хвост записи и строим отчет."""
+    try:
+        print(f"⚡ [Worker] Завершаю живую запись ID: {consultation_id}")
+        live.tick(consultation_id, final=True)
 
-        # 5. Финал: сохраняем всё в базу
-        consultation.generated_report = json_string
-        consultation.final_report = json_string  # Копируем в финал
-        consultation.status = 'ready'
-        consultation.save()
+        consultation = Consultation.objects.get(id=consultation_id)
+        ensure_audio_hash(consultation)
+        save_transcription_and_report(consultation, consultation.get_content().raw_transcription)
 
         print(f"🎉 Задача {consultation_id} полностью готова!")
 
     except Exception as e:
         print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: {e}")
-        # Если что-то сломалось, пишем статус Error
-        try:
-            c = Consultation.objects.get(id=consultation_id)
-            c.status = 'error'
-            c.save()
-        except:
-            pass
\ No newline at end of file
+        Consultation.objects.filter(id=consultation_id).update(status='error')
+        progress.status(consultation_id, 'error')
+
+
+def archive_audio(consultation_id):
+    """Архивная Opus-копия записи (api/normalization.py): после отчета, чтобы не задерживать врача."""
+    try:
+        normalization.archive(Consultation.objects.get(id=consultation_id))
+    except Exception as e:
+        print(f"⚠️ Не удалось сохранить Opus-копию консультации {consultation_id}: {e}")
+
+
+def prerender_pdf(consultation_id):
+    """Заранее рендерим PDF-заключение, чтобы скачивание не ждало xhtml2pdf."""
+    try:
+        with metrics.run('pdf', consultation_id):
+            consultation = Consultation.objects.select_related('doctor', 'patient').get(id=consultation_id)
+            _path, etag = pdf_reports.get_or_render(consultation)
+        print(f"📄 PDF для консультации {consultation_id} готов ({etag[:8]})")
+    except Exception as e:
+        print(f"⚠️ Не удалось подготовить PDF для консультации {consultation_id}: {e}")
+
+
+def run_export(job_id):
+    """
+    Пачка фоновой выгрузки PDF (api/exports.py). Следующая пачка — новой задачей,
+    чтобы большой период не упирался в timeout воркера.
+    """
+    job = ExportJob.objects.get(id=job_id)
+    try:
+        if exports.run_job_batch(job):
+            print(f"📦 Выгрузка {job_id} готова: {job.done} отчетов")
+        else:
+            print(f"📦 Выгрузка {job_id}: {job.done} из {job.total}")
+            async_task('api.tasks.run_export', job_id)
+    except Exception as e:
+        print(f"❌ Выгрузка {job_id} прервалась: {e}")
+        job.status = 'error'
+        job.error = str(e)
+        job.save()
+
+
+def model_label():
+    """Модель (и движок) текущей конфигурации: ключ кэша транскрибаций и отметка, чем распознан прием."""
+    return two_tier.model_label() if settings.WHISPER_TWO_TIER else backends.get_backend().label
+
+
+def reprocess_batch(job_id):
+    """
+    Пачка массовой переобработки (api/reprocessing.py). Следующая пачка — новой задачей:
+    таких цепочек job.parallelism, каждая берет себе очередную пачку из общего списка.
+    """
+    # Импорт внутри: api/reprocessing.py сам использует функции этого модуля
+    from . import reprocessing
+
+    job = ReprocessJob.objects.get(id=job_id)
+    try:
+        if reprocessing.run_batch(job):
+            async_task('api.tasks.reprocess_batch', job_id)
+    except Exception as e:
+        print(f"❌ Переобработка {job_id} прервалась: {e}")
+        ReprocessJob.objects.filter(id=job_id).update(status='error', error=str(e))
+
+
+def ensure_audio_hash(consultation):
+    """Старые записи могли быть загружены до появления хэша — досчитываем."""
+    if not consultation.audio_hash:
+        with open(consultation.audio_file.path, 'rb') as f:
+            consultation.audio_hash = transcription_cache.hash_file(f)
+        consultation.save(update_fields=['audio_hash'])
+
+
+def build_report(text):
+    """
+    Анализ текста (Имитация ума врача).
+    Здесь мы формируем JSON для отчета.
+    """
+    # Клинические правила из CLINICAL_RULES_FILE (api/rule_engine.py): все совпадения за один проход
+    with metrics.span('rules'):
+        findings = rule_engine.analyze(text)
+    diagnosis = "Диагноз не уточнен"
+    recs = "Осмотр терапевта"
+
+    if findings:
+        diagnosis = rule_engine.format_diagnosis(findings[0])
+        recs = findings[0]['recommendations']
+
+    report_data = {
+        "complaints": text,  # Жалобы = всё, что сказал пациент
+        "anamnesis": "Записано со слов пациента автоматически.",
+        "diagnosis": diagnosis,
+        "recommendations": recs,
+        "findings": findings,  # Все сработавшие правила с позициями в тексте
+    }
+
+    # Превращаем словарь в текст JSON
+    return json.dumps(report_data, ensure_ascii=False)
+
+
+def save_transcription(consultation, text, segments=None, model_name=None):
+    """
+    Сырой текст в ConsultationContent, сегменты — для поиска по записи
+    (живая запись сохраняет их сама по ходу, тогда segments=None).
+    model_name — чем распознано (по умолчанию текущая конфигурация).
+    """
+    with metrics.span('db_write'):
+        if segments is not None:
+            segment_store.replace(consultation, segments)
+        content = consultation.get_content()
+        content.raw_transcription = text  # Сохраняем сырой текст
+        mark_transcription(consultation, content, model_name or model_label())
+        content.save(update_fields=['raw_transcription', 'transcription_model', 'transcription_key'])
+
+
+def mark_transcription(consultation, content, model_name):
+    content.transcription_model = model_name
+    content.transcription_key = transcription_cache.make_key(
+        consultation.audio_hash, model_name, settings.WHISPER_DECODE_OPTIONS)
+
+
+def save_report(consultation, text):
+    # 5. Анализ текста
+    print("🧠 Формирую медицинский отчет...")
+    progress.progress(consultation.id, 95)
+    json_string = build_report(text)
+
+    # 6. Тексты — в отдельную таблицу, строку приема не трогаем
+    with metrics.span('db_write'):
+        content = consultation.get_content()
+        content.generated_report = json_string
+        content.final_report = json_string  # Копируем в финал
+        content.report_version = rule_engine.rules_version()
+        content.save(update_fields=['generated_report', 'final_report', 'report_version'])
+
+
+def save_transcription_and_report(consultation, text, segments=None):
+    """Общий финал для пакетного планировщика и живой записи: текст, отчет, статус 'ready'."""
+    save_transcription(consultation, text, segments)
+    save_report(consultation, text)
+    consultation.set_status('ready')
+    progress.status(consultation.id, 'ready', percent=100)
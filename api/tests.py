@@ -1,3 +1,1539 @@
-from django.test import TestCase
+from django.db import connection
+import asyncio
+import concurrent.futures
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+import wave
+import zipfile
+from datetime import timedelta
+
+import numpy as np
+import torch
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from asgiref.sync import async_to_sync
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .models import (
+    Organization, User, Patient, Consultation, ConsultationContent, TranscriptSegment, TranscriptionJob, PipelineRun,
+    AudioUpload, LiveSession, ReprocessJob, ExportJob,
+)
+from . import (
+    ai_service, audio_stream, backends, batch_scheduler, chunking, events, exports, feature_cache, live, metrics,
+    normalization, pdf_reports, progress, reprocessing, rule_engine, segment_store, tasks, transcription_cache,
+    transcription_queue, two_tier, uploads, views, whisper_models,
+)
+
+
+class ConsultationListQueryTests(TestCase):
+    """
+    Список консультаций не должен делать запрос на каждую строку (N+1)
+    и не должен читать большие тексты, если их не просили.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.organization = Organization.objects.create(name="Клиника")
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def create_consultations(self, count):
+        # У каждой консультации свои врач и пациент — иначе N+1 не проявится
+        consultations = []
+        for i in range(count):
+            doctor = User.objects.create(username=f"doctor{User.objects.count()}",
+                                         organization=self.organization, first_name="Иван", last_name="Петров")
+            patient = Patient.objects.create(first_name="Анна", last_name=f"Смирнова{i}",
+                                             birth_date="1990-01-01", organization=self.organization)
+            consultation = Consultation.objects.create(
+                doctor=doctor, patient=patient, audio_file='consultations/audio/test.mp3',
+            )
+            ConsultationContent.objects.filter(pk=consultation.pk).update(
+                raw_transcription="текст " * 100, generated_report="{}", final_report="{}",
+            )
+            consultations.append(consultation)
+        return consultations
+
+    def list_query_count(self, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/consultations/', params or {})
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_list_query_count_does_not_grow_with_rows(self):
+        self.create_consultations(3)
+        few, _ = self.list_query_count()
+        self.create_consultations(30)
+        many, response = self.list_query_count()
+
+        self.assertEqual(few, many)
+        self.assertEqual(many, 1)
+        self.assertEqual(len(response.data['results']), 33)
+
+    def test_retrieve_is_single_query(self):
+        consultation = self.create_consultations(1)[0]
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/consultations/{consultation.id}/')
+        self.assertEqual(response.data['patient_info']['last_name'], "Смирнова0")
+        self.assertEqual(response.data['doctor_name'], "Иван Петров")
+
+    def test_sparse_fields_skip_heavy_columns(self):
+        self.create_consultations(5)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/consultations/', {'fields': 'id,status,patient_info'})
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'status', 'patient_info'})
+        sql = queries[0]['sql']
+        for column in ('raw_transcription', 'generated_report', 'final_report'):
+            self.assertNotIn(column, sql)
+
+    def test_sparse_fields_keep_requested_heavy_column(self):
+        self.create_consultations(2)
+        _, response = self.list_query_count({'fields': 'id,final_report'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'final_report'})
+        self.assertEqual(response.data['results'][0]['final_report'], "{}")
+
+    def test_unknown_field_is_rejected(self):
+        self.create_consultations(1)
+        response = self.client.get('/api/consultations/', {'fields': 'id,password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_pagination_walks_all_rows_with_equal_timestamps(self):
+        self.create_consultations(12)
+        # Одинаковое время создания: порядок должен держаться на id
+        Consultation.objects.update(created_at=timezone.now())
+
+        seen = []
+        url, params = '/api/consultations/', {'page_size': 5, 'fields': 'id'}
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, params)
+            self.assertEqual(len(queries), 1)
+            seen.extend(row['id'] for row in response.data['results'])
+            url, params = response.data['next'], None
+
+        expected = list(Consultation.objects.order_by('-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_status_change_does_not_rewrite_texts(self):
+        consultation = self.create_consultations(1)[0]
+        with CaptureQueriesContext(connection) as queries:
+            consultation.set_status('processing')
+
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]['sql']
+        self.assertIn('status', sql)
+        for column in ('raw_transcription', 'generated_report', 'final_report', 'audio_file'):
+            self.assertNotIn(column, sql)
+
+    def test_final_report_edit_goes_to_content_table(self):
+        consultation = self.create_consultations(1)[0]
+        response = self.client.patch(f'/api/consultations/{consultation.id}/',
+                                     {'final_report': '{"diagnosis": "ОРВИ"}'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['final_report'], '{"diagnosis": "ОРВИ"}')
+        content = ConsultationContent.objects.get(pk=consultation.pk)
+        self.assertEqual(content.final_report, '{"diagnosis": "ОРВИ"}')
+        self.assertEqual(content.raw_transcription, "текст " * 100)
+
+
+class TranscriptSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.organization = Organization.objects.create(name="Клиника")
+        cls.other = other = Organization.objects.create(name="Другая клиника")
+        cls.doctor = doctor = User.objects.create(username="doctor", organization=cls.organization)
+        patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                         birth_date="1990-01-01", organization=cls.organization)
+        stranger = Patient.objects.create(first_name="Петр", last_name="Иванов",
+                                          birth_date="1990-01-01", organization=other)
+        cls.consultation = Consultation.objects.create(doctor=doctor, patient=patient,
+                                                       audio_file='consultations/audio/a.mp3')
+        cls.foreign = Consultation.objects.create(doctor=doctor, patient=stranger,
+                                                  audio_file='consultations/audio/b.mp3')
+        words = [
+            {'start': 10.0, 'end': 10.4, 'word': ' Сильная'},
+            {'start': 10.4, 'end': 10.9, 'word': ' головная'},
+            {'start': 10.9, 'end': 11.3, 'word': ' боль'},
+        ]
+        segment_store.replace(cls.consultation, [
+            {'start': 0.0, 'end': 9.5, 'text': ' добрый день'},
+            {'start': 9.5, 'end': 11.5, 'text': ' Сильная головная боль', 'words': words},
+        ])
+        segment_store.replace(cls.foreign, [{'start': 3.0, 'end': 5.0, 'text': ' головная боль'}])
+
+    def test_segments_are_stored_in_order(self):
+        positions = list(TranscriptSegment.objects.filter(consultation=self.consultation)
+                         .values_list('position', 'start'))
+        self.assertEqual(positions, [(0, 0.0), (1, 9.5)])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor)
+
+    def test_search_returns_word_offset_within_organization(self):
+        response = self.client.get('/api/consultations/search/', {'q': 'головная боль'})
+
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([r['consultation'] for r in results], [self.consultation.id])
+        self.assertEqual(results[0]['offset'], 10.4)
+        self.assertTrue(results[0]['audio_url'].endswith('#t=10.40'))
+
+    def test_search_requires_phrase(self):
+        response = self.client.get('/api/consultations/search/')
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_ignores_organization_param_from_doctor(self):
+        self.assertIn(APIClient().get('/api/consultations/search/', {'q': 'боль', 'organization': self.other.id})
+                      .status_code, (401, 403))
+
+        response = self.client.get('/api/consultations/search/', {'q': 'боль', 'organization': self.other.id})
+        self.assertEqual([r['consultation'] for r in response.data['results']], [self.consultation.id])
+
+        admin = User.objects.create(username="admin", is_staff=True)
+        self.client.force_authenticate(admin)
+        response = self.client.get('/api/consultations/search/', {'q': 'боль', 'organization': self.other.id})
+        self.assertEqual([r['consultation'] for r in response.data['results']], [self.foreign.id])
+
+
+@override_settings(TRANSCRIPTION_MAX_RUNNING=2, TRANSCRIPTION_ORG_MAX_RUNNING=0, WHISPER_BATCH_SCHEDULER=False)
+class TranscriptionCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="Клиника")
+        cls.doctor = User.objects.create(username="doctor", organization=organization)
+        cls.patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                             birth_date="1990-01-01", organization=organization)
+
+    def test_cache_hit_does_not_decode_audio(self):
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media, AUDIO_NORMALIZE=True):
+            # Не аудио: любая попытка ffmpeg закончилась бы ошибкой
+            audio = SimpleUploadedFile('visit.mp3', b'not really audio')
+            consultation = Consultation.objects.create(doctor=self.doctor, patient=self.patient, audio_file=audio)
+            tasks.ensure_audio_hash(consultation)
+            transcription_cache.put(consultation.audio_hash, tasks.model_label(), settings.WHISPER_DECODE_OPTIONS,
+                                    {'text': "Болит голова", 'segments': [{'start': 0.0, 'end': 1.5, 'text': "Болит голова"}]})
+            default_storage.save(normalization.opus_name(consultation.audio_hash), ContentFile(b'opus'))
+
+            transcription_queue.enqueue(consultation, duration=1.5)
+            tasks.process_audio(consultation.id)
+
+            consultation.refresh_from_db()
+            self.assertEqual(consultation.status, 'ready')
+            self.assertIsNone(normalization.read_meta(consultation.audio_hash))
+            self.assertFalse(os.path.exists(normalization.pcm_path(consultation.audio_hash)))
+
+    def test_cache_key_covers_audio_model_and_options(self):
+        key = transcription_cache.make_key('a' * 64, 'medium', {'language': 'ru', 'beam_size': 5})
+
+        # Порядок параметров не важен, пустые параметры = отсутствующие
+        self.assertEqual(key, transcription_cache.make_key('a' * 64, 'medium', {'beam_size': 5, 'language': 'ru'}))
+        self.assertEqual(transcription_cache.make_key('a' * 64, 'medium', None),
+                         transcription_cache.make_key('a' * 64, 'medium', {}))
+        self.assertEqual(len({
+            key,
+            transcription_cache.make_key('b' * 64, 'medium', {'language': 'ru', 'beam_size': 5}),
+            transcription_cache.make_key('a' * 64, 'small', {'language': 'ru', 'beam_size': 5}),
+            transcription_cache.make_key('a' * 64, 'medium', {'language': 'ru', 'beam_size': 1}),
+        }), 4)
+
+        transcription_cache.put('a' * 64, 'medium', {'language': 'ru', 'beam_size': 5},
+                                {'text': "Болит голова", 'segments': []})
+        self.assertEqual(transcription_cache.get('a' * 64, 'medium', {'beam_size': 5, 'language': 'ru'})['text'],
+                         "Болит голова")
+        self.assertIsNone(transcription_cache.get('a' * 64, 'small', {'beam_size': 5, 'language': 'ru'}))
+
+    @override_settings(WHISPER_BATCH_SCHEDULER=True)  # только очередь: распознавание не запускаем
+    def test_duplicate_upload_shares_stored_file(self):
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            ids = []
+            for _ in range(2):
+                response = self.client.post('/api/consultations/', {
+                    'doctor': self.doctor.id, 'patient': self.patient.id,
+                    'audio_file': SimpleUploadedFile('visit.mp3', b'same audio bytes'),
+                })
+                self.assertEqual(response.status_code, 201, response.content)
+                ids.append(response.json()['id'])
+
+            first, second = Consultation.objects.filter(id__in=ids).order_by('id')
+            self.assertEqual(first.audio_hash, second.audio_hash)
+            self.assertEqual(first.audio_file.name, second.audio_file.name)
+            self.assertEqual(os.listdir(os.path.join(media, 'consultations', 'audio')), ['visit.mp3'])
+
+    def test_shared_pcm_is_kept_while_duplicate_is_queued(self):
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media, AUDIO_KEEP_PCM=False):
+            first, second = [
+                Consultation.objects.create(doctor=self.doctor, patient=self.patient, audio_hash='b' * 64,
+                                            audio_file='consultations/audio/same.mp3')
+                for _ in range(2)
+            ]
+            os.makedirs(os.path.dirname(normalization.pcm_path('b' * 64)))
+            np.save(normalization.pcm_path('b' * 64), np.zeros(16000, np.int16))
+            with open(normalization.pcm_path('b' * 64)[:-len('.npy')] + '.json', 'w') as f:
+                json.dump({'offset': 0.0, 'gain_db': 0.0}, f)
+            default_storage.save(normalization.opus_name('b' * 64), ContentFile(b'opus'))
+
+            transcription_queue.enqueue(second, duration=1.0)
+            normalization.archive(first)
+            self.assertIsNotNone(normalization.read_meta('b' * 64))
+
+            TranscriptionJob.objects.filter(consultation=second).update(status='done')
+            normalization.archive(first)
+            self.assertIsNone(normalization.read_meta('b' * 64))
+
+
+class ChunkStitchingTests(SimpleTestCase):
+    def test_segments_are_shifted_to_chunk_start(self):
+        chunks = [(0, 30 * 16000), (30 * 16000, 55 * 16000)]
+        results = [
+            {'text': " Добрый день. ", 'language': 'ru', 'segments': [
+                {'id': 0, 'start': 0.0, 'end': 2.0, 'text': " Добрый день."},
+            ]},
+            {'text': " Болит голова.", 'language': 'ru', 'segments': [
+                {'id': 0, 'start': 1.5, 'end': 3.0, 'text': " Болит голова.", 'words': [
+                    {'start': 1.5, 'end': 2.0, 'word': " Болит"}, {'start': 2.0, 'end': 3.0, 'word': " голова."},
+                ]},
+            ]},
+        ]
+
+        stitched = chunking._stitch(chunks, results)
+
+        self.assertEqual(stitched['text'], "Добрый день. Болит голова.")
+        self.assertEqual(stitched['language'], 'ru')
+        self.assertEqual([(seg['id'], seg['start'], seg['end']) for seg in stitched['segments']],
+                         [(0, 0.0, 2.0), (1, 31.5, 33.0)])
+        self.assertEqual([(w['start'], w['end']) for w in stitched['segments'][1]['words']],
+                         [(31.5, 32.0), (32.0, 33.0)])
+        # Результаты кусков (они же чекпоинты) не меняются
+        self.assertEqual(results[1]['segments'][0]['start'], 1.5)
+
+    @override_settings(WHISPER_CHUNK_SECONDS=10, WHISPER_CHUNK_MAX_SECONDS=15)
+    def test_chunks_are_cut_in_the_middle_of_a_pause(self):
+        sr = 16000
+        chunks = chunking.plan_chunks(40 * sr, [(11 * sr, 12 * sr), (24 * sr, 26 * sr)])
+        self.assertEqual(chunks, [(0, int(11.5 * sr)), (int(11.5 * sr), 25 * sr), (25 * sr, 40 * sr)])
+
+        # Паузы нет — режем жестко по максимальной длине
+        self.assertEqual(chunking.plan_chunks(40 * sr, []), [(0, 15 * sr), (15 * sr, 30 * sr), (30 * sr, 40 * sr)])
+
+
+    @override_settings(WHISPER_CHUNK_SECONDS=10, WHISPER_CHUNK_MAX_SECONDS=15, WHISPER_CHUNK_WORKERS=2)
+    def test_pool_does_not_fork_threaded_worker(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        contexts = []
+
+        class InlinePool:
+            """Пул без процессов: запоминаем способ запуска, куски считаем здесь же."""
+            def __init__(self, max_workers, mp_context, initializer, initargs):
+                contexts.append(mp_context.get_start_method())
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def submit(self, fn, *args):
+                future = concurrent.futures.Future()
+                future.set_result(fn(*args))
+                return future
+
+        original = chunking.ProcessPoolExecutor
+        chunking.ProcessPoolExecutor = InlinePool
+        self.addCleanup(setattr, chunking, 'ProcessPoolExecutor', original)
+        original_chunk = chunking._transcribe_chunk
+        chunking._transcribe_chunk = lambda model_name, samples, options: {
+            'text': " Болит голова.", 'language': 'ru',
+            'segments': [{'id': 0, 'start': 0.0, 'end': 1.0, 'text': " Болит голова."}],
+        }
+        self.addCleanup(setattr, chunking, '_transcribe_chunk', original_chunk)
+
+        audio = np.random.default_rng(0).normal(0, 0.1, 40 * 16000).astype(np.float32)
+        with override_settings(MEDIA_ROOT=media):
+            result = chunking.transcribe_file(None, 'tiny', {}, 'pool', audio=audio)
+
+        self.assertEqual(len(contexts), 1)
+        self.assertIn(contexts[0], ('forkserver', 'spawn'))
+        self.assertEqual(len(result['segments']), 3)
+
+
+    @override_settings(WHISPER_CHUNK_SECONDS=10, WHISPER_CHUNK_MAX_SECONDS=15, WHISPER_CHUNK_WORKERS=1)
+    def test_retry_resumes_from_saved_chunks(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        calls = []
+
+        def transcribe_chunk(model_name, samples, options):
+            calls.append(len(calls))
+            if len(calls) == 2:
+                raise RuntimeError("воркер убит")
+            return {'text': f" кусок {len(calls)}", 'language': 'ru',
+                    'segments': [{'id': 0, 'start': 1.0, 'end': 2.0, 'text': f" кусок {len(calls)}"}]}
+
+        original = chunking._transcribe_chunk
+        chunking._transcribe_chunk = transcribe_chunk
+        self.addCleanup(setattr, chunking, '_transcribe_chunk', original)
+
+        audio = np.random.default_rng(0).normal(0, 0.1, 40 * 16000).astype(np.float32)
+        progress_seen = []
+        with override_settings(MEDIA_ROOT=media):
+            with self.assertRaises(RuntimeError):
+                chunking.transcribe_file(None, 'tiny', {}, 'retry', audio=audio)
+            # Повтор задачи: первый кусок уже на диске, Whisper для него не запускаем
+            result = chunking.transcribe_file(None, 'tiny', {}, 'retry', audio=audio,
+                                              on_progress=lambda done, segments: progress_seen.append(done))
+
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(progress_seen, [2 / 3, 1.0])
+        self.assertEqual(result['text'], "кусок 1 кусок 3 кусок 4")
+        self.assertEqual([(seg['id'], seg['start']) for seg in result['segments']], [(0, 1.0), (1, 16.0), (2, 31.0)])
+
+
+class TwoTierRefineTests(SimpleTestCase):
+    def test_refined_segments_do_not_repeat_neighbours(self):
+        draft = {'language': 'ru', 'text': " Добрый день. бол голва Принимайте ибупрофен.", 'segments': [
+            {'start': 0.0, 'end': 2.0, 'text': " Добрый день.", 'avg_logprob': -0.1},
+            {'start': 2.0, 'end': 4.0, 'text': " бол голва", 'avg_logprob': -2.0},
+            {'start': 4.0, 'end': 6.0, 'text': " Принимайте ибупрофен.", 'avg_logprob': -0.1},
+        ]}
+        # Большая модель слышит участок с запасом PAD_SECONDS: 1.7 .. 4.3 c — и края соседей
+        piece = {'language': 'ru', 'text': " день. Болит голова. Принимайте", 'segments': [
+            {'start': 0.0, 'end': 0.3, 'text': " день."},
+            {'start': 0.3, 'end': 2.3, 'text': " Болит голова.", 'words': [
+                {'start': 0.3, 'end': 1.0, 'word': " Болит"}, {'start': 1.0, 'end': 2.3, 'word': " голова."},
+            ]},
+            {'start': 2.3, 'end': 2.6, 'text': " Принимайте"},
+        ]}
+        pieces = []
+
+        class Backend:
+            def transcribe(self, samples, **options):
+                pieces.append(len(samples) / 16000)
+                return piece
+
+        original = backends.get_backend
+        backends.get_backend = lambda *args, **kwargs: Backend()
+        self.addCleanup(setattr, backends, 'get_backend', original)
+
+        result = two_tier.refine(np.zeros(6 * 16000, np.int16), draft, {})
+
+        self.assertEqual(pieces, [2.6])
+        self.assertEqual(result['text'], " Добрый день. Болит голова. Принимайте ибупрофен.")
+        self.assertEqual([(seg['id'], seg['start'], seg['end']) for seg in result['segments']],
+                         [(0, 0.0, 2.0), (1, 2.0, 4.0), (2, 4.0, 6.0)])
+
+
+class LiveTranscriptionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="Клиника")
+        cls.doctor = User.objects.create(username="doctor", organization=organization)
+        cls.patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                             birth_date="1990-01-01", organization=organization)
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        name = default_storage.save('consultations/audio/live.webm', ContentFile(b''))
+        self.consultation = Consultation.objects.create(doctor=self.doctor, patient=self.patient,
+                                                        audio_file=name, status='recording')
+        live.start_session(self.consultation)
+
+    def test_chunk_is_appended_once_per_offset(self):
+        self.assertEqual(live.append_chunk(self.consultation, b'abc', 0), 3)
+        with self.assertRaises(live.OffsetMismatch) as error:
+            live.append_chunk(self.consultation, b'abc', 0)
+        self.assertEqual(error.exception.size, 3)
+        self.assertEqual(live.append_chunk(self.consultation, b'de', 3), 5)
+
+    def test_agreed_prefix_commits_only_stable_repeated_segments(self):
+        previous = [
+            {'start': 0.0, 'end': 2.0, 'text': " Добрый день."},
+            {'start': 2.0, 'end': 4.0, 'text': " Болит голова"},
+            {'start': 4.0, 'end': 9.5, 'text': " и немного"},
+        ]
+        current = [
+            {'start': 0.0, 'end': 2.0, 'text': "добрый день"},  # регистр и пунктуация не важны
+            {'start': 2.0, 'end': 4.0, 'text': " Болит голова,"},
+            {'start': 4.0, 'end': 9.5, 'text': " и немного тошнит"},
+        ]
+
+        self.assertEqual(live._agreed_prefix(previous, current, stable_until=8.0), 2)
+        # Сегмент у края окна не подтверждаем, даже если он совпал
+        self.assertEqual(live._agreed_prefix(previous, current, stable_until=3.0), 1)
+        # Расхождение в начале — дальше не смотрим
+        self.assertEqual(live._agreed_prefix(previous[1:], current, stable_until=8.0), 0)
+        self.assertEqual(live._agreed_prefix([], current, stable_until=8.0), 0)
+
+    def test_tick_does_not_run_while_another_holds_the_session(self):
+        LiveSession.objects.filter(consultation=self.consultation).update(
+            tick_owner='other', tick_until=timezone.now() + timedelta(minutes=5), hypothesis='[]',
+        )
+        live.tick(self.consultation.id)
+        self.assertEqual(LiveSession.objects.get(consultation=self.consultation).tick_owner, 'other')
+
+        # Аренда истекла (воркер умер) — финальный шаг ее забирает и отпускает.
+        # Проверяем аренду, а не распознавание: запись пустая, ffmpeg не нужен
+        decoded = []
+        original = audio_stream.decode_from
+        audio_stream.decode_from = lambda path, start=0.0, strict=True: decoded.append(start) or np.zeros(0, np.float32)
+        self.addCleanup(setattr, audio_stream, 'decode_from', original)
+        LiveSession.objects.filter(consultation=self.consultation).update(tick_until=timezone.now())
+        live.tick(self.consultation.id, final=True)
+        self.assertEqual(decoded, [0])
+        session = LiveSession.objects.get(consultation=self.consultation)
+        self.assertEqual((session.tick_owner, session.tick_until, session.committed_seconds), ('', None, 0))
+
+
+class ProgressStreamTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="Клиника")
+        cls.doctor = User.objects.create(username="doctor", organization=organization)
+        cls.patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                             birth_date="1990-01-01", organization=organization)
+
+    def setUp(self):
+        self.consultation = Consultation.objects.create(doctor=self.doctor, patient=self.patient, status='processing')
+
+    def stream(self, last_event_id=None):
+        headers = [] if last_event_id is None else [(b'last-event-id', str(last_event_id).encode())]
+        scope = {'type': 'http', 'path': f'/api/consultations/{self.consultation.id}/events/', 'headers': headers}
+        messages = []
+
+        async def receive():
+            await asyncio.sleep(60)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        async def run():
+            # Поток для завершенной консультации обязан закрыться сам, а не опрашивать базу вечно
+            await asyncio.wait_for(events.sse_application(scope, receive, send), timeout=5)
+
+        async_to_sync(run)()
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], body.decode()
+
+    def test_finished_consultation_stops_reconnects(self):
+        progress.progress(self.consultation.id, 50)
+        progress.emit(self.consultation.id, 'status', status='ready', percent=100)
+        Consultation.objects.filter(id=self.consultation.id).update(status='ready')
+        last_id = self.consultation.events.order_by('-id').values_list('id', flat=True)[0]
+
+        status, body = self.stream()
+        self.assertEqual(status, 200)
+        self.assertIn('"status": "ready"', body)
+
+        # Клиент видел последнее событие — 204, EventSource больше не переподключается
+        self.assertEqual(self.stream(last_id), (204, ''))
+
+        # Клиент отвалился до финального статуса — досылаем пропущенное и закрываем поток
+        status, body = self.stream(last_id - 1)
+        self.assertEqual(status, 200)
+        self.assertIn(f'id: {last_id}\n', body)
+        self.assertIn('"status": "ready"', body)
+
+
+class TranscriptionQueueTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.busy = Organization.objects.create(name="Клиника с пачкой записей")
+        cls.quiet = Organization.objects.create(name="Обычная клиника")
+        cls.doctor = User.objects.create(username="doctor")
+
+    def add_job(self, organization, minutes_ago=0, priority=2):
+        patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                         birth_date="1990-01-01", organization=organization)
+        consultation = Consultation.objects.create(doctor=self.doctor, patient=patient,
+                                                   audio_file='consultations/audio/a.mp3')
+        TranscriptionJob.objects.create(
+            consultation=consultation, organization=organization, priority=priority,
+            enqueued_at=timezone.now() - timedelta(minutes=minutes_ago),
+        )
+        return consultation.id
+
+    def test_bulk_upload_does_not_starve_other_organization(self):
+        bulk = [self.add_job(self.busy, minutes_ago=60 - i) for i in range(10)]
+        other = self.add_job(self.quiet)
+
+        self.assertEqual(transcription_queue.claim(), [bulk[0], other])
+        transcription_queue.finish(bulk[0])
+        transcription_queue.finish(other)
+        self.assertEqual(transcription_queue.claim(), bulk[1:3])
+
+    def test_urgent_and_short_recordings_go_first(self):
+        long_recording = self.add_job(self.busy, minutes_ago=10)
+        short_recording = self.add_job(self.busy, minutes_ago=5, priority=1)
+        urgent = self.add_job(self.quiet, priority=0)
+
+        self.assertEqual(transcription_queue.claim(limit=2), [urgent, short_recording])
+        self.assertEqual(transcription_queue.claim(limit=1), [long_recording])
+
+    def test_organization_cap(self):
+        self.busy.max_running_transcriptions = 1
+        self.busy.save()
+        first = self.add_job(self.busy, minutes_ago=2)
+        self.add_job(self.busy, minutes_ago=1)
+
+        self.assertEqual(transcription_queue.claim(), [first])
+        self.assertEqual(transcription_queue.claim(), [])
+
+    @override_settings(TRANSCRIPTION_ORG_QUEUE_LIMIT=1)
+    def test_upload_is_rejected_when_queue_is_full(self):
+        self.add_job(self.busy)
+        patient = Patient.objects.filter(organization=self.busy).first()
+        response = APIClient().post('/api/consultations/', {
+            'doctor': self.doctor.id, 'patient': patient.id,
+            'audio_file': SimpleUploadedFile('a.mp3', b'ID3', content_type='audio/mpeg'),
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(Consultation.objects.count(), 1)
+
+    def test_stats_report_wait_per_organization(self):
+        self.add_job(self.busy, minutes_ago=3)
+        self.add_job(self.busy, minutes_ago=1)
+        transcription_queue.claim(limit=1)
+
+        stats = {row['organization']: row for row in transcription_queue.stats()}
+        self.assertEqual(stats[self.busy.id]['queued'], 1)
+        self.assertEqual(stats[self.busy.id]['running'], 1)
+        self.assertGreaterEqual(stats[self.busy.id]['wait_p50_seconds'], 180)
+        self.assertNotIn(self.quiet.id, stats)
+
+    def test_queue_endpoint_shows_only_own_organization(self):
+        self.add_job(self.busy)
+        self.add_job(self.quiet)
+        client = APIClient()
+        self.assertIn(client.get('/api/consultations/queue/').status_code, (401, 403))
+
+        doctor = User.objects.create(username="quiet_doctor", organization=self.quiet)
+        client.force_authenticate(doctor)
+        response = client.get('/api/consultations/queue/', {'organization': self.busy.id})
+        self.assertEqual([row['organization'] for row in response.data['results']], [self.quiet.id])
+
+        client.force_authenticate(User.objects.create(username="admin", is_staff=True))
+        response = client.get('/api/consultations/queue/', {'organization': self.busy.id})
+        self.assertEqual([row['organization'] for row in response.data['results']], [self.busy.id])
+
+
+@override_settings(TRANSCRIPTION_MAX_ATTEMPTS=2, WHISPER_BATCH_SCHEDULER=False)
+class TranscriptionLeaseTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="Клиника")
+        doctor = User.objects.create(username="doctor")
+        patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                         birth_date="1990-01-01", organization=organization)
+        # Файла нет на диске: любая попытка распознавания закончится ошибкой
+        cls.consultation = Consultation.objects.create(doctor=doctor, patient=patient,
+                                                       audio_file='consultations/audio/missing.mp3')
+
+    def test_duplicate_enqueue_and_run_collapse(self):
+        job = transcription_queue.enqueue(self.consultation)
+        self.assertEqual(transcription_queue.enqueue(self.consultation).id, job.id)
+
+        self.assertIsNotNone(transcription_queue.acquire(self.consultation.id, 'worker-a'))
+        self.assertIsNone(transcription_queue.acquire(self.consultation.id, 'worker-b'))
+
+        transcription_queue.finish(self.consultation.id, owner='worker-a')
+        self.assertEqual(transcription_queue.enqueue(self.consultation).status, 'done')
+        self.assertIsNone(transcription_queue.acquire(self.consultation.id, 'worker-b'))
+
+    def test_expired_lease_is_requeued_with_its_stage(self):
+        job = transcription_queue.acquire(self.consultation.id, 'worker-a')
+        transcription_queue.checkpoint(job, 'transcribed')
+        TranscriptionJob.objects.filter(id=job.id).update(lease_until=timezone.now() - timedelta(seconds=1))
+        Consultation.objects.filter(id=self.consultation.id).update(status='processing')
+
+        self.assertEqual(transcription_queue.reap(), (1, 0))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.stage, job.owner), ('queued', 'transcribed', ''))
+        self.assertEqual(Consultation.objects.get(id=self.consultation.id).status, 'created')
+
+        # Старый воркер проснулся — его аренды больше нет
+        with self.assertRaises(transcription_queue.LeaseLost):
+            transcription_queue.checkpoint(job, 'reported')
+
+    def test_attempts_are_limited(self):
+        for _ in range(2):
+            transcription_queue.enqueue(self.consultation)
+            TranscriptionJob.objects.update(status='queued')
+            transcription_queue.acquire(self.consultation.id, 'worker-a')
+            TranscriptionJob.objects.update(lease_until=timezone.now() - timedelta(seconds=1))
+            transcription_queue.reap()
+
+        self.assertEqual(TranscriptionJob.objects.get().status, 'error')
+        self.assertEqual(Consultation.objects.get(id=self.consultation.id).status, 'error')
+
+    def test_retry_resumes_after_transcription(self):
+        ConsultationContent.objects.filter(pk=self.consultation.pk).update(raw_transcription="Болит голова с утра")
+        job = transcription_queue.enqueue(self.consultation)
+        TranscriptionJob.objects.filter(id=job.id).update(stage='transcribed', attempts=1)
+
+        tasks.process_audio(self.consultation.id)
+
+        self.assertEqual(Consultation.objects.get(id=self.consultation.id).status, 'ready')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.stage), ('done', 'reported'))
+        self.assertIn('G44.2', ConsultationContent.objects.get(pk=self.consultation.pk).final_report)
+
+
+class LeaseHeartbeatTests(TransactionTestCase):
+    # Поток продления ходит в базу своим соединением — нужны закоммиченные данные
+    def test_long_stage_keeps_lease(self):
+        organization = Organization.objects.create(name="Клиника")
+        patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                         birth_date="1990-01-01", organization=organization)
+        consultation = Consultation.objects.create(doctor=User.objects.create(username="doctor"), patient=patient,
+                                                   audio_file='consultations/audio/long.mp3')
+        job = transcription_queue.acquire(consultation.id, 'worker-a')
+        expired = timezone.now() - timedelta(seconds=1)
+        TranscriptionJob.objects.filter(id=job.id).update(lease_until=expired)
+
+        with transcription_queue.heartbeat(job, interval=0.05):
+            deadline = time.monotonic() + 5
+            while TranscriptionJob.objects.get(id=job.id).lease_until <= expired and time.monotonic() < deadline:
+                time.sleep(0.02)
+            # Этап все еще идет — reap() задачу не трогает
+            self.assertEqual(transcription_queue.reap(), (0, 0))
+        transcription_queue.checkpoint(job, 'transcribed')
+
+
+@override_settings(TASK_EXECUTOR='local', WHISPER_PRELOAD_MODELS=[], AUDIO_NORMALIZE=False,
+                   WHISPER_BATCH_SCHEDULER=False)
+class LocalPipelineTests(TransactionTestCase):
+    # Задача идет в потоке пула своим соединением — нужны закоммиченные данные
+    def test_local_pool_runs_the_queue_pipeline(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        executor = ai_service.LocalExecutor(workers=1, queue_limit=10)
+        original, ai_service._executor = ai_service._executor, executor
+        self.addCleanup(setattr, ai_service, '_executor', original)
+
+        organization = Organization.objects.create(name="Клиника")
+        patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                         birth_date="1990-01-01", organization=organization)
+        consultation = Consultation.objects.create(doctor=User.objects.create(username="doctor"), patient=patient,
+                                                   audio_file=SimpleUploadedFile('visit.mp3', b'not really audio'))
+        tasks.ensure_audio_hash(consultation)
+        options = settings.WHISPER_DECODE_OPTIONS
+        transcription_cache.put(consultation.audio_hash, tasks.model_label(), options,
+                                {'text': "Болит голова", 'segments': [{'start': 0.0, 'end': 1.5, 'text': "Болит голова"}]})
+        transcription_queue.enqueue(consultation, duration=1.5)
+
+        self.assertTrue(ai_service.start_ai_task(consultation.id))
+        executor.join()
+
+        # Те же этапы, что у Django Q: кэш, версии модели и правил — reprocess не сочтет отчет устаревшим
+        consultation.refresh_from_db()
+        content = consultation.get_content()
+        self.assertEqual(consultation.status, 'ready')
+        self.assertEqual(content.transcription_key,
+                         transcription_cache.make_key(consultation.audio_hash, tasks.model_label(), options))
+        self.assertEqual(content.report_version, rule_engine.rules_version())
+        self.assertEqual(json.loads(content.final_report)['diagnosis'], "Головная боль напряжения (G44.2)")
+        self.assertEqual(executor.stats()['failed'], 0)
+
+
+class BatchSchedulerTests(SimpleTestCase):
+    """BatchTranscriber без ffmpeg и модели: окна и декодер подменены, номер окна зашит в mel."""
+
+    def setUp(self):
+        self.batches = []
+        recordings = {
+            'a.mp3': [(0.0, 30.0, 10), (30.0, 30.0, 11), (60.0, 12.0, 12)],
+            'b.mp3': [(0.0, 8.0, 20)],
+        }
+
+        def iter_mel_windows(path, n_mels):
+            if path == 'broken.mp3':
+                raise RuntimeError("ffmpeg не прочитал файл")
+            for offset, duration, number in recordings[path]:
+                yield offset, duration, torch.full((1, 1), float(number))
+
+        def decode_with_fallback(model, mel, schedule, options):
+            numbers = [int(value) for value in mel.flatten().tolist()]
+            self.batches.append(numbers)
+            return [types.SimpleNamespace(tokens=[number], language='ru', avg_logprob=-0.1, no_speech_prob=0.0)
+                    for number in numbers]
+
+        stubs = {
+            'iter_mel_windows': iter_mel_windows,
+            'decode_with_fallback': decode_with_fallback,
+            'decoding_options': lambda model, options, language, prompt: [],
+            'split_segments': lambda tokens, tokenizer, duration: ([(0.0, duration, f" {tokens[0]}")], None),
+        }
+        for name, stub in stubs.items():
+            self.addCleanup(setattr, audio_stream, name, getattr(audio_stream, name))
+            setattr(audio_stream, name, stub)
+        class Model:
+            # На модель вешается блокировка распознавания (weakref) — нужен обычный объект
+            dims = types.SimpleNamespace(n_mels=80)
+            device = 'cpu'
+            is_multilingual = True
+            num_languages = 99
+
+        model = Model()
+        self.transcriber = batch_scheduler.BatchTranscriber(model, {'language': 'ru'}, max_batch_size=2)
+
+    def run_all(self):
+        finished = {}
+        while len(self.transcriber):
+            for key, result, error in self.transcriber.step():
+                finished[key] = (result, error)
+        return finished
+
+    def test_windows_of_several_recordings_share_a_batch(self):
+        self.transcriber.add('a', 'a.mp3')
+        self.transcriber.add('b', 'b.mp3')
+
+        finished = self.run_all()
+
+        # По кругу: окно от каждой записи, освободившееся место — следующему окну
+        self.assertEqual(self.batches, [[10, 20], [11, 12]])
+        self.assertEqual(finished['a'][0]['text'], " 10 11 12")
+        self.assertEqual([(seg['id'], seg['start'], seg['end']) for seg in finished['a'][0]['segments']],
+                         [(0, 0.0, 30.0), (1, 30.0, 60.0), (2, 60.0, 72.0)])
+        self.assertEqual(finished['b'], ({'text': " 20", 'segments': [
+            {'id': 0, 'start': 0.0, 'end': 8.0, 'text': " 20", 'avg_logprob': -0.1, 'no_speech_prob': 0.0},
+        ]}, None))
+
+    def test_unreadable_file_does_not_stop_the_batch(self):
+        self.transcriber.add('broken', 'broken.mp3')
+        self.transcriber.add('b', 'b.mp3')
+
+        finished = self.run_all()
+
+        result, error = finished['broken']
+        self.assertIsNone(result)
+        self.assertIsInstance(error, RuntimeError)
+        self.assertEqual(finished['b'][0]['text'], " 20")
+        self.assertEqual(self.batches, [[20]])
+
+
+class PipelineMetricsTests(TestCase):
+    def record_run(self, transcribe_seconds, audio_seconds=100.0):
+        with metrics.run('transcription') as run:
+            run.set('audio_seconds', audio_seconds)
+            with metrics.span('decode'):
+                pass
+            metrics.count('model_cache_hits')
+        # Время этапа подменяем: реальный sleep замедлил бы тесты
+        spans = {'decode': 0.5, 'transcribe': transcribe_seconds}
+        PipelineRun.objects.filter(id=PipelineRun.objects.latest('id').id).update(
+            spans=json.dumps(spans), rtf=transcribe_seconds / audio_seconds,
+        )
+
+    def test_run_records_spans_and_counters(self):
+        with metrics.run('transcription') as run:
+            run.set('audio_seconds', 60.0)
+            with metrics.span('transcribe'):
+                pass
+            metrics.count('model_cache_misses')
+        metrics.count('model_cache_misses')  # вне прогона — ничего не делает
+
+        recorded = PipelineRun.objects.get()
+        self.assertTrue(recorded.ok)
+        self.assertEqual(set(json.loads(recorded.spans)), {'transcribe'})
+        self.assertEqual(json.loads(recorded.counters), {'model_cache_misses': 1})
+        self.assertIsNotNone(recorded.rtf)
+
+    def test_failed_run_is_marked(self):
+        with self.assertRaises(ValueError):
+            with metrics.run('pdf'):
+                raise ValueError
+        self.assertFalse(PipelineRun.objects.get().ok)
+
+    def test_prometheus_endpoint(self):
+        for seconds in (10.0, 20.0, 30.0):
+            self.record_run(seconds)
+
+        response = self.client.get('/api/metrics/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('clinspeech_stage_seconds{kind="transcription",stage="transcribe",quantile="0.5"} 20\n', body)
+        self.assertIn('clinspeech_stage_seconds_count{kind="transcription",stage="transcribe"} 3\n', body)
+        self.assertIn('clinspeech_rtf{kind="transcription",quantile="0.95"} 0.3\n', body)
+        self.assertIn('clinspeech_events{kind="transcription",event="model_cache_hits"} 3\n', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_prometheus_endpoint_token(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 401)
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    def test_current_span_is_innermost(self):
+        with metrics.run('pdf'):
+            self.assertIsNone(metrics.current_span())
+            with metrics.span('transcribe'):
+                with metrics.span('model_load'):
+                    self.assertEqual(metrics.current_span(), 'model_load')
+                self.assertEqual(metrics.current_span(), 'transcribe')
+        self.assertIsNone(metrics.current_span())
+
+
+class ChunkedUploadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="Клиника")
+        cls.doctor = User.objects.create(username="doctor", organization=organization)
+        cls.patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                             birth_date="1990-01-01", organization=organization)
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def start(self, length, filename='visit.mp3'):
+        response = self.client.post('/api/uploads/', {
+            'doctor': self.doctor.id, 'patient': self.patient.id, 'filename': filename,
+        }, content_type='application/json', HTTP_UPLOAD_LENGTH=str(length))
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def send(self, upload_id, data, offset):
+        return self.client.patch(f'/api/uploads/{upload_id}/', data, content_type='application/offset+octet-stream',
+                                 HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_resume_from_server_offset(self):
+        upload_id = self.start(10)
+
+        self.assertEqual(self.send(upload_id, b'abcd', 0).status_code, 204)
+        response = self.send(upload_id, b'abcd', 0)  # повтор уже полученного куска
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Upload-Offset'], '4')
+
+        response = self.client.head(f'/api/uploads/{upload_id}/')
+        self.assertEqual((response['Upload-Offset'], response['Upload-Length']), ('4', '10'))
+        self.assertEqual(self.send(upload_id, b'ef', 4)['Upload-Offset'], '6')
+
+    def test_chunk_is_not_written_while_another_request_holds_the_upload(self):
+        upload_id = self.start(10)
+        AudioUpload.objects.filter(id=upload_id).update(
+            lock_owner='other', locked_until=timezone.now() + timedelta(minutes=1),
+        )
+
+        response = self.send(upload_id, b'abcd', 0)
+        self.assertEqual((response.status_code, response['Upload-Offset']), (409, '0'))
+        self.assertEqual(AudioUpload.objects.get(id=upload_id).offset, 0)
+
+        # Аренда истекла (запрос завис) — повтор забирает загрузку и отпускает после записи
+        AudioUpload.objects.filter(id=upload_id).update(locked_until=timezone.now())
+        self.assertEqual(self.send(upload_id, b'abcd', 0)['Upload-Offset'], '4')
+        upload = AudioUpload.objects.get(id=upload_id)
+        self.assertEqual((upload.offset, upload.lock_owner, upload.locked_until), (4, '', None))
+
+    def test_not_audio_is_rejected_before_queue(self):
+        upload_id = self.start(8)
+
+        response = self.send(upload_id, b'not-mp3!', 0)
+
+        self.assertEqual(response.status_code, 422)
+        upload = AudioUpload.objects.get(id=upload_id)
+        self.assertEqual(upload.status, 'rejected')
+        self.assertIsNone(upload.consultation)
+        self.assertFalse(TranscriptionJob.objects.exists())
+        self.assertEqual(self.send(upload_id, b'', 8).status_code, 422)
+
+    @unittest.skipUnless(shutil.which('ffmpeg'), "нужен ffmpeg")
+    @override_settings(UPLOAD_SILENCE_SAMPLES=3, UPLOAD_SILENCE_SAMPLE_SECONDS=2.0)
+    def test_silence_is_checked_on_bounded_samples(self):
+        def record(name, tone_at=None):
+            audio = np.zeros(30 * 16000, np.int16)
+            if tone_at is not None:
+                t = np.arange(16000) / 16000
+                audio[tone_at * 16000:(tone_at + 1) * 16000] = 8000 * np.sin(2 * np.pi * 220 * t)
+            file_path = os.path.join(settings.MEDIA_ROOT, name)
+            with wave.open(file_path, 'wb') as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(16000)
+                f.writeframes(audio.tobytes())
+            return file_path
+
+        self.assertLessEqual(uploads.sampled_max_volume(record('silent.wav'), 30.0), settings.UPLOAD_SILENCE_DB)
+        # Отрезки 0-2, 14-16 и 28-30 с: речь в середине попадает в выборку
+        self.assertGreater(uploads.sampled_max_volume(record('voice.wav', tone_at=14), 30.0), -50)
+
+    @override_settings(UPLOAD_SILENCE_SAMPLES=5, UPLOAD_SILENCE_SAMPLE_SECONDS=20.0, UPLOAD_SILENCE_BUDGET_SECONDS=5.0)
+    def test_silence_check_fits_in_time_budget(self):
+        timeouts = []
+
+        def max_volume(file_path, start=0.0, seconds=None, timeout=60):
+            timeouts.append(timeout)
+            if len(timeouts) == 2:
+                raise subprocess.TimeoutExpired('ffmpeg', timeout)
+            return -90.0
+
+        original = uploads.max_volume
+        uploads.max_volume = max_volume
+        self.addCleanup(setattr, uploads, 'max_volume', original)
+
+        # Не успели проверить все отрезки — тишину не утверждаем, запись не отклоняем
+        self.assertIsNone(uploads.sampled_max_volume('long.mp3', 3600.0))
+        self.assertEqual(len(timeouts), 2)
+        self.assertTrue(all(0 < timeout <= 5.0 for timeout in timeouts))
+
+        with override_settings(UPLOAD_SILENCE_BUDGET_SECONDS=0):
+            self.assertIsNone(uploads.sampled_max_volume('long.mp3', 3600.0))
+        self.assertEqual(len(timeouts), 2)
+
+    def test_unsupported_extension(self):
+        response = self.client.post('/api/uploads/', {
+            'doctor': self.doctor.id, 'patient': self.patient.id, 'filename': 'visit.exe', 'length': 10,
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class NormalizationTests(SimpleTestCase):
+    def speech(self, seconds, amplitude):
+        t = np.arange(int(seconds * 16000)) / 16000
+        return (amplitude * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+    def test_trims_silence_at_edges(self):
+        audio = np.concatenate([np.zeros(3 * 16000, np.float32), self.speech(2, 0.1), np.zeros(16000, np.float32)])
+
+        start, end = normalization.trim_bounds(audio)
+
+        self.assertAlmostEqual(start / 16000, 3 - settings.AUDIO_TRIM_PADDING, delta=0.05)
+        self.assertAlmostEqual(end / 16000, 5 + settings.AUDIO_TRIM_PADDING, delta=0.05)
+
+    def test_quiet_speech_is_not_trimmed_after_a_click(self):
+        silence = lambda seconds: np.zeros(int(seconds * 16000), np.float32)
+        click = np.full(480, 0.5, np.float32)
+        # Речь около -57 dBFS — ниже AUDIO_TRIM_THRESHOLD_DB, громче всего щелчок в начале
+        audio = np.concatenate([silence(2), click, silence(1), self.speech(3, 0.002), silence(1)])
+
+        start, end = normalization.trim_bounds(audio)
+
+        self.assertAlmostEqual(start / 16000, 2 - settings.AUDIO_TRIM_PADDING, delta=0.05)
+        self.assertAlmostEqual(end / 16000, 6.03 + settings.AUDIO_TRIM_PADDING, delta=0.05)
+
+    def test_gain_targets_speech_level_without_clipping(self):
+        quiet = self.speech(2, 0.01)
+        gain = normalization.loudness_gain(quiet)
+        rms_db = 20 * np.log10(np.sqrt(np.mean((quiet * gain) ** 2)))
+        self.assertAlmostEqual(rms_db, settings.AUDIO_TARGET_DBFS, delta=0.5)
+
+        loud = self.speech(2, 0.9)
+        self.assertLessEqual(np.abs(loud * normalization.loudness_gain(loud)).max(), 1.0)
+
+    def test_pcm_stays_int16_until_a_chunk_is_used(self):
+        audio = np.concatenate([self.speech(70, 0.1), np.zeros(16000, np.float32), self.speech(5, 0.1)])
+        pcm = (audio * 32767).astype(np.int16)
+
+        # Паузы на int16 из mmap те же, что на float32; в float переводится только кусок
+        self.assertEqual(chunking.find_silences(pcm), chunking.find_silences(audio))
+        piece = chunking.as_float32(pcm[:16000])
+        self.assertEqual(piece.dtype, np.float32)
+        np.testing.assert_allclose(piece, audio[:16000], atol=1e-4)
+        self.assertIs(chunking.as_float32(audio), audio)
+
+    def test_timestamps_shift_back_to_original(self):
+        result = {'text': 'a', 'segments': [{'start': 0.5, 'end': 1.0, 'text': 'a'}]}
+        shifted = normalization.shift_result(result, 3.0)
+        self.assertEqual((shifted['segments'][0]['start'], shifted['segments'][0]['end']), (3.5, 4.0))
+
+
+@override_settings(CLINICAL_RULES_FILE=os.path.join(os.path.dirname(__file__), 'clinical_rules.json'))
+class ClinicalRulesGoldenTests(SimpleTestCase):
+    """
+    Эталонные отчеты по правилам из поставляемого clinical_rules.json. Правка файла,
+    меняющая диагноз или порядок находок, должна менять и эти ожидания — осознанно.
+    """
+    GOLDEN = [
+        ("Сильная головная боль, мигрень", "Головная боль напряжения (G44.2)", [('headache', 2.0)]),
+        ("Кашель и температура 38, болит горло", "ОРВИ (J06.9)", [('arvi', 3.0), ('gastritis', 0.2)]),
+        # Старая цепочка if/elif выбрала бы головную боль (первая ветка); теперь решает балл
+        ("Болит голова, кашель, температура, першит горло", "ОРВИ (J06.9)",
+         [('arvi', 3.0), ('headache', 1.0), ('gastritis', 0.2)]),
+        # Равный балл — порядок правил в файле, как у старой цепочки
+        ("Голова болит и кашель", "Головная боль напряжения (G44.2)",
+         [('headache', 1.0), ('arvi', 1.0), ('gastritis', 0.2)]),
+        ("ГОЛОВОКРУЖЕНИЕ и Температура", "Головная боль напряжения (G44.2)", [('headache', 1.0), ('arvi', 1.0)]),
+        ("Болит живот после еды", "Гастрит? Синдром раздраженного кишечника (K29.7)", [('gastritis', 1.2)]),
+        ("Болит колено", "Гастрит? Синдром раздраженного кишечника (K29.7)", [('gastritis', 0.2)]),
+        ("Кашёл сухой", "ОРВИ (J06.9)", [('arvi', 1.0)]),
+        ("Пришел на плановый осмотр", "Диагноз не уточнен", []),
+    ]
+
+    def test_reports_match_golden_output(self):
+        for text, diagnosis, ranking in self.GOLDEN:
+            with self.subTest(text=text):
+                report = json.loads(tasks.build_report(text))
+                self.assertEqual(report['diagnosis'], diagnosis)
+                self.assertEqual([(f['rule'], f['score']) for f in report['findings']], ranking)
+
+    def test_matches_point_into_original_text(self):
+        report = json.loads(tasks.build_report("Кашель и температура 38, болит горло"))
+        self.assertEqual(report['recommendations'], "Обильное питье, постельный режим, парацетамол.")
+        self.assertEqual(
+            [(m['start'], m['end'], m['text']) for m in report['findings'][0]['matches']],
+            [(0, 5, 'Кашел'), (9, 19, 'температур'), (31, 35, 'горл')],
+        )
+
+
+class DecodingFallbackTests(SimpleTestCase):
+    def result(self, avg_logprob=-0.3, compression_ratio=1.5, no_speech_prob=0.1):
+        return types.SimpleNamespace(avg_logprob=avg_logprob, compression_ratio=compression_ratio,
+                                     no_speech_prob=no_speech_prob)
+
+    def test_schedule_covers_all_temperatures(self):
+        model = types.SimpleNamespace(device=torch.device('cpu'))
+        schedule = audio_stream.decoding_options(model, {'beam_size': 5, 'best_of': 5}, 'ru', prompt=None)
+
+        self.assertEqual([o.temperature for o in schedule], list(audio_stream.TEMPERATURES))
+        self.assertEqual((schedule[0].beam_size, schedule[0].best_of), (5, None))
+        self.assertEqual((schedule[1].beam_size, schedule[1].best_of), (None, 5))
+        self.assertEqual(len(audio_stream.decoding_options(model, {'temperature': 0.0}, 'ru', prompt=None)), 1)
+
+    def test_fallback_thresholds_match_transcribe(self):
+        self.assertFalse(audio_stream.needs_fallback(self.result(), {}))
+        self.assertTrue(audio_stream.needs_fallback(self.result(compression_ratio=3.0), {}))  # зациклился
+        self.assertTrue(audio_stream.needs_fallback(self.result(avg_logprob=-1.5), {}))
+        # Неуверенность на тишине повтора не требует
+        self.assertFalse(audio_stream.needs_fallback(self.result(avg_logprob=-1.5, no_speech_prob=0.9), {}))
+        self.assertFalse(audio_stream.needs_fallback(self.result(avg_logprob=-1.5), {'logprob_threshold': None}))
+
+
+class FeatureCacheTests(SimpleTestCase):
+    def test_windows_match_whisper_log_mel(self):
+        import whisper
+
+        audio = np.random.default_rng(0).uniform(-0.5, 0.5, 16000 * 40).astype(np.float32)
+        raw = np.zeros((80, len(audio) // 160), np.float32)
+        feature_cache.raw_log_mel(audio, 80, raw)
+
+        windows = feature_cache.FeatureWindows(raw)
+        mel, n_samples, eof = windows.next(80)
+        expected = whisper.log_mel_spectrogram(audio[:480000])[:, :3000]
+        self.assertEqual((n_samples, eof), (480000, False))
+        # Последние кадры окна у Whisper дополнены отражением, в кэше за ними — продолжение записи
+        self.assertLess(float((mel - expected)[:, :-3].abs().max()), 1e-3)
+
+        windows.advance(n_samples)
+        mel, n_samples, eof = windows.next(80)
+        self.assertEqual((mel.shape[1], n_samples, eof), (3000, 160000, True))
+
+        # Последнее окно: нули дописаны в PCM до спектрограммы, как в model.transcribe()
+        expected = whisper.log_mel_spectrogram(audio[480000:], padding=480000 - 160000)
+        self.assertEqual(float((audio_stream.window_mel(audio[480000:], 80) - expected).abs().max()), 0.0)
+        edges = np.r_[0:3, 995:1005]  # кадры у начала окна и у конца записи
+        self.assertLess(float(np.delete((mel - expected).abs().numpy(), edges, axis=1).max()), 1e-3)
+
+    def test_evicts_least_recently_read(self):
+        import os
+
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media, FEATURE_CACHE_MAX_MB=1):
+            directory = os.path.join(media, feature_cache.FEATURES_DIR)
+            os.makedirs(directory)
+            for index, name in enumerate(('old', 'new')):
+                path = os.path.join(directory, f'{name}-80.npy')
+                with open(path, 'wb') as f:
+                    f.write(b'\0' * 700 * 1024)
+                os.utime(path, (1000 + index, 1000 + index))
+
+            self.assertEqual(feature_cache.evict(), 1)
+            self.assertEqual(os.listdir(directory), ['new-80.npy'])
+
+
+class ReprocessingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="Клиника")
+        cls.doctor = User.objects.create(username="doctor", organization=organization)
+        cls.patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                             birth_date="1990-01-01", organization=organization)
+
+    def add(self, report_version, final_report=None):
+        """Прием, распознанный текущей моделью, с отчетом по правилам report_version."""
+        consultation = Consultation.objects.create(doctor=self.doctor, patient=self.patient, status='ready',
+                                                   audio_file='consultations/audio/a.mp3', audio_hash='a' * 64)
+        label = backends.get_backend(settings.WHISPER_MODEL).label
+        ConsultationContent.objects.filter(consultation=consultation).update(
+            raw_transcription="Болит голова", generated_report='{"old": 1}', final_report=final_report or '{"old": 1}',
+            transcription_model=label, report_version=report_version,
+            transcription_key=transcription_cache.make_key('a' * 64, label, settings.WHISPER_DECODE_OPTIONS),
+        )
+        return consultation
+
+    def test_skips_unchanged_and_rebuilds_outdated_reports(self):
+        fresh = self.add(rule_engine.rules_version())
+        stale = self.add('old')
+        edited = self.add('old', final_report='{"edited": 1}')
+        job = reprocessing.create_job([fresh.id, stale.id, edited.id], settings.WHISPER_MODEL, batch_size=2)
+
+        self.assertTrue(reprocessing.run_batch(job))
+        self.assertTrue(reprocessing.run_batch(job))
+        self.assertFalse(reprocessing.run_batch(job))
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.done, job.skipped, job.failed), ('ready', 2, 1, 0))
+        stale_content = ConsultationContent.objects.get(consultation=stale)
+        self.assertEqual(stale_content.report_version, rule_engine.rules_version())
+        self.assertEqual(stale_content.final_report, stale_content.generated_report)
+        # Правку врача переобработка не затирает
+        self.assertEqual(ConsultationContent.objects.get(consultation=edited).final_report, '{"edited": 1}')
+        self.assertEqual(ConsultationContent.objects.get(consultation=fresh).generated_report, '{"old": 1}')
+
+
+    def test_one_whisper_pass_per_batch(self):
+        self.assertEqual(reprocessing.split_batches([1, 2, 3, 4, 5], 3, heavy=[2, 3]), [[1, 2], [3, 4, 5]])
+
+    def test_batch_of_killed_task_is_reclaimed(self):
+        stale = self.add('old')
+        job = reprocessing.create_job([stale.id], settings.WHISPER_MODEL)
+        self.assertEqual(reprocessing.claim(job, 'killed'), (0, [stale.id]))
+        # Задачу убил timeout: пачка в аренде, новых нет
+        self.assertEqual(reprocessing.claim(job, 'other'), (None, []))
+
+        leases = json.loads(ReprocessJob.objects.get(id=job.id).leases)
+        leases['0']['until'] = 0
+        ReprocessJob.objects.filter(id=job.id).update(leases=json.dumps(leases),
+                                                      updated_at=timezone.now() - timedelta(days=1))
+        job.refresh_from_db()
+        self.assertTrue(reprocessing.is_stalled(job))
+        self.assertTrue(reprocessing.run_batch(job))
+        # Опоздавший владелец не считает пачку второй раз
+        self.assertFalse(reprocessing.complete(job, 0, 'killed', 1, 0, 0, 0.0))
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.done, job.leases), ('ready', 1, '{}'))
+        self.assertFalse(reprocessing.is_stalled(job))
+
+class PdfCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name="Клиника")
+        cls.doctor = User.objects.create(username="doctor", organization=organization)
+        patient = Patient.objects.create(first_name="Анна", last_name="Смирнова",
+                                         birth_date="1990-01-01", organization=organization)
+        cls.consultation = Consultation.objects.create(doctor=cls.doctor, patient=patient, status='ready',
+                                                       audio_file='consultations/audio/a.mp3')
+        ConsultationContent.objects.filter(consultation=cls.consultation).update(
+            final_report='{"complaints": "Головная боль", "diagnosis": "G44.2"}')
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        override = override_settings(PDF_CACHE_DIR=cache_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.cache_dir = os.path.join(cache_dir, str(self.consultation.id))
+
+        self.renders = 0
+        original = pdf_reports.render
+
+        def render(context):
+            self.renders += 1
+            return original(context)
+
+        pdf_reports.render = render
+        self.addCleanup(setattr, pdf_reports, 'render', original)
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor)
+        self.url = f'/api/consultations/{self.consultation.id}/download_pdf/'
+
+    def test_pdf_is_rendered_once_and_revalidated_by_etag(self):
+        first = self.client.get(self.url)
+        etag = first['ETag']
+        self.assertEqual((first.status_code, self.renders), (200, 1))
+        self.assertTrue(b''.join(first.streaming_content).startswith(b'%PDF'))
+
+        self.assertEqual(self.client.get(self.url)['ETag'], etag)
+        not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((not_modified.status_code, not_modified['ETag']), (304, etag))
+        self.assertEqual(self.renders, 1)
+
+    def test_edited_report_invalidates_cached_pdf(self):
+        etag = self.client.get(self.url)['ETag']
+        ConsultationContent.objects.filter(consultation=self.consultation).update(
+            final_report='{"complaints": "Головная боль", "diagnosis": "G43.0"}')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.renders, 2)
+        # Старая версия удалена, на диске только актуальная
+        self.assertEqual(os.listdir(self.cache_dir), [response['ETag'].strip('"') + '.pdf'])
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.organization = Organization.objects.create(name="Клиника")
+        cls.other = Organization.objects.create(name="Другая клиника")
+        cls.doctor = User.objects.create(username="doctor", organization=cls.organization)
+        cls.stranger = User.objects.create(username="stranger", organization=cls.other)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor)
+        # Цепочку run_export не запускаем: проверяем только, что и с какими фильтрами ставится
+        self.started = []
+        original = views.async_task
+        views.async_task = lambda name, *args, **kwargs: self.started.append(args)
+        self.addCleanup(setattr, views, 'async_task', original)
+
+    def test_doctor_cannot_export_other_clinic(self):
+        response = self.client.get('/api/consultations/export/', {'organization': self.other.id, 'background': 1})
+
+        self.assertEqual(response.status_code, 202)
+        job = ExportJob.objects.get(id=response.data['id'])
+        self.assertEqual(json.loads(job.filters)['organization'], self.organization.id)
+        self.assertIn(APIClient().get('/api/consultations/export/').status_code, (401, 403))
+        # Чужая клиника не видит выгрузку
+        self.client.force_authenticate(self.stranger)
+        self.assertEqual(self.client.get(f'/api/exports/{job.id}/').status_code, 404)
+
+    def test_small_export_streams_zip_of_cached_pdfs(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        override = override_settings(PDF_CACHE_DIR=cache_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        def add(organization, last_name):
+            patient = Patient.objects.create(first_name="Анна", last_name=last_name,
+                                             birth_date="1990-01-01", organization=organization)
+            return Consultation.objects.create(doctor=self.doctor, patient=patient, status='ready',
+                                               audio_file='consultations/audio/a.mp3')
+
+        own = [add(self.organization, "Смирнова"), add(self.organization, "Иванова")]
+        add(self.other, "Петрова")
+        paths = {consultation.id: pdf_reports.get_or_render(consultation)[0] for consultation in own}
+        renders = []
+        original = pdf_reports.render
+        pdf_reports.render = lambda context: renders.append(context) or original(context)
+        self.addCleanup(setattr, pdf_reports, 'render', original)
+
+        response = self.client.get('/api/consultations/export/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        parts = list(response.streaming_content)
+        # Архив уходит по файлу, а не одним куском в конце
+        self.assertGreater(len([part for part in parts if part]), 2)
+        with zipfile.ZipFile(io.BytesIO(b''.join(parts))) as archive:
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(sorted(archive.namelist()), sorted(exports.archive_name(c) for c in own))
+            for consultation in own:
+                with open(paths[consultation.id], 'rb') as f:
+                    self.assertEqual(archive.read(exports.archive_name(consultation)), f.read())
+        self.assertEqual(renders, [])
+        self.assertEqual(self.started, [])
+
+    def test_resume_refuses_running_job(self):
+        job = exports.create_job({}, self.doctor)
+        ExportJob.objects.filter(id=job.id).update(status='running', last_id=5)
+
+        response = self.client.post(f'/api/exports/{job.id}/resume/')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.started, [])
+
+        # Цепочка молчит дольше EXPORT_JOB_STALE_SECONDS — воркер умер, продолжаем
+        ExportJob.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(days=1))
+        response = self.client.post(f'/api/exports/{job.id}/resume/')
+        self.assertEqual((response.status_code, response.data['status']), (202, 'running'))
+        self.assertEqual(self.started, [(job.id,)])
+
+    def test_resume_after_error_starts_one_chain(self):
+        job = exports.create_job({}, self.doctor)
+        ExportJob.objects.filter(id=job.id).update(status='error', error='boom')
+
+        self.assertEqual(self.client.post(f'/api/exports/{job.id}/resume/').status_code, 202)
+        # Повторный resume видит живую цепочку
+        self.assertEqual(self.client.post(f'/api/exports/{job.id}/resume/').status_code, 409)
+        self.assertEqual(self.started, [(job.id,)])
+        self.assertEqual(ExportJob.objects.get(id=job.id).error, '')
+
+
+class LocalExecutorTests(SimpleTestCase):
+    @override_settings(WHISPER_PRELOAD_MODELS=[])
+    def test_bounded_queue_rejects_overflow(self):
+        executor = ai_service.LocalExecutor(workers=1, queue_limit=1)
+        release = threading.Event()
+        done = []
+
+        executor.submit(release.wait)
+        deadline = time.monotonic() + 5
+        while executor.stats()['busy'] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        executor.submit(done.append, 1)
+        with self.assertRaises(transcription_queue.QueueFull):
+            executor.submit(done.append, 2)
+        self.assertEqual((executor.stats()['busy'], executor.stats()['queued']), (1, 1))
+
+        release.set()
+        executor.join()
+        self.assertEqual(done, [1])
+        stats = executor.stats()
+        self.assertEqual((stats['completed'], stats['rejected'], stats['queued']), (2, 1, 0))
+
+    def test_pool_threads_share_model_one_at_a_time(self):
+        model = torch.nn.Linear(1, 1)
+        inside, overlaps = [], []
+
+        def infer():
+            with whisper_models.inference(model):
+                inside.append(1)
+                overlaps.append(len(inside))
+                time.sleep(0.02)
+                inside.pop()
+
+        executor = ai_service.LocalExecutor(workers=3, queue_limit=10)
+        with override_settings(WHISPER_PRELOAD_MODELS=[]):
+            for _ in range(6):
+                executor.submit(infer)
+            executor.join()
+        self.assertEqual((len(overlaps), max(overlaps)), (6, 1))
+
+    def test_app_starts_without_django_q(self):
+        # Отдельный процесс: в этом django_q уже импортирован
+        script = (
+            "import sys; sys.modules['django_q'] = None\n"
+            "import django; django.setup()\n"
+            "from django.conf import settings\n"
+            "from django.core.management import call_command\n"
+            "from api import ai_service, signals, views\n"
+            "call_command('check')\n"
+            "assert 'django_q' not in settings.INSTALLED_APPS\n"
+            "assert ai_service.local_mode()\n"
+        )
+        result = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=os.environ.copy(),
+                                capture_output=True, text=True, timeout=120)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class BackendSelectionTests(SimpleTestCase):
+    @override_settings(TRANSCRIPTION_BACKEND='whisper-int8', WHISPER_MODEL='tiny')
+    def test_backend_comes_from_settings_and_keys_the_cache(self):
+        backend = backends.get_backend()
+        self.assertIsInstance(backend, backends.QuantizedWhisperBackend)
+        self.assertEqual((backend.model_name, backend.compute_type), ('tiny', 'int8'))
+        # int8 распознает иначе — у кэша транскрибаций свой ключ
+        self.assertNotEqual(backend.label, backends.get_backend(name='whisper').label)
+
+        with self.assertRaises(ValueError):
+            backends.get_backend(name='faster-whisper')
+
+    def test_int8_quantizes_linear_layers_on_cpu_only(self):
+        full = whisper_models._load('tiny', 'cpu', 'float32')
+        quantized = whisper_models._load('tiny', 'cpu', 'int8')
+
+        self.assertFalse(any(type(m) is torch.nn.Linear for m in quantized.modules()))
+        self.assertTrue(any(isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in quantized.modules()))
+        # Эмбеддинг токенов остается float32, сжимаются только линейные слои
+        self.assertLess(whisper_models._model_size_bytes(quantized), whisper_models._model_size_bytes(full))
+
+        with self.assertRaises(ValueError):
+            whisper_models._load('tiny', 'cuda', 'int8')
+        with self.assertRaises(ValueError):
+            whisper_models._load('tiny', 'cpu', 'int4')
+
+
+class ModelRegistryTests(SimpleTestCase):
+    def setUp(self):
+        whisper_models.clear()
+        self.addCleanup(whisper_models.clear)
+        self.resident_at_load = []
+
+        def load(name, device, compute_type):
+            self.resident_at_load.append([key[0] for key in whisper_models._models])
+            return torch.nn.Linear(1000, 1000)  # ~4 МБ float32
+
+        original = whisper_models._load
+        whisper_models._load = load
+        self.addCleanup(setattr, whisper_models, '_load', original)
+
+    @override_settings(WHISPER_MODEL_MEMORY_LIMIT_MB=6)
+    def test_room_is_made_before_loading(self):
+        whisper_models.get_model('tiny')
+        whisper_models.get_model('base')  # по таблице ~300 МБ: tiny выгружаем до загрузки
+        whisper_models.get_model('tiny')  # размер известен с прошлой загрузки: 4 + 4 > 6
+
+        self.assertEqual(self.resident_at_load, [[], [], []])
+        self.assertEqual(list(whisper_models.stats()['resident']), ['tiny/cpu/float32'])
+
+    @override_settings(WHISPER_MODEL_MEMORY_LIMIT_MB=10)
+    def test_loading_does_not_block_other_models(self):
+        warm = whisper_models.get_model('tiny')
+        started, release = threading.Event(), threading.Event()
+        loads = []
+
+        def slow_load(name, device, compute_type):
+            loads.append(name)
+            started.set()
+            release.wait(5)
+            return torch.nn.Linear(10, 10)
+
+        whisper_models._load = slow_load
+        self.addCleanup(release.set)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(whisper_models.get_model('/models/clinic-c.pt')))
+                   for _ in range(2)]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        threads[1].start()
+
+        # Пока своя модель клиники грузится, теплая модель и распознавание ею не ждут
+        done = threading.Event()
+
+        def use_warm():
+            with whisper_models.inference(whisper_models.get_model('tiny')):
+                done.set()
+
+        threading.Thread(target=use_warm).start()
+        self.assertTrue(done.wait(2))
+
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(loads, ['/models/clinic-c.pt'])
+        self.assertIs(results[0], results[1])
+        self.assertIs(whisper_models.get_model('tiny'), warm)
+
+    @override_settings(WHISPER_MODEL_MEMORY_LIMIT_MB=10)
+    def test_models_that_fit_stay_loaded(self):
+        whisper_models.get_model('/models/clinic-a.pt')  # свой чекпойнт: размер заранее не знаем
+        whisper_models.get_model('/models/clinic-b.pt')
+        whisper_models.get_model('/models/clinic-a.pt')
+
+        self.assertEqual(self.resident_at_load, [[], ['/models/clinic-a.pt']])
+        self.assertEqual(whisper_models.stats()['evictions'], 0)
 
-# Create your tests here.
@@ -0,0 +1,116 @@
+"""
+Кэш транскрибаций по содержимому аудио.
+
+Повторно загруженный файл (тот же SHA-256) с той же моделью и теми же
+параметрами распознавания не гоняется через Whisper второй раз.
+"""
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import Consultation, TranscriptionCache
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file_obj):
+    """SHA-256 файла (UploadedFile, FieldFile или обычного файла), читаем кусками."""
+    hasher = hashlib.sha256()
+    if hasattr(file_obj, 'chunks'):
+        for chunk in file_obj.chunks(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+    else:
+        for chunk in iter(lambda: file_obj.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    if hasattr(file_obj, 'seek'):
+        file_obj.seek(0)
+    return hasher.hexdigest()
+
+
+def stored_audio(audio_hash):
+    """Имя уже загруженного файла с тем же содержимым (если он еще на диске) или None."""
+    duplicate = (
+        Consultation.objects.filter(audio_hash=audio_hash)
+        .exclude(audio_file='')
+        .only('audio_file')
+        .first()
+    )
+    if duplicate is not None and duplicate.audio_file.storage.exists(duplicate.audio_file.name):
+        return duplicate.audio_file.name
+    return None
+
+
+def make_key(audio_hash, model_name, options):
+    payload = json.dumps([audio_hash, model_name, options or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _compact_segments(segments):
+    """Из сегментов Whisper оставляем только то, что нужно дальше по конвейеру."""
+    keep = ('start', 'end', 'text', 'avg_logprob', 'no_speech_prob')
+    compact = []
+    for seg in segments or []:
+        item = {k: seg[k] for k in keep if k in seg}
+        if seg.get('words'):
+            item['words'] = [{k: w[k] for k in ('start', 'end', 'word')} for w in seg['words']]
+        compact.append(item)
+    return compact
+
+
+def get(audio_hash, model_name, options):
+    """Возвращает {'text': ..., 'segments': [...]} или None."""
+    if not audio_hash:
+        return None
+    key = make_key(audio_hash, model_name, options)
+    entry = TranscriptionCache.objects.filter(key=key).first()
+    if entry is None:
+        return None
+
+    TranscriptionCache.objects.filter(pk=entry.pk).update(hits=F('hits') + 1, last_used_at=timezone.now())
+    return {
+        'text': entry.text,
+        'segments': json.loads(entry.segments) if entry.segments else [],
+    }
+
+
+def put(audio_hash, model_name, options, result):
+    """Сохраняет результат model.transcribe() в кэш и чистит старые записи."""
+    if not audio_hash:
+        return
+    segments = json.dumps(_compact_segments(result.get('segments')), ensure_ascii=False)
+    text = result['text']
+    TranscriptionCache.objects.update_or_create(
+        key=make_key(audio_hash, model_name, options),
+        defaults={
+            'audio_hash': audio_hash,
+            'model_name': model_name,
+            'options': json.dumps(options or {}, sort_keys=True, ensure_ascii=False),
+            'text': text,
+            'segments': segments,
+            'size_bytes': len(text.encode('utf-8')) + len(segments.encode('utf-8')),
+        },
+    )
+    evict()
+
+
+def evict():
+    """Удаляем записи старше срока хранения и самые давние, если кэш больше лимита."""
+    max_age = timezone.now() - timedelta(days=settings.TRANSCRIPTION_CACHE_MAX_AGE_DAYS)
+    TranscriptionCache.objects.filter(last_used_at__lt=max_age).delete()
+
+    limit = settings.TRANSCRIPTION_CACHE_MAX_MB * 1024 * 1024
+    total = TranscriptionCache.objects.aggregate(total=Sum('size_bytes'))['total'] or 0
+    if total <= limit:
+        return
+
+    stale_ids = []
+    for pk, size in TranscriptionCache.objects.order_by('last_used_at').values_list('pk', 'size_bytes'):
+        if total <= limit:
+            break
+        stale_ids.append(pk)
+        total -= size
+    TranscriptionCache.objects.filter(pk__in=stale_ids).delete()
@@ -0,0 +1,448 @@
+"""
+Очередь транскрибации с честным делением между клиниками.
+
+Django Q — одна FIFO-очередь: клиника, загрузившая записи за весь день, занимает
+воркеры на часы, а остальные ждут. Поэтому загрузка ставит консультацию сюда
+(TranscriptionJob), а в Django Q задача уходит, только когда для нее есть слот:
+всего не больше TRANSCRIPTION_MAX_RUNNING, от одной клиники не больше ее лимита.
+
+Кому отдать освободившийся слот:
+  1. срочный прием (is_urgent) — раньше всех;
+  2. клиника, у которой сейчас меньше всего задач в работе;
+  3. при равенстве — клиника, которую обслуживали давнее остальных.
+Внутри клиники: срочные, потом короткие записи (длительность из метаданных файла),
+потом остальные по времени загрузки. Обычная запись, прождавшая дольше
+TRANSCRIPTION_AGING_SECONDS, идет наравне с короткими — длинные не голодают.
+
+Когда в очереди больше queue_limit записей, загрузка отвечает 429 (QueueFull).
+
+Задача выдается в аренду (owner + lease_until). Воркер берет ее через acquire():
+повторная доставка той же консультации (retry Django Q, двойной запуск) при живой
+аренде просто пропускается. Пройденные этапы (transcribed/reported)
+сохраняются в stage через checkpoint() — повтор продолжает со следующего этапа.
+Распознавание длинной записи идет дольше аренды — на это время heartbeat() продлевает ее
+из отдельного потока.
+Воркер умер или его убил timeout — аренда истекает, reap() возвращает задачу
+в очередь (после TRANSCRIPTION_MAX_ATTEMPTS попыток — в ошибку).
+"""
+import json
+import os
+import re
+import socket
+import subprocess
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Count, F, Max, Min
+from django.utils import timezone
+
+from . import metrics, progress
+from .models import Consultation, Organization, TranscriptionJob
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+# Окно, за которое считаем время ожидания в метриках
+WAIT_WINDOW = timedelta(hours=1)
+
+DURATION_RE = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+class QueueFull(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LeaseLost(Exception):
+    """Аренду забрал reap(): задача уже у другого воркера, эту работу надо бросить."""
+
+
+def worker_id():
+    """Уникальный владелец аренды: хост, процесс и случайный хвост (на случай переиспользования pid)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _lease_deadline(now=None):
+    return (now or timezone.now()) + timedelta(seconds=settings.TRANSCRIPTION_LEASE_SECONDS)
+
+
+def probe_duration(path):
+    """
+    Длительность записи по метаданным контейнера, без декодирования. None — не удалось.
+    ffprobe есть не везде (на Windows часто лежит только ffmpeg.exe) — тогда читаем шапку из ffmpeg -i.
+    """
+    try:
+        output = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', path],
+            capture_output=True, timeout=10, check=True,
+        ).stdout
+        return float(json.loads(output)['format']['duration'])
+    except FileNotFoundError:
+        pass
+    except (OSError, subprocess.SubprocessError, ValueError, KeyError, TypeError):
+        return None
+
+    try:
+        # Без выходного файла ffmpeg завершается с ошибкой, но шапку входа успевает напечатать
+        stderr = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-i', path],
+                                capture_output=True, timeout=10).stderr.decode(errors='replace')
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = DURATION_RE.search(stderr)
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def org_max_running(organization):
+    """Сколько задач клиники может быть в работе; None — ограничивает только общий лимит."""
+    return organization.max_running_transcriptions or settings.TRANSCRIPTION_ORG_MAX_RUNNING or None
+
+
+def org_queue_limit(organization):
+    return organization.queue_limit or settings.TRANSCRIPTION_ORG_QUEUE_LIMIT
+
+
+def check_capacity(organization):
+    """Перед сохранением загрузки: если очередь переполнена — QueueFull (клиенту 429)."""
+    # Импорт внутри: api/ai_service.py сам импортирует этот модуль
+    from . import ai_service
+    ai_service.check_capacity()
+    queued = TranscriptionJob.objects.filter(status='queued')
+    if queued.filter(organization=organization).count() >= org_queue_limit(organization):
+        raise QueueFull(
+            f"В очереди клиники уже {org_queue_limit(organization)} записей, повторите загрузку позже",
+            settings.TRANSCRIPTION_RETRY_AFTER,
+        )
+    if queued.count() >= settings.TRANSCRIPTION_QUEUE_LIMIT:
+        raise QueueFull("Очередь транскрибации переполнена, повторите загрузку позже",
+                        settings.TRANSCRIPTION_RETRY_AFTER)
+
+
+def _organization_id(consultation_id):
+    return Consultation.objects.filter(id=consultation_id).values_list('patient__organization_id', flat=True)[0]
+
+
+def enqueue(consultation, force=False, duration=None):
+    """
+    Ставит консультацию в очередь (duration — если длительность уже известна, файл не читаем). Повторная постановка той же консультации схлопывается:
+    ждущая или выполняющаяся задача остается как есть, готовая — тоже (force=True — пересчитать заново).
+    Задача с ошибкой возвращается в очередь и продолжит с последнего пройденного этапа.
+    """
+    existing = TranscriptionJob.objects.filter(consultation=consultation).first()
+    if existing is not None and not force and existing.status != 'error':
+        return existing
+
+    if duration is None:
+        duration = probe_duration(consultation.audio_file.path)
+    if consultation.is_urgent:
+        priority = 0
+    elif duration is not None and duration <= settings.TRANSCRIPTION_SHORT_SECONDS:
+        priority = 1
+    else:
+        priority = 2
+
+    defaults = {
+        'organization_id': _organization_id(consultation.id),
+        'priority': priority,
+        'duration': duration,
+        'status': 'queued',
+        'enqueued_at': timezone.now(),
+        'started_at': None,
+        'finished_at': None,
+        'owner': '',
+        'lease_until': None,
+        'attempts': 0,
+    }
+    if force:
+        defaults['stage'] = ''
+    with transaction.atomic():
+        job, created = TranscriptionJob.objects.select_for_update().get_or_create(
+            consultation=consultation, defaults=defaults,
+        )
+        # Пока мы читали файл, задачу мог поставить кто-то еще — повторяем проверку под блокировкой.
+        # Выполняющуюся задачу не сбиваем даже с force
+        if not created and job.status != 'running' and (force or job.status == 'error'):
+            for name, value in defaults.items():
+                setattr(job, name, value)
+            job.save()
+    return job
+
+
+def _effective_priority(job, now):
+    if job.priority == 2 and (now - job.enqueued_at).total_seconds() > settings.TRANSCRIPTION_AGING_SECONDS:
+        return 1
+    return job.priority
+
+
+def claim(limit=None, owner=''):
+    """
+    Выбирает задачи по правилам из docstring модуля и помечает их 'running' с арендой.
+    limit=None — сколько свободно из TRANSCRIPTION_MAX_RUNNING; пакетный планировщик передает свой
+    лимит и себя как owner (задачи Django Q арендует воркер уже в acquire()).
+    Возвращает id консультаций в порядке выдачи.
+    """
+    from . import ai_service
+
+    now = timezone.now()
+    with transaction.atomic():
+        # Блокируем все активные задачи: два раздающих процесса не выдадут один слот дважды
+        active = list(TranscriptionJob.objects.select_for_update().filter(status__in=ACTIVE_STATUSES))
+        running, queues = {}, {}
+        for job in active:
+            if job.status == 'running':
+                running[job.organization_id] = running.get(job.organization_id, 0) + 1
+            else:
+                queues.setdefault(job.organization_id, []).append(job)
+        if limit is None:
+            limit = settings.TRANSCRIPTION_MAX_RUNNING - sum(running.values())
+            free = ai_service.free_slots()
+            if free is not None:
+                # Встроенный пул: не больше свободных потоков, иначе аренда истечет, пока задача ждет в пуле
+                limit = min(limit, free)
+        if not queues or limit <= 0:
+            return []
+
+        for jobs in queues.values():
+            jobs.sort(key=lambda job: (_effective_priority(job, now), job.enqueued_at, job.id))
+        caps = {org.id: org_max_running(org) for org in Organization.objects.filter(id__in=queues)}
+        last_served = dict(
+            TranscriptionJob.objects.filter(organization_id__in=queues, started_at__isnull=False)
+            .values('organization_id').annotate(last=Max('started_at')).values_list('organization_id', 'last')
+        )
+        never = now - timedelta(days=36500)
+
+        picked = []
+        while len(picked) < limit:
+            candidates = [org_id for org_id, jobs in queues.items()
+                          if jobs and (caps[org_id] is None or running.get(org_id, 0) < caps[org_id])]
+            if not candidates:
+                break
+            org_id = min(candidates, key=lambda org_id: (
+                queues[org_id][0].priority != 0,
+                running.get(org_id, 0),
+                last_served.get(org_id) or never,
+            ))
+            job = queues[org_id].pop(0)
+            running[org_id] = running.get(org_id, 0) + 1
+            last_served[org_id] = now
+            picked.append(job)
+
+        TranscriptionJob.objects.filter(id__in=[job.id for job in picked]).update(
+            status='running', started_at=now, owner=owner, lease_until=_lease_deadline(now),
+            attempts=F('attempts') + 1,
+        )
+
+    for job in picked:
+        wait = (now - job.enqueued_at).total_seconds()
+        print(f"⏳ [Queue] Консультация {job.consultation_id} (клиника {job.organization_id}) ждала {wait:.0f} c")
+    return [job.consultation_id for job in picked]
+
+
+def dispatch():
+    """
+    Раздает свободные слоты: вызывается после загрузки и после каждой завершенной задачи.
+    В режиме пакетного планировщика слоты забирает он сам (batch_scheduler.claim_consultations).
+    """
+    reap()
+    if settings.WHISPER_BATCH_SCHEDULER:
+        return []
+    consultation_ids = claim()
+    for consultation_id in consultation_ids:
+        transaction.on_commit(lambda consultation_id=consultation_id: _submit(consultation_id))
+    return consultation_ids
+
+
+def _submit(consultation_id):
+    from . import ai_service
+    try:
+        ai_service.async_task('api.tasks.process_audio', consultation_id)
+    except ai_service.ExecutorFull:
+        # Встроенный пул занят — задача ждет следующей раздачи слотов в очереди
+        release(consultation_id)
+
+
+def acquire(consultation_id, owner):
+    """
+    Воркер берет задачу в работу. None — запускать не нужно: консультация уже готова,
+    упала с ошибкой или ее держит другой воркер с живой арендой (дубль задачи).
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job = TranscriptionJob.objects.select_for_update().filter(consultation_id=consultation_id).first()
+        if job is None:
+            # Задача поставлена в обход очереди (старые задачи в Django Q, ai_service)
+            try:
+                with transaction.atomic():
+                    job = TranscriptionJob.objects.create(
+                        consultation_id=consultation_id, organization_id=_organization_id(consultation_id),
+                        status='queued', enqueued_at=now,
+                    )
+            except IntegrityError:
+                job = TranscriptionJob.objects.select_for_update().get(consultation_id=consultation_id)
+
+        if job.status in ('done', 'error'):
+            return None
+        if job.status == 'running' and job.owner and job.owner != owner and job.lease_until > now:
+            return None
+
+        if job.status == 'queued':
+            # Очередь эту задачу не выдавала — попытка считается здесь
+            job.attempts += 1
+        job.status = 'running'
+        job.owner = owner
+        job.lease_until = _lease_deadline(now)
+        job.started_at = job.started_at or now
+        job.save(update_fields=['status', 'owner', 'lease_until', 'started_at', 'attempts'])
+    return job
+
+
+def checkpoint(job, stage):
+    """Этап пройден: запоминаем его и продлеваем аренду. Аренду уже забрали — LeaseLost."""
+    updated = TranscriptionJob.objects.filter(id=job.id, owner=job.owner, status='running').update(
+        stage=stage, lease_until=_lease_deadline(),
+    )
+    if not updated:
+        raise LeaseLost(f"Аренда задачи консультации {job.consultation_id} потеряна")
+    job.stage = stage
+
+
+def renew(consultation_ids, owner):
+    """Продлить аренду (пакетный планировщик держит записи дольше одной задачи). Возвращает, скольким продлили."""
+    return TranscriptionJob.objects.filter(
+        consultation_id__in=consultation_ids, owner=owner, status='running',
+    ).update(lease_until=_lease_deadline())
+
+
+@contextmanager
+def heartbeat(job, interval=None):
+    """
+    Продлевает аренду job, пока идет долгий этап: checkpoint() бывает только между этапами,
+    а распознавание длинной записи идет дольше TRANSCRIPTION_LEASE_SECONDS — без продления
+    reap() вернул бы живую задачу в очередь. Процесс воркера убили — умер и этот поток,
+    аренда истечет как обычно. Аренду уже забрали — продлевать перестаем, LeaseLost
+    бросит следующий checkpoint().
+    """
+    interval = interval or max(1, settings.TRANSCRIPTION_LEASE_SECONDS / 3)
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                if not renew([job.consultation_id], job.owner):
+                    break
+        except Exception as e:
+            print(f"⚠️ [Queue] Не удалось продлить аренду консультации {job.consultation_id}: {e}")
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=beat, name=f'lease-{job.consultation_id}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def release(consultation_id, owner=None):
+    """Задачу выдали, но запустить не смогли: обратно в очередь, попытка не считается."""
+    jobs = TranscriptionJob.objects.filter(consultation_id=consultation_id, status='running')
+    if owner is not None:
+        jobs = jobs.filter(owner=owner)
+    jobs.update(status='queued', owner='', lease_until=None, attempts=F('attempts') - 1)
+
+
+def finish(consultation_id, ok=True, owner=None):
+    """Задача закончена. owner — чтобы опоздавший воркер не перезаписал задачу, уже отданную другому."""
+    jobs = TranscriptionJob.objects.filter(consultation_id=consultation_id, status='running')
+    if owner is not None:
+        jobs = jobs.filter(owner=owner)
+    jobs.update(status='done' if ok else 'error', finished_at=timezone.now(), lease_until=None)
+
+
+def reap():
+    """
+    Задачи с истекшей арендой (воркер умер, задачу убил timeout) — обратно в очередь
+    с сохраненным этапом; исчерпавшие TRANSCRIPTION_MAX_ATTEMPTS — в ошибку.
+    Возвращает (возвращено в очередь, сдались).
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        expired = list(
+            TranscriptionJob.objects.select_for_update(skip_locked=True)
+            .filter(status='running', lease_until__lt=now)
+        )
+        if not expired:
+            return 0, 0
+        retry = [job.consultation_id for job in expired if job.attempts < settings.TRANSCRIPTION_MAX_ATTEMPTS]
+        failed = [job.consultation_id for job in expired if job.attempts >= settings.TRANSCRIPTION_MAX_ATTEMPTS]
+
+        TranscriptionJob.objects.filter(consultation_id__in=retry).update(status='queued', owner='', lease_until=None)
+        TranscriptionJob.objects.filter(consultation_id__in=failed).update(
+            status='error', owner='', lease_until=None, finished_at=now,
+        )
+        Consultation.objects.filter(id__in=retry).update(status='created')
+        Consultation.objects.filter(id__in=failed).update(status='error')
+
+    for consultation_id in retry:
+        print(f"♻️ [Queue] Аренда консультации {consultation_id} истекла, возвращаю в очередь")
+        progress.status(consultation_id, 'created')
+    for consultation_id in failed:
+        print(f"❌ [Queue] Консультация {consultation_id}: попытки исчерпаны")
+        progress.status(consultation_id, 'error')
+    return len(retry), len(failed)
+
+
+def _rounded(value):
+    return None if value is None else round(value, 1)
+
+
+def stats(organization_id=None):
+    """
+    Метрики очереди по клиникам: сколько ждет и выполняется, сколько ждет самая старая
+    запись, p50/p95 ожидания слота за последний час.
+    """
+    now = timezone.now()
+    jobs = TranscriptionJob.objects.all()
+    if organization_id is not None:
+        jobs = jobs.filter(organization_id=organization_id)
+
+    result = {}
+    for row in jobs.filter(status__in=ACTIVE_STATUSES).values('organization_id', 'status').annotate(n=Count('id')):
+        result.setdefault(row['organization_id'], {})[row['status']] = row['n']
+
+    oldest = dict(
+        jobs.filter(status='queued').values('organization_id').annotate(first=Min('enqueued_at'))
+        .values_list('organization_id', 'first')
+    )
+
+    waits = {}
+    for org_id, enqueued_at, started_at in (
+        jobs.filter(started_at__gte=now - WAIT_WINDOW).values_list('organization_id', 'enqueued_at', 'started_at')
+    ):
+        waits.setdefault(org_id, []).append((started_at - enqueued_at).total_seconds())
+
+    organizations = Organization.objects.filter(id__in=set(result) | set(waits)).order_by('name')
+    report = []
+    for org in organizations:
+        org_waits = sorted(waits.get(org.id, []))
+        counts = result.get(org.id, {})
+        report.append({
+            'organization': org.id,
+            'name': org.name,
+            'queued': counts.get('queued', 0),
+            'running': counts.get('running', 0),
+            'max_running': org_max_running(org),
+            'queue_limit': org_queue_limit(org),
+            'oldest_wait_seconds': round((now - oldest[org.id]).total_seconds(), 1) if org.id in oldest else None,
+            'started_last_hour': len(org_waits),
+            'wait_p50_seconds': _rounded(metrics.percentile(org_waits, 0.5)),
+            'wait_p95_seconds': _rounded(metrics.percentile(org_waits, 0.95)),
+        })
+    return report
@@ -0,0 +1,105 @@
+"""
+Двухуровневая транскрибация "черновик -> уточнение".
+
+Быстрая модель (WHISPER_DRAFT_MODEL) за секунды даёт черновик, который сразу
+виден врачу. Затем большая модель (WHISPER_MODEL) перераспознаёт только
+сомнительные сегменты — по avg_logprob / no_speech_prob от Whisper.
+Уверенные участки повторно не гоняются.
+"""
+from django.conf import settings
+
+from . import backends
+from .chunking import SAMPLE_RATE, as_float32, shift_segment
+
+# Небольшой запас по краям, чтобы не обрезать слова на границе сегмента
+PAD_SECONDS = 0.3
+
+
+def model_label():
+    """Имя "модели" для ключа кэша: результат зависит от обеих моделей."""
+    return f"{backends.get_backend(settings.WHISPER_DRAFT_MODEL).label}>{backends.get_backend().label}"
+
+
+def is_low_confidence(segment):
+    return (
+        segment.get('avg_logprob', 0.0) < settings.WHISPER_REFINE_LOGPROB_THRESHOLD
+        or segment.get('no_speech_prob', 0.0) > settings.WHISPER_REFINE_NO_SPEECH_THRESHOLD
+    )
+
+
+def low_confidence_spans(segments):
+    """Соседние сомнительные сегменты объединяем: [(первый индекс, последний индекс), ...]."""
+    spans = []
+    for i, segment in enumerate(segments):
+        if not is_low_confidence(segment):
+            continue
+        if spans and spans[-1][1] == i - 1:
+            spans[-1] = (spans[-1][0], i)
+        else:
+            spans.append((i, i))
+    return spans
+
+
+def clip_segment(seg, lo, hi):
+    """
+    Сегмент уточнения -> в границы заменяемых сегментов черновика [lo, hi].
+    Запас PAD_SECONDS захватывает края соседних сегментов: без обрезки их слова
+    попадут в текст второй раз. Сегмент (слово) оставляем, если его середина внутри;
+    None — сегмент целиком пришелся на запас.
+    """
+    if not lo <= (seg['start'] + seg['end']) / 2 < hi:
+        return None
+    clipped = dict(seg, start=max(seg['start'], lo), end=min(seg['end'], hi))
+    if seg.get('words'):
+        words = [w for w in seg['words'] if lo <= (w['start'] + w['end']) / 2 < hi]
+        if not words:
+            return None
+        clipped['words'] = words
+        clipped['text'] = ''.join(w['word'] for w in words)
+    return clipped
+
+
+def draft(audio, options):
+    return backends.get_backend(settings.WHISPER_DRAFT_MODEL).transcribe(as_float32(audio), **options)
+
+
+def refine(audio, draft_result, options):
+    """
+    Перераспознаёт сомнительные участки черновика большой моделью
+    и вклеивает результат на их место. Возвращает словарь как у model.transcribe().
+    """
+    segments = draft_result['segments']
+    spans = low_confidence_spans(segments)
+    print(f"🔍 [Refine] Сомнительных участков: {len(spans)} из {len(segments)} сегментов")
+    if not spans:
+        return draft_result
+
+    backend = backends.get_backend()
+    refined = {}
+    for first, last in spans:
+        start = max(0.0, segments[first]['start'] - PAD_SECONDS)
+        end = segments[last]['end'] + PAD_SECONDS
+        piece = audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)]
+        result = backend.transcribe(as_float32(piece), **options)
+        lo, hi = segments[first]['start'], segments[last]['end']
+        shifted = (shift_segment(seg, start, limit=end) for seg in result['segments'])
+        refined[first] = (last, [seg for seg in (clip_segment(s, lo, hi) for s in shifted) if seg is not None])
+
+    merged = []
+    i = 0
+    while i < len(segments):
+        if i in refined:
+            last, replacement = refined[i]
+            merged.extend(replacement)
+            i = last + 1
+        else:
+            merged.append(segments[i])
+            i += 1
+    for index, segment in enumerate(merged):
+        segment['id'] = index
+
+    return {
+        'text': ''.join(seg['text'] for seg in merged),
+        'segments': merged,
+        'language': draft_result.get('language'),
+    }
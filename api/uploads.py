@@ -0,0 +1,368 @@
+"""
+Загрузка записей по частям (в духе протокола tus).
+
+Обычный POST /api/consultations/ с multipart целиком буферизует файл до perform_create:
+200 МБ с телефона держат sync-воркер gunicorn всю передачу, а проверяется только расширение.
+Здесь клиент создает загрузку (POST /api/uploads/, Upload-Length), затем шлет куски
+PATCH-запросами с Upload-Offset. Кусок пишется на диск блоками прямо из потока запроса,
+хэш считается по ходу. Оборвалась связь — HEAD вернет, сколько байт уже лежит на диске.
+
+Шапку файла проверяем ffprobe, как только она пришла (нет аудиодорожки — отказ сразу,
+не дожидаясь остальных сотен мегабайт). Последний кусок: длительность, тишина (по отрезкам записи,
+не дольше UPLOAD_SILENCE_BUDGET_SECONDS на все), и только потом консультация и очередь транскрибации.
+"""
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.utils import timezone
+
+from . import transcription_cache
+from .live import OffsetMismatch
+from .models import AudioUpload, Consultation
+from .transcription_queue import DURATION_RE
+
+BLOCK_SIZE = 1024 * 1024
+
+AUDIO_STREAM_RE = re.compile(r'Stream #\S+: Audio: (\w+)')
+MAX_VOLUME_RE = re.compile(r'max_volume: (-?[\d.]+|-inf) dB')
+
+# Хэш недокачанных файлов в памяти процесса: следующий кусок обычно приходит в тот же воркер.
+# Пришел в другой — досчитываем префикс с диска (локальное чтение дешевле передачи по сети).
+# Словарь общий для потоков воркера (gthread, ASGI) — только под _hashers_lock
+_hashers = {}
+_hashers_lock = threading.Lock()
+MAX_HASHERS = 256
+
+
+class UploadRejected(Exception):
+    """Запись не годится для транскрибации: файл удален, загрузка помечена rejected."""
+
+
+class UploadBusy(OffsetMismatch):
+    """Загрузку сейчас дописывает (или завершает) другой запрос."""
+
+    def __init__(self, size):
+        Exception.__init__(self, "Загрузку уже дописывает другой запрос")
+        self.size = size
+
+
+def path(upload):
+    return default_storage.path(upload.audio_file)
+
+
+def received(upload):
+    """Сколько байт реально лежит на диске (после обрыва может быть больше upload.offset)."""
+    try:
+        return os.path.getsize(path(upload))
+    except OSError:
+        return 0
+
+
+def create(doctor, patient, length, filename, is_urgent=False):
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    name = default_storage.save(f'consultations/audio/upload_{uuid.uuid4().hex}.{extension}', ContentFile(b''))
+    return AudioUpload.objects.create(
+        doctor=doctor, patient=patient, is_urgent=is_urgent, audio_file=name, length=length,
+    )
+
+
+def _hasher(upload, size):
+    state = _forget(upload)
+    if state is not None and state[0] == size:
+        return state[1]
+    hasher = hashlib.sha256()
+    with open(path(upload), 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher
+
+
+def _remember(upload, size, hasher):
+    with _hashers_lock:
+        while len(_hashers) >= MAX_HASHERS:
+            _hashers.pop(next(iter(_hashers)))
+        _hashers[upload.id] = (size, hasher)
+
+
+def _forget(upload):
+    with _hashers_lock:
+        return _hashers.pop(upload.id, None)
+
+
+def _claim(upload, owner):
+    """Аренда записи: свободна или истекла (запрос завис или воркер умер) — берем."""
+    now = timezone.now()
+    return AudioUpload.objects.filter(id=upload.id, status='uploading').filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+    ).update(lock_owner=owner, locked_until=now + timedelta(seconds=settings.UPLOAD_LOCK_SECONDS)) == 1
+
+
+def _renew(upload, owner):
+    return AudioUpload.objects.filter(id=upload.id, lock_owner=owner).update(
+        locked_until=timezone.now() + timedelta(seconds=settings.UPLOAD_LOCK_SECONDS),
+    ) == 1
+
+
+@contextmanager
+def _locked(upload):
+    """Проверка offset и запись — только под арендой: два PATCH с одним offset не допишут кусок дважды."""
+    owner = uuid.uuid4().hex
+    if not _claim(upload, owner):
+        raise UploadBusy(received(upload))
+    try:
+        yield owner
+    finally:
+        AudioUpload.objects.filter(id=upload.id, lock_owner=owner).update(lock_owner='', locked_until=None)
+
+
+def append(upload, stream, offset):
+    """
+    Дописывает кусок из потока (request) блоками, не держа его в памяти целиком.
+    Возвращает новый размер; при расхождении offset — OffsetMismatch с реальным размером,
+    кусок пишет другой запрос — UploadBusy.
+    """
+    with _locked(upload) as owner:
+        size = _append(upload, stream, offset, owner)
+
+    # Последний кусок проверяет complete() целиком
+    if not upload.codec and settings.UPLOAD_PROBE_BYTES <= size < upload.length:
+        check_header(upload)
+    return size
+
+
+def _append(upload, stream, offset, owner):
+    size = received(upload)
+    if offset != size:
+        raise OffsetMismatch(size)
+    hasher = _hasher(upload, size)
+    renewed = time.monotonic()
+    try:
+        with open(path(upload), 'ab') as f:
+            while size < upload.length:
+                block = stream.read(min(BLOCK_SIZE, upload.length - size))
+                if not block:
+                    break
+                # Клиент молчал дольше аренды — загрузку мог забрать повтор, дописывать нельзя
+                if time.monotonic() - renewed > settings.UPLOAD_LOCK_SECONDS / 3:
+                    if not _renew(upload, owner):
+                        raise UploadBusy(size)
+                    renewed = time.monotonic()
+                f.write(block)
+                hasher.update(block)
+                size += len(block)
+    finally:
+        # Оборвавшийся кусок не теряем: клиент продолжит с того, что успело дойти
+        _remember(upload, size, hasher)
+        upload.offset = size
+        AudioUpload.objects.filter(id=upload.id, lock_owner=owner).update(offset=size, updated_at=timezone.now())
+    return size
+
+
+def probe(file_path):
+    """
+    Кодек и длительность по шапке: {'codec': 'aac' | None, 'duration': float | None}.
+    None — контейнер не читается (для m4a с moov в конце — пока файл не загружен целиком).
+    """
+    try:
+        output = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name:format=duration',
+             '-of', 'json', file_path],
+            capture_output=True, timeout=10,
+        )
+    except FileNotFoundError:
+        output = None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    if output is not None:
+        if output.returncode != 0:
+            return None
+        try:
+            data = json.loads(output.stdout)
+        except ValueError:
+            return None
+        codecs = [s.get('codec_name') for s in data.get('streams', []) if s.get('codec_type') == 'audio']
+        try:
+            duration = float(data.get('format', {}).get('duration'))
+        except (TypeError, ValueError):
+            duration = None
+        return {'codec': codecs[0] if codecs else None, 'duration': duration}
+
+    # ffprobe нет (см. transcription_queue.probe_duration) — читаем шапку из ffmpeg -i
+    try:
+        stderr = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-i', file_path],
+                                capture_output=True, timeout=10).stderr.decode(errors='replace')
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if 'Input #0' not in stderr:
+        return None
+    codec = AUDIO_STREAM_RE.search(stderr)
+    match = DURATION_RE.search(stderr)
+    duration = None
+    if match is not None:
+        hours, minutes, seconds = match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return {'codec': codec.group(1) if codec else None, 'duration': duration}
+
+
+def max_volume(file_path, start=0.0, seconds=None, timeout=60):
+    """
+    Пиковая громкость в dBFS (-inf — полная тишина) всей записи или отрезка
+    [start, start + seconds); None — ffmpeg недоступен. Не уложился в timeout — TimeoutExpired.
+    """
+    command = ['ffmpeg', '-nostdin', '-hide_banner']
+    if start:
+        command += ['-ss', f'{start:.3f}']
+    if seconds:
+        command += ['-t', f'{seconds:.3f}']
+    command += ['-i', file_path, '-vn', '-af', 'volumedetect', '-f', 'null', '-']
+    try:
+        result = subprocess.run(command, capture_output=True, timeout=timeout)
+    except FileNotFoundError:
+        return None
+    except subprocess.TimeoutExpired:
+        raise
+    except subprocess.SubprocessError:
+        raise UploadRejected("Не удалось декодировать запись")
+    match = MAX_VOLUME_RE.search(result.stderr.decode(errors='replace'))
+    if result.returncode != 0 or match is None:
+        raise UploadRejected("Не удалось декодировать запись")
+    return float(match.group(1))
+
+
+def sampled_max_volume(file_path, duration):
+    """
+    Пик громкости по UPLOAD_SILENCE_SAMPLES отрезкам, разложенным по всей записи.
+    Декодировать сотни мегабайт в последнем PATCH — минуты, а для отказа по тишине
+    достаточно, что звука нет ни в одном отрезке. Громкий отрезок — дальше не смотрим.
+    Все вызовы ffmpeg вместе — не дольше UPLOAD_SILENCE_BUDGET_SECONDS (PATCH ждет ответа):
+    не успели — None, как без ffmpeg, и запись уходит в очередь без проверки.
+    """
+    seconds = settings.UPLOAD_SILENCE_SAMPLE_SECONDS
+    samples = settings.UPLOAD_SILENCE_SAMPLES
+    deadline = time.monotonic() + settings.UPLOAD_SILENCE_BUDGET_SECONDS
+
+    def measure(**kwargs):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            return max_volume(file_path, timeout=remaining, **kwargs)
+        except subprocess.TimeoutExpired:
+            return None
+
+    if not duration or duration <= seconds * samples:
+        peak = measure()
+    else:
+        step = (duration - seconds) / max(samples - 1, 1)
+        peak = None
+        for i in range(samples):
+            volume = measure(start=i * step, seconds=seconds)
+            if volume is None:
+                peak = None
+                break
+            peak = volume if peak is None else max(peak, volume)
+            if peak > settings.UPLOAD_SILENCE_DB:
+                break
+    if peak is None and time.monotonic() >= deadline:
+        print(f"⚠️ [Upload] Проверка тишины не уложилась в {settings.UPLOAD_SILENCE_BUDGET_SECONDS:g} с, пропускаю")
+    return peak
+
+
+def reject(upload, message):
+    print(f"🚫 [Upload] Загрузка {upload.id} отклонена: {message}")
+    _forget(upload)
+    default_storage.delete(upload.audio_file)
+    upload.status = 'rejected'
+    upload.error = message
+    upload.save(update_fields=['status', 'error', 'updated_at'])
+
+
+def check_header(upload, complete=False):
+    """
+    Проверка по шапке. Пока файл не дошел целиком, отказываем, только если контейнер
+    прочитан и аудиодорожки в нем нет; нечитаемая шапка — ждем следующих кусков.
+    Длительность недокачанного файла ffprobe оценивает по размеру — проверяем ее только в конце.
+    """
+    info = probe(path(upload))
+    if info is None:
+        if complete:
+            reject(upload, "Файл не распознан как аудиозапись")
+            raise UploadRejected(upload.error)
+        return
+    if info['codec'] is None:
+        reject(upload, "В файле нет аудиодорожки")
+        raise UploadRejected(upload.error)
+    if complete and info['duration'] is not None and info['duration'] < settings.UPLOAD_MIN_SECONDS:
+        reject(upload, f"Запись короче {settings.UPLOAD_MIN_SECONDS:g} с")
+        raise UploadRejected(upload.error)
+    upload.codec = info['codec']
+    upload.duration = info['duration'] if complete else None
+    AudioUpload.objects.filter(id=upload.id).update(codec=upload.codec, duration=upload.duration)
+
+
+def complete(upload):
+    """
+    Последний кусок дошел: длительность по полному файлу, проверка на тишину, консультация.
+    В очередь консультацию ставит вызывающий (как и обычную загрузку).
+    Под арендой: два одновременных последних PATCH не создадут две консультации.
+    """
+    with _locked(upload):
+        return _complete(upload)
+
+
+def _complete(upload):
+    check_header(upload, complete=True)
+
+    try:
+        volume = sampled_max_volume(path(upload), upload.duration)
+    except UploadRejected as e:
+        reject(upload, str(e))
+        raise
+    if volume is not None and volume <= settings.UPLOAD_SILENCE_DB:
+        reject(upload, "В записи тишина")
+        raise UploadRejected(upload.error)
+
+    audio_hash = _hasher(upload, upload.length).hexdigest()
+    _forget(upload)
+    audio_file = upload.audio_file
+    existing = transcription_cache.stored_audio(audio_hash)
+    if existing is not None:
+        print(f"♻️ [Upload] Аудио совпадает с уже загруженным ({existing}), копию не храню")
+        default_storage.delete(audio_file)
+        audio_file = existing
+
+    consultation = Consultation.objects.create(
+        doctor_id=upload.doctor_id, patient_id=upload.patient_id, is_urgent=upload.is_urgent,
+        audio_file=audio_file, audio_hash=audio_hash,
+    )
+    upload.status = 'complete'
+    upload.consultation = consultation
+    upload.save(update_fields=['status', 'consultation', 'updated_at'])
+    return consultation
+
+
+def expire():
+    """Удаляет брошенные загрузки (и их файлы). Возвращает число удаленных."""
+    deadline = timezone.now() - timedelta(hours=settings.UPLOAD_EXPIRE_HOURS)
+    stale = AudioUpload.objects.filter(updated_at__lt=deadline).exclude(status='complete')
+    count = 0
+    for upload in stale.only('id', 'audio_file', 'status'):
+        if upload.status == 'uploading':
+            default_storage.delete(upload.audio_file)
+        _forget(upload)
+        upload.delete()
+        count += 1
+    return count
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import PatientViewSet, ConsultationViewSet
+from .views import PatientViewSet, ConsultationViewSet, ExportJobViewSet, AudioUploadViewSet, prometheus_metrics
 
 # Создаем роутер
 router = DefaultRouter()
@@ -8,8 +8,12 @@ router = DefaultRouter()
 # --- ВОТ ЭТИХ СТРОК СКОРЕЕ ВСЕГО НЕ ХВАТАЕТ ---
 router.register(r'patients', PatientViewSet)
 router.register(r'consultations', ConsultationViewSet)
+router.register(r'exports', ExportJobViewSet)
+router.register(r'uploads', AudioUploadViewSet)
 # ---------------------------------------------
 
 urlpatterns = [
+    # Для Prometheus: /api/metrics/
+    path('metrics/', prometheus_metrics, name='metrics'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -1,27 +1,55 @@
-import json
-from rest_framework import viewsets, permissions, status
+import uuid
+from rest_framework import mixins, viewsets, permissions, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied, Throttled
 from rest_framework.response import Response
-from django.http import HttpResponse
-from django.template.loader import render_to_string
-from xhtml2pdf import pisa
-from .models import Patient, Consultation
-from .serializers import PatientSerializer, ConsultationSerializer
-try:
-    from django_q.tasks import async_task
-except ImportError:
-    # Для django-q2 используем другой импорт
-    try:
-        from django_q.pusher import async_task
-    except ImportError:
-        # Если не работает, используем заглушку (синхронный запуск)
-        def async_task(func_path, *args, **kwargs):
-            print(f"⚠️ Django-Q не настроен, запускаем синхронно: {func_path}")
-            import importlib
-            module_path, func_name = func_path.rsplit('.', 1)
-            module = importlib.import_module(module_path)
-            func = getattr(module, func_name)
-            func(*args, **kwargs)
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from .models import Patient, Consultation, LiveSession, ExportJob, AudioUpload
+from .pagination import ConsultationCursorPagination
+from .serializers import (
+    PatientSerializer, ConsultationSerializer, LiveConsultationSerializer, ExportJobSerializer, AudioUploadSerializer,
+    requested_fields,
+)
+from . import (
+    ai_service, exports, live, metrics, pdf_reports, progress, segment_store, transcription_cache, transcription_queue, uploads,
+)
+# Django Q или, без него, встроенный пул с ограниченной очередью (api/ai_service.py)
+from .ai_service import async_task
+
+
+def start_processing(instance, duration=None):
+    """
+    Новая консультация -> очередь транскрибации (api/transcription_queue.py): в Django Q задача
+    уйдет, когда освободится слот, — одна клиника не займет воркеры за всех.
+    """
+    job = transcription_queue.enqueue(instance, duration=duration)
+
+    if settings.WHISPER_BATCH_SCHEDULER:
+        # Из очереди запись заберет пакетный планировщик (api/batch_scheduler.py)
+        print(f"🚀 [API] Консультация {instance.id} создана. Ждет пакетный планировщик...")
+        return
+
+    print(f"🚀 [API] Консультация {instance.id} создана (приоритет {job.get_priority_display()}), в очереди")
+    transcription_queue.dispatch()
+
+
+def scoped_organization(request):
+    """
+    Клиника, по которой отвечаем на запрос. Врач видит только свою; ?organization=
+    принимаем лишь от персонала (is_staff) — иначе любой прочитал бы данные чужой клиники.
+    """
+    if request.user.is_staff:
+        return request.query_params.get('organization') or request.user.organization_id
+    if request.user.organization_id is None:
+        raise PermissionDenied("Пользователь не привязан к клинике")
+    return request.user.organization_id
+
 
 class PatientViewSet(viewsets.ModelViewSet):
     """
@@ -35,71 +63,364 @@ class ConsultationViewSet(viewsets.ModelViewSet):
     """
     Главный API. Обрабатывает загрузку аудио и скачивание отчетов.
     """
-    queryset = Consultation.objects.all().order_by('-created_at')
+    # Врач и пациент нужны каждой строке (doctor_name, patient_info) — берем одним JOIN
+    queryset = Consultation.objects.select_related('doctor', 'patient').order_by('-created_at', '-id')
     serializer_class = ConsultationSerializer
+    pagination_class = ConsultationCursorPagination
+
+    # Тексты лежат в ConsultationContent: JOIN только если их просили в ?fields= (или поля не заданы)
+    HEAVY_FIELDS = {'raw_transcription', 'generated_report', 'final_report'}
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        requested = requested_fields(self.request)
+        if requested is None or requested & self.HEAVY_FIELDS:
+            queryset = queryset.select_related('content')
+        return queryset
 
     def perform_create(self, serializer):
         """
         Метод срабатывает при POST запросе (загрузка файла).
         """
-        # 1. Сохраняем запись в базу данных MySQL
-        instance = serializer.save()
-        
-        print(f"🚀 [API] Консультация {instance.id} создана. Передаю задачу в Django Q...")
+        # 0. Очередь переполнена — 429 до записи файла на диск, клиент повторит позже
+        try:
+            transcription_queue.check_capacity(serializer.validated_data['patient'].organization)
+        except transcription_queue.QueueFull as e:
+            raise Throttled(wait=e.retry_after, detail=str(e))
+
+        # 1. Считаем хэш содержимого: одинаковые файлы храним один раз
+        audio_hash = transcription_cache.hash_file(serializer.validated_data['audio_file'])
+        existing = transcription_cache.stored_audio(audio_hash)
+
+        # 2. Сохраняем запись в базу данных MySQL
+        if existing is not None:
+            # Такой файл уже лежит в media — ссылаемся на него, а не пишем копию с суффиксом
+            print(f"♻️ [API] Аудио совпадает с уже загруженным ({existing}), копию не создаю")
+            instance = serializer.save(audio_file=existing, audio_hash=audio_hash)
+        else:
+            instance = serializer.save(audio_hash=audio_hash)
+
+        # 3. Ставим в очередь транскрибации
+        start_processing(instance)
+
+    @action(detail=False, methods=['post'])
+    def live(self, request):
+        """
+        Начало живой записи. Дальше браузер шлет куски на /chunk/, в конце — /finish/.
+        """
+        serializer = LiveConsultationSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        extension = serializer.validated_data.pop('format')
+
+        # Пустой файл, в который будут дописываться куски записи
+        name = default_storage.save(f'consultations/audio/live_{uuid.uuid4().hex}.{extension}', ContentFile(b''))
+        instance = serializer.save(audio_file=name, status='recording')
+        live.start_session(instance)
+        print(f"🎙️ [API] Консультация {instance.id}: началась живая запись")
+
+        return Response(self.get_serializer(instance).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'])
+    def chunk(self, request, pk=None):
+        """
+        Очередной кусок записи: сырое тело запроса или multipart-поле 'chunk'.
+        offset (параметр или заголовок Upload-Offset) — сколько байт уже отправлено,
+        при расхождении отвечаем 409 с реальным размером, чтобы клиент дослал с нужного места.
+        """
+        consultation = self.get_object()
+        if consultation.status != 'recording':
+            return Response({"error": "Запись уже завершена"}, status=status.HTTP_409_CONFLICT)
+        try:
+            ai_service.check_capacity()
+        except ai_service.ExecutorFull as e:
+            raise Throttled(wait=e.retry_after, detail=str(e))
+
+        try:
+            offset = int(request.query_params.get('offset', request.headers.get('Upload-Offset', '')))
+        except ValueError:
+            return Response({"error": "Не указан offset"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if request.content_type.startswith('multipart/'):
+            uploaded = request.FILES.get('chunk')
+            data = uploaded.read() if uploaded else b''
+        else:
+            data = request.body
+
+        try:
+            size = live.append_chunk(consultation, data, offset)
+        except live.OffsetMismatch as e:
+            return Response({"error": str(e), "offset": e.size}, status=status.HTTP_409_CONFLICT)
+
+        # Один шаг распознавания в очереди на сессию: воркер сам возьмет всё накопленное
+        if live.claim_tick(consultation.id):
+            try:
+                async_task('api.tasks.transcribe_live', consultation.id)
+            except ai_service.ExecutorFull:
+                # Кусок уже сохранен: шаг распознавания поставит следующий кусок
+                live.release_tick(consultation.id)
+
+        return Response({"offset": size})
+
+    @action(detail=True, methods=['post'])
+    def finish(self, request, pk=None):
+        """
+        Конец приема: дораспознаём хвост и строим отчет.
+        """
+        consultation = self.get_object()
+        if consultation.status != 'recording':
+            return Response({"error": "Запись уже завершена"}, status=status.HTTP_409_CONFLICT)
+        try:
+            ai_service.check_capacity()
+        except ai_service.ExecutorFull as e:
+            raise Throttled(wait=e.retry_after, detail=str(e))
 
-        # 2. АСИНХРОННЫЙ ЗАПУСК:
-        # Мы не ждем выполнения! Мы просто кидаем задачу в очередь.
-        # 'api.tasks.process_audio' — это путь к функции, которую мы писали в tasks.py
-        async_task('api.tasks.process_audio', instance.id)
+        LiveSession.objects.filter(consultation=consultation).update(finished=True)
+        consultation.set_status('processing')
+        progress.status(consultation.id, 'processing', percent=90)
+
+        async_task('api.tasks.finish_live', consultation.id)
+        return Response(self.get_serializer(consultation).data)
+
+    @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated])
+    def export(self, request):
+        """
+        Массовая выгрузка PDF в ZIP: ?patient=&doctor=&organization=&date_from=&date_to=
+        Небольшой объем отдаем сразу потоком, большой (или ?background=1) — фоновой задачей (202).
+        Клинику выбирает только персонал, врач выгружает лишь свою (scoped_organization).
+        """
+        try:
+            filters = exports.clean_filters(request.query_params)
+            organization = scoped_organization(request)
+            if organization is not None:
+                filters['organization'] = int(organization)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        consultations = exports.filter_consultations(filters)
+        count = consultations.count()
+        if request.query_params.get('background') or count > settings.EXPORT_SYNC_MAX:
+            try:
+                ai_service.check_capacity()
+            except ai_service.ExecutorFull as e:
+                raise Throttled(wait=e.retry_after, detail=str(e))
+            job = exports.create_job(filters, request.user)
+            async_task('api.tasks.run_export', job.id)
+            print(f"📦 [API] Выгрузка {job.id}: {count} отчетов, ставлю в очередь")
+            return Response(ExportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+        response = StreamingHttpResponse(exports.stream_zip(consultations), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="Medical_Reports.zip"'
+        return response
+
+    @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated])
+    def queue(self, request):
+        """
+        Состояние очереди транскрибации по клиникам: сколько ждет и выполняется,
+        время ожидания слота (p50/p95 за последний час). Врач видит только свою клинику,
+        персонал — все или ?organization=.
+        executor — режим исполнения задач и глубина очереди встроенного пула (api/ai_service.py).
+        """
+        organization = scoped_organization(request)
+        return Response({"results": transcription_queue.stats(organization), "executor": ai_service.stats()})
+
+    @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated])
+    def search(self, request):
+        """
+        Поиск фразы по транскриптам клиники: ?q=...&organization=
+        Возвращает места в записях; audio_url с #t= открывает плеер сразу на фразе.
+        """
+        phrase = request.query_params.get('q', '').strip()
+        # Врач ищет только по своей клинике; ?organization= — только для персонала
+        organization = scoped_organization(request)
+        if not phrase or not organization:
+            return Response({"error": "Нужны параметры q и organization"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(int(request.query_params.get('limit', 50)), 200)
+        except ValueError:
+            return Response({"error": "limit должен быть числом"}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = []
+        for segment, offset in segment_store.search(organization, phrase, limit):
+            consultation = segment.consultation
+            results.append({
+                "consultation": consultation.id,
+                "patient": str(consultation.patient),
+                "created_at": consultation.created_at,
+                "start": segment.start,
+                "end": segment.end,
+                "offset": offset,
+                "text": segment.text,
+                "audio_url": request.build_absolute_uri(f"{consultation.audio_file.url}#t={offset:.2f}"),
+            })
+        return Response({"results": results})
 
     @action(detail=True, methods=['get'])
     def download_pdf(self, request, pk=None):
         """
-        Генерация и скачивание PDF файла.
+        Скачивание PDF файла. Готовый PDF берется из кэша (api/pdf_reports.py),
+        по If-None-Match отвечаем 304, если отчет не менялся.
         """
         consultation = self.get_object()
 
-        # 1. Подготовка данных (парсим JSON от ИИ)
         try:
-            # Если в базе лежит текст JSON, превращаем его в словарь
-            if consultation.final_report:
-                report_data = json.loads(consultation.final_report)
-            else:
-                raise ValueError("Отчет пуст")
-        except (json.JSONDecodeError, ValueError, TypeError):
-            # Заглушка, если ИИ еще думает или произошла ошибка
-            report_data = {
-                "complaints": consultation.raw_transcription or "Транскрибация в процессе...",
-                "anamnesis": "Данные обрабатываются...",
-                "diagnosis": "Диагноз не сформирован",
-                "recommendations": "Ожидайте завершения анализа."
-            }
-
-        # 2. Собираем контекст для шаблона HTML
-        context = {
-            'doctor': consultation.doctor.get_full_name() if consultation.doctor else "Дежурный врач",
-            'patient': f"{consultation.patient.last_name} {consultation.patient.first_name}",
-            'date': consultation.created_at.strftime("%d.%m.%Y"),
-            'report': report_data,
-            'report_id': consultation.id
-        }
-
-        # 3. Генерируем PDF
-        response = HttpResponse(content_type='application/pdf')
+            context = pdf_reports.build_context(consultation)
+            quoted_etag = f'"{pdf_reports.content_hash(context)}"'
+            if quoted_etag in request.headers.get('If-None-Match', ''):
+                # У клиента актуальная версия — даже не открываем файл
+                response = HttpResponseNotModified()
+                response['ETag'] = quoted_etag
+                return response
+            path, _etag = pdf_reports.get_or_render(consultation, context)
+        except pdf_reports.PdfRenderError as e:
+            return Response({"error": str(e)}, status=500)
+        except Exception as e:
+            return Response({"error": f"Ошибка шаблона: {str(e)}"}, status=500)
+
         filename = f"Medical_Report_{consultation.patient.last_name}_{pk}.pdf"
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response = FileResponse(open(path, 'rb'), as_attachment=True, filename=filename,
+                                content_type='application/pdf')
+        response['ETag'] = quoted_etag
+        # Браузер может хранить копию, но обязан переспросить сервер (отчет могут отредактировать)
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+
+class AudioUploadViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    Загрузка длинных записей по частям (api/uploads.py), в духе протокола tus:
+    POST /api/uploads/ (filename, doctor, patient; размер — заголовок Upload-Length),
+    затем PATCH /api/uploads/<id>/ с Upload-Offset и телом application/offset+octet-stream.
+    HEAD/GET — сколько байт уже получено (продолжить после обрыва).
+    Последний кусок создает консультацию и ставит ее в очередь.
+    """
+    queryset = AudioUpload.objects.all()
+    serializer_class = AudioUploadSerializer
+    CHUNK_CONTENT_TYPES = ('application/offset+octet-stream', 'application/octet-stream')
 
+    def upload_headers(self, upload):
+        return {'Upload-Offset': str(upload.offset), 'Upload-Length': str(upload.length), 'Cache-Control': 'no-store'}
+
+    def create(self, request):
+        data = dict(request.data.items())
+        data.setdefault('length', request.headers.get('Upload-Length'))
+        serializer = self.get_serializer(data=data)
+        serializer.is_valid(raise_exception=True)
+
+        # Очередь переполнена — 429 до того, как клиент начнет слать сотни мегабайт
         try:
-            # Рендерим HTML из шаблона
-            html_string = render_to_string('report.html', context)
-            
-            # Конвертируем HTML -> PDF
-            pisa_status = pisa.CreatePDF(html_string, dest=response)
+            transcription_queue.check_capacity(serializer.validated_data['patient'].organization)
+        except transcription_queue.QueueFull as e:
+            raise Throttled(wait=e.retry_after, detail=str(e))
 
-            if pisa_status.err:
-                return Response({"error": "Ошибка конвертации в PDF"}, status=500)
-                
-            return response
+        upload = uploads.create(
+            doctor=serializer.validated_data['doctor'],
+            patient=serializer.validated_data['patient'],
+            length=serializer.validated_data['length'],
+            filename=serializer.validated_data['filename'],
+            is_urgent=serializer.validated_data.get('is_urgent', False),
+        )
+        print(f"📥 [Upload] Загрузка {upload.id}: {upload.length} байт")
+        headers = self.upload_headers(upload)
+        headers['Location'] = request.build_absolute_uri(reverse('audioupload-detail', args=[upload.id]))
+        return Response(self.get_serializer(upload).data, status=status.HTTP_201_CREATED, headers=headers)
 
-        except Exception as e:
-            return Response({"error": f"Ошибка шаблона: {str(e)}"}, status=500)
\ No newline at end of file
+    def retrieve(self, request, pk=None):
+        upload = self.get_object()
+        if upload.status == 'uploading':
+            upload.offset = uploads.received(upload)
+        return Response(self.get_serializer(upload).data, headers=self.upload_headers(upload))
+
+    def partial_update(self, request, pk=None):
+        """
+        Очередной кусок. Тело читаем из потока блоками (request.data не трогаем — DRF
+        не буферизует файл). Расхождение offset — 409 с реальным размером.
+        """
+        upload = self.get_object()
+        if upload.status == 'rejected':
+            return Response({"error": upload.error}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        if upload.status != 'uploading':
+            return Response({"error": "Загрузка уже завершена"}, status=status.HTTP_409_CONFLICT)
+        if request.content_type.split(';')[0].strip() not in self.CHUNK_CONTENT_TYPES:
+            return Response({"error": "Кусок передается как application/offset+octet-stream"},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return Response({"error": "Не указан Upload-Offset"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            size = uploads.append(upload, request, offset)
+            if size < upload.length:
+                return Response(status=status.HTTP_204_NO_CONTENT, headers=self.upload_headers(upload))
+            consultation = uploads.complete(upload)
+        except live.OffsetMismatch as e:
+            return Response({"error": str(e), "offset": e.size}, status=status.HTTP_409_CONFLICT,
+                            headers={'Upload-Offset': str(e.size)})
+        except uploads.UploadRejected as e:
+            return Response({"error": str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        # Файл уже у нас: в очередь ставим даже при ее переполнении, лимит проверен при создании
+        start_processing(consultation, duration=upload.duration)
+        return Response(self.get_serializer(upload).data, headers=self.upload_headers(upload))
+
+
+class ExportJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Фоновые выгрузки PDF: статус, скачивание готового ZIP, продолжение после сбоя.
+    Врач видит выгрузки своей клиники, персонал — все.
+    """
+    queryset = ExportJob.objects.all().order_by('-created_at')
+    serializer_class = ExportJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.user.is_staff:
+            return queryset
+        return queryset.filter(requested_by__organization_id=scoped_organization(self.request))
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, pk=None):
+        job = self.get_object()
+        if job.status != 'ready':
+            return Response({"error": "Выгрузка еще не готова"}, status=status.HTTP_409_CONFLICT)
+        return FileResponse(open(job.archive, 'rb'), as_attachment=True,
+                            filename=f"Medical_Reports_{job.id}.zip", content_type='application/zip')
+
+    @action(detail=True, methods=['post'])
+    def resume(self, request, pk=None):
+        """
+        Продолжить выгрузку с last_id (после ошибки или остановки воркера).
+        Живая цепочка run_export сохраняет задачу после каждой пачки; пока она не молчит
+        дольше EXPORT_JOB_STALE_SECONDS — 409, иначе две цепочки писали бы один архив.
+        """
+        job = self.get_object()
+        if job.status == 'ready':
+            return Response({"error": "Выгрузка уже готова"}, status=status.HTTP_409_CONFLICT)
+        stale = timezone.now() - timedelta(seconds=settings.EXPORT_JOB_STALE_SECONDS)
+        if job.status != 'error' and job.updated_at > stale:
+            return Response({"error": "Выгрузка уже идет"}, status=status.HTTP_409_CONFLICT)
+        try:
+            ai_service.check_capacity()
+        except ai_service.ExecutorFull as e:
+            raise Throttled(wait=e.retry_after, detail=str(e))
+
+        # Условный UPDATE: из двух одновременных resume цепочку запустит только один
+        claimed = ExportJob.objects.filter(id=job.id, status=job.status, updated_at=job.updated_at).update(
+            status='running' if job.last_id else 'queued', error='', updated_at=timezone.now())
+        if not claimed:
+            return Response({"error": "Выгрузка уже идет"}, status=status.HTTP_409_CONFLICT)
+        job.refresh_from_db()
+        async_task('api.tasks.run_export', job.id)
+        return Response(ExportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+def prometheus_metrics(request):
+    """
+    Метрики конвейера в текстовом формате Prometheus (api/metrics.py).
+    Если задан METRICS_TOKEN — только с заголовком Authorization: Bearer <токен>.
+    """
+    if settings.METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {settings.METRICS_TOKEN}":
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
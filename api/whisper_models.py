@@ -0,0 +1,214 @@
+"""
+Реестр моделей Whisper на уровне процесса.
+
+Каждая комбинация (модель, устройство, тип вычислений) загружается один раз
+на процесс воркера Django Q и дальше переиспользуется между задачами.
+Если суммарный размер загруженных моделей превышает лимит памяти,
+вытесняется модель, которая дольше всех не использовалась (LRU). Место освобождаем
+до загрузки, по оценке размера новой модели: иначе пик памяти — лимит плюс еще одна модель.
+
+Экземпляр модели общий для всех потоков процесса, а распознавать им можно только
+по одному: декодер Whisper на время decode() вешает на модель хуки kv-кэша, и
+одновременные вызовы портят результаты друг друга. Поэтому каждый вызов модели
+идет под inference(model) — потоки встроенного пула (api/ai_service.py) ждут друг друга.
+Реестр это обеспечивает сам: код, который берет модель из get_model(), вызывает ее
+только внутри inference().
+
+Загрузка (секунды, а то и минуты) идет без общей блокировки _lock: она держится только
+на время работы со словарями. Второй поток, которому нужна та же модель, ждет ту же
+загрузку (Future в _loading), остальные модели и inference() в это время доступны.
+"""
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import torch
+import whisper  # Библиотека ИИ
+from django.conf import settings
+
+from . import metrics
+
+# Ключ -> {'model': ..., 'bytes': ...}. Порядок = порядок последнего использования.
+_models = OrderedDict()
+_lock = threading.RLock()
+# Ключ -> Future идущей загрузки: одна загрузка на ключ, остальные потоки ждут ее
+_loading = {}
+# Модель -> блокировка распознавания (см. docstring модуля)
+_inference_locks = weakref.WeakKeyDictionary()
+
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'load_seconds_total': 0.0,
+    'load_seconds': {},  # ключ -> время последней загрузки
+}
+
+SUPPORTED_COMPUTE_TYPES = ('float32', 'float16', 'int8')
+
+# Параметров в модели (млн) и байт на параметр — оценка памяти до загрузки
+MODEL_PARAMS_M = {'tiny': 39, 'base': 74, 'small': 244, 'medium': 769, 'large': 1550, 'turbo': 809}
+BYTES_PER_PARAM = {'float32': 4, 'float16': 2, 'int8': 1}
+# Ключ -> реальный размер после прошлой загрузки (точнее оценки по таблице)
+_sizes = {}
+
+
+def _make_key(name, device, compute_type):
+    return (
+        name or settings.WHISPER_MODEL,
+        device or settings.WHISPER_DEVICE,
+        compute_type or settings.WHISPER_COMPUTE_TYPE,
+    )
+
+
+def _model_size_bytes(model):
+    """Оценка памяти, занимаемой весами и буферами модели (включая упакованные int8-веса)."""
+    total = 0
+    for value in model.state_dict().values():
+        tensors = value if isinstance(value, tuple) else (value,)
+        for tensor in tensors:
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def _quantize_int8(model):
+    """
+    Динамическая int8-квантизация линейных слоёв (веса int8, активации квантуются на лету).
+    whisper.model.Linear — подкласс nn.Linear, который только приводит dtype весов;
+    quantize_dynamic работает по точному типу, поэтому сначала приводим к nn.Linear.
+    """
+    for module in model.modules():
+        if isinstance(module, whisper.model.Linear):
+            module.__class__ = torch.nn.Linear
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _load(name, device, compute_type):
+    if compute_type not in SUPPORTED_COMPUTE_TYPES:
+        raise ValueError(f"Неизвестный тип вычислений: {compute_type}")
+    if compute_type == 'int8' and device != 'cpu':
+        raise ValueError("int8-квантизация поддерживается только на CPU")
+    model = whisper.load_model(name, device=device)
+    if compute_type == 'float16':
+        model = model.half()
+    elif compute_type == 'int8':
+        model = _quantize_int8(model)
+    return model
+
+
+def _estimate_bytes(key):
+    """Сколько займет модель: прошлая загрузка, иначе таблица; 0 — не знаем (своя модель по пути)."""
+    if key in _sizes:
+        return _sizes[key]
+    name, _, compute_type = key
+    family = name.split('.')[0]  # 'small.en' -> 'small'
+    family = 'turbo' if 'turbo' in family else family.split('-')[0]  # 'large-v3' -> 'large'
+    params = MODEL_PARAMS_M.get(family)
+    if params is None:
+        return 0
+    return params * 1_000_000 * BYTES_PER_PARAM.get(compute_type, 4)
+
+
+def _evict(keep_key=None, incoming=0):
+    """Вытесняем самые старые модели, пока вместе с incoming байт не уложимся в лимит памяти."""
+    limit = settings.WHISPER_MODEL_MEMORY_LIMIT_MB * 1024 * 1024
+    while True:
+        candidates = [key for key in _models if key != keep_key]
+        if not candidates or sum(entry['bytes'] for entry in _models.values()) + incoming <= limit:
+            return
+        old_key = candidates[0]
+        del _models[old_key]
+        _stats['evictions'] += 1
+        print(f"♻️ [Models] Выгружена модель {old_key} (лимит памяти)")
+
+
+def get_model(name=None, device=None, compute_type=None):
+    """
+    Возвращает "тёплую" модель Whisper, загружая её при первом обращении.
+    """
+    key = _make_key(name, device, compute_type)
+    with _lock:
+        entry = _models.get(key)
+        if entry is not None:
+            _models.move_to_end(key)
+            _stats['hits'] += 1
+            metrics.count('model_cache_hits')
+            return entry['model']
+
+        future = _loading.get(key)
+        loading = future is None
+        if loading:
+            future = _loading[key] = Future()
+            _stats['misses'] += 1
+            metrics.count('model_cache_misses')
+            # Освобождаем место до загрузки, а не после — с учетом моделей, которые грузятся сейчас
+            _evict(incoming=sum(_estimate_bytes(other) for other in _loading))
+
+    if not loading:
+        # Эту модель уже грузит другой поток; ошибка загрузки достанется и нам
+        return future.result()
+
+    print(f"📥 [Models] Загружаю модель Whisper {key}...")
+    started = time.monotonic()
+    try:
+        with metrics.span('model_load'):
+            model = _load(*key)
+    except BaseException as e:
+        with _lock:
+            del _loading[key]
+        future.set_exception(e)
+        raise
+    elapsed = time.monotonic() - started
+    size = _model_size_bytes(model)
+
+    with _lock:
+        _stats['load_seconds_total'] += elapsed
+        _stats['load_seconds'][key] = elapsed
+        _sizes[key] = size
+        _models[key] = {'model': model, 'bytes': size}
+        del _loading[key]
+        # Оценка могла оказаться меньше реального размера
+        _evict(keep_key=key)
+    print(f"✅ [Models] Модель {key} загружена за {elapsed:.1f} c")
+    future.set_result(model)
+    return model
+
+
+@contextmanager
+def inference(model):
+    """Монопольный доступ к модели на время распознавания."""
+    with _lock:
+        lock = _inference_locks.get(model)
+        if lock is None:
+            lock = _inference_locks[model] = threading.Lock()
+    with lock:
+        yield model
+
+
+def preload(names=None):
+    """Прогрев моделей при старте воркера."""
+    for name in names if names is not None else settings.WHISPER_PRELOAD_MODELS:
+        get_model(name)
+
+
+def stats():
+    """Снимок метрик реестра (для логов и мониторинга)."""
+    with _lock:
+        return {
+            'hits': _stats['hits'],
+            'misses': _stats['misses'],
+            'evictions': _stats['evictions'],
+            'load_seconds_total': _stats['load_seconds_total'],
+            'load_seconds': {'/'.join(key): value for key, value in _stats['load_seconds'].items()},
+            'resident': {'/'.join(key): entry['bytes'] for key, entry in _models.items()},
+        }
+
+
+def clear():
+    """Выгружает все модели (для тестов и ручного сброса)."""
+    with _lock:
+        _models.clear()